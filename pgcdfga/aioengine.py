@@ -0,0 +1,265 @@
+#!/usr/bin/env python
+
+# Copyright 2019 Bol.com
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''
+Module with the building blocks of the asyncio engine (see pgcdfga --engine asyncio), which
+waits for the round trips to all databases (and ldap) of all clusters on one event loop,
+instead of one after the other.
+Queries that fan out over databases run on asynchronous psycopg2 connections. The DDL of
+PGConnection (and the ldap searches of LDAPConnection) are blocking, and run in worker threads.
+
+=== Authors
+Sebastiaan Mannem <smannem@bol.com>
+Jing Rao <jrao@bol.com>
+'''
+
+import asyncio
+import logging
+from collections import OrderedDict
+import psycopg2
+from psycopg2.extensions import POLL_OK, POLL_READ, POLL_WRITE
+from pgcdfga.pgcatalog import EXTENSIONS_QUERY, CLUSTER_FINGERPRINT_QUERY, \
+    DATABASE_FINGERPRINT_QUERY
+from pgcdfga.pgconnection import prepared_statement, redact
+from pgcdfga.pgpool import DEFAULT_MAX_CONNECTIONS
+from pgcdfga.planner import PHASES, apply_operations
+from pgcdfga.metrics import QUERIES, QUERY_SECONDS
+
+
+async def wait_ready(conn):
+    '''
+    Wait (on the running event loop) until an asynchronous psycopg2 connection is done
+    connecting, or done running a query.
+    '''
+    loop = asyncio.get_running_loop()
+    while True:
+        state = conn.poll()
+        if state == POLL_OK:
+            return
+        if state == POLL_READ:
+            add, remove = loop.add_reader, loop.remove_reader
+        elif state == POLL_WRITE:
+            add, remove = loop.add_writer, loop.remove_writer
+        else:
+            raise psycopg2.OperationalError('Unexpected poll state {}'.format(state))
+        ready = loop.create_future()
+        fd = conn.fileno()
+        add(fd, lambda: ready.done() or ready.set_result(None))
+        try:
+            await ready
+        finally:
+            remove(fd)
+
+
+async def gather(awaitables):
+    '''
+    Run awaitables concurrently and return their results (like asyncio.gather), but when one
+    of them fails, only raise its exception after all others are done too (so that nothing
+    is still using the connections when the caller handles the error).
+    '''
+    results = await asyncio.gather(*awaitables, return_exceptions=True)
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+    return results
+
+
+class AsyncPGConnection():
+    '''
+    This class runs queries on asynchronous psycopg2 connections, one per database, so that
+    queries on different databases wait for their round trips at the same time.
+    Every connection runs one query at a time, and at most max_queries queries run at a time.
+    Idle connections (and the statements prepared on them) are kept over runs, but at most
+    max_connections connections are kept open: like PGConnectionPool, the least recently used
+    connection that is not running a query is closed when a new connection is needed.
+    '''
+    def __init__(self, connect, max_queries=1, max_connections=DEFAULT_MAX_CONNECTIONS):
+        '''
+        Sets some defaults on a new initted AsyncPGConnection class.
+        connect is a callable that returns a new asynchronous connection to a database,
+        e.a. functools.partial(PGConnection.new_connection, async_=True).
+        '''
+        self.__connect = connect
+        self.max_queries = max_queries
+        self.max_connections = max_connections
+        self.__connections = OrderedDict()
+        self.__prepared = {}
+        self.__loop = None
+        self.__limit = None
+        self.__locks = {}
+
+    def __limits(self, database):
+        '''
+        Returns the semaphore that limits the queries of the cluster, and the lock of the
+        connection to database. Both belong to the running event loop, and are created again
+        for every loop (every run).
+        '''
+        loop = asyncio.get_running_loop()
+        if loop is not self.__loop:
+            self.__loop = loop
+            self.__limit = asyncio.Semaphore(max(1, self.max_queries))
+            self.__locks = {}
+        return self.__limit, self.__locks.setdefault(database, asyncio.Lock())
+
+    async def run_prepared(self, query, parameters=None, database: str = 'postgres'):
+        '''
+        Run a query with $1, $2, etc. as placeholders for the parameters, and return the
+        results like PGConnection.run_prepared does. The query is prepared on first use on the
+        connection to a database, in the same round trip as the first EXECUTE.
+        A connection that fails (or is cancelled) while running a query is closed.
+        '''
+        limit, lock = self.__limits(database)
+        async with limit, lock:
+            conn = self.__connections.get(database)
+            try:
+                if conn is None:
+                    self.__evict()
+                    conn = self.__connections[database] = self.__connect(database)
+                    self.__prepared[database] = set()
+                    await wait_ready(conn)
+                else:
+                    self.__connections.move_to_end(database)
+                return await self.__execute(conn, query, parameters, database)
+            except (Exception, asyncio.CancelledError):
+                if conn is not None:
+                    self.__close(database)
+                raise
+
+    async def __execute(self, conn, query, parameters, database):
+        '''
+        Run a (prepared) query on a connection and return the results as a list of dicts.
+        '''
+        name, prepare, execute = prepared_statement(query, parameters)
+        statement = execute if name in self.__prepared[database] else prepare
+        QUERIES.inc(database=database)
+        with QUERY_SECONDS.time():
+            logging.debug('query: %s', redact(statement))
+            cur = conn.cursor()
+            cur.execute(statement, parameters)
+            await wait_ready(conn)
+            self.__prepared[database].add(name)
+            if cur.description is None:
+                return None
+            columns = [column[0] for column in cur.description]
+            rows = [dict(zip(columns, row)) for row in cur.fetchall()]
+        cur.close()
+        return rows
+
+    def __evict(self):
+        '''
+        Close least recently used connections (that are not running a query) until there is
+        room for a new connection.
+        '''
+        for database in list(self.__connections):
+            if len(self.__connections) < self.max_connections:
+                return
+            lock = self.__locks.get(database)
+            if lock is not None and lock.locked():
+                continue
+            logging.debug('Closing least recently used connection to database %s', database)
+            self.__close(database)
+        if len(self.__connections) >= self.max_connections:
+            logging.debug('All %d connections are in use. Exceeding max_connections.',
+                          len(self.__connections))
+
+    def __close(self, database):
+        '''
+        Close the connection to a database.
+        '''
+        conn = self.__connections.pop(database)
+        self.__prepared.pop(database, None)
+        try:
+            conn.close()
+        except Exception as error:
+            logging.debug('Could not close connection to database %s: %s', database, error)
+
+    def close(self):
+        '''
+        Close all connections.
+        '''
+        for database in list(self.__connections):
+            self.__close(database)
+
+    def __len__(self):
+        '''
+        Returns the number of open connections.
+        '''
+        return len(self.__connections)
+
+
+async def load_extensions(catalog, apgconn, dbnames):
+    '''
+    Load the extensions of the databases in dbnames into a catalog snapshot (like
+    PGCatalog.load_extensions), reading all databases concurrently.
+    '''
+    dbnames = [dbname for dbname in dbnames if dbname not in catalog.extensions]
+    existing = [dbname for dbname in dbnames if dbname in catalog.databases]
+    results = await gather([apgconn.run_prepared(EXTENSIONS_QUERY, database=dbname)
+                            for dbname in existing])
+    for dbname in dbnames:
+        catalog.extensions[dbname] = {}
+    for dbname, rows in zip(existing, results):
+        catalog.extensions[dbname] = {row['extname']: row['extversion'] for row in rows}
+
+
+async def catalog_fingerprint(apgconn, dbnames):
+    '''
+    Returns the same fingerprint as pgcatalog.catalog_fingerprint, reading the databases in
+    dbnames concurrently.
+    '''
+    rows = await apgconn.run_prepared(CLUSTER_FINGERPRINT_QUERY)
+    existing = {row['datname']
+                for row in await apgconn.run_prepared('SELECT datname FROM pg_database')}
+    dbnames = sorted(set(dbnames) & existing)
+    results = await gather([apgconn.run_prepared(DATABASE_FINGERPRINT_QUERY, database=dbname)
+                            for dbname in dbnames])
+    for dbname, dbrows in zip(dbnames, results):
+        rows += [dict(row, database=dbname) for row in dbrows]
+    return rows
+
+
+async def apply(pgconn, operations, call, batch_size=0, parallelism=1):
+    '''
+    Apply a list of operations on a PGConnection (like planner.apply) and return the number of
+    failed operations. call is a coroutine function that runs a blocking function (with args)
+    in a worker thread. Per phase, the cluster wide operations run first, and then the
+    operations of up to parallelism databases at a time (one worker per database).
+    '''
+    errorcount = 0
+    limit = asyncio.Semaphore(max(1, parallelism))
+
+    async def apply_database(ops):
+        '''
+        Apply the operations of one database (when a worker is free).
+        '''
+        async with limit:
+            return await call(apply_operations, pgconn, ops, batch_size)
+
+    for phase in PHASES:
+        cluster_operations = []
+        database_operations = OrderedDict()
+        for operation in operations:
+            if operation.phase != phase:
+                continue
+            if operation.database is None:
+                cluster_operations.append(operation)
+            else:
+                database_operations.setdefault(operation.database, []).append(operation)
+        if cluster_operations:
+            errorcount += await call(apply_operations, pgconn, cluster_operations, batch_size)
+        errorcount += sum(await gather([apply_database(ops)
+                                        for ops in database_operations.values()]))
+    return errorcount
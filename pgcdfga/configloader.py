@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+
+# Copyright 2019 Bol.com
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''
+Module that loads the yaml config file, and only parses it again when it has changed.
+
+=== Authors
+Sebastiaan Mannem <smannem@bol.com>
+Jing Rao <jrao@bol.com>
+'''
+
+import os
+import time
+import logging
+from copy import deepcopy
+import yaml
+from pgcdfga.configmodel import compile_config
+try:
+    import inotify_simple
+except ImportError:
+    inotify_simple = None
+
+# The libyaml based loader is a lot faster, but is not available everywhere
+YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+# After a change, wait this long (in seconds) for more changes (like a ConfigMap swap)
+DEBOUNCE_DELAY = 0.5
+
+
+def file_signature(filename):
+    '''
+    Returns a tuple that changes when a file (or the file a symlink points to) changes.
+    '''
+    stat = os.stat(filename)
+    return (stat.st_dev, stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+
+class ConfigLoader():
+    '''
+    This class loads a yaml config file and keeps the parsed result.
+    The file is only parsed again when its inode, mtime or size changes, which also detects
+    Kubernetes ConfigMap updates (where symlinks are swapped to a new directory).
+    The config is also compiled (validated) into a ConfigModel only once per parse.
+    When inotify_simple is installed, wait() returns as soon as the file changes.
+    '''
+    def __init__(self, filename):
+        '''
+        Sets some defaults on a new initted ConfigLoader class.
+        '''
+        self.filename = filename
+        self.__signature = None
+        self.__configdata = None
+        self.__model = None
+        self.__inotify = None
+        self.stats = {'loads': 0, 'parses': 0, 'compiles': 0}
+
+    def load(self):
+        '''
+        Returns (a copy of) the parsed config file, parsing it only when it has changed.
+        '''
+        self.stats['loads'] += 1
+        signature = file_signature(self.filename)
+        if signature != self.__signature:
+            logging.debug("Parsing config file %s", self.filename)
+            with open(self.filename) as configfile:
+                self.__configdata = yaml.load(configfile, Loader=YAML_LOADER)
+            self.__signature = signature
+            self.__model = None
+            self.stats['parses'] += 1
+        # The caller may change the config data (e.a. by adding defaults)
+        return deepcopy(self.__configdata)
+
+    def model(self):
+        '''
+        Returns the ConfigModel (see configmodel.compile_config) of the config file that was
+        parsed last by load. It is compiled on first use after every parse, so that the config
+        is validated (and unknown keys are warned about) once per change of the file.
+        '''
+        if self.__model is None:
+            self.__model = compile_config(self.__configdata or {})
+            self.stats['compiles'] += 1
+        return self.__model
+
+    def changed(self):
+        '''
+        Returns True if the config file changed since it was last parsed.
+        '''
+        try:
+            return file_signature(self.filename) != self.__signature
+        except OSError:
+            return False
+
+    def wait(self, delay):
+        '''
+        Sleeps for delay seconds, or less when the config file changes (if inotify is available).
+        Returns True if the config file changed.
+        '''
+        watcher = self.__watcher()
+        if watcher is None:
+            time.sleep(delay)
+            return self.changed()
+        deadline = time.monotonic() + delay
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return self.changed()
+            if watcher.read(timeout=int(remaining * 1000)):
+                # Wait for the rest of the events of this change (debounce)
+                while watcher.read(timeout=int(DEBOUNCE_DELAY * 1000)):
+                    pass
+                if self.changed():
+                    logging.info("Config file %s changed", self.filename)
+                    return True
+
+    def fileno(self):
+        '''
+        Returns the file descriptor that is readable when the config file (or its directory)
+        changes, so that callers can wait for it with select (or None without inotify).
+        '''
+        watcher = self.__watcher()
+        return watcher.fileno() if watcher is not None else None
+
+    def __watcher(self):
+        '''
+        Returns an inotify watch on the directory of the config file (or None without inotify).
+        The directory is watched, so that files and symlinks that are replaced are noticed too.
+        '''
+        if inotify_simple is None:
+            return None
+        if self.__inotify is None:
+            flags = inotify_simple.flags
+            try:
+                watcher = inotify_simple.INotify()
+                watcher.add_watch(os.path.dirname(os.path.abspath(self.filename)),
+                                  flags.CLOSE_WRITE | flags.MOVED_TO | flags.CREATE |
+                                  flags.DELETE | flags.ATTRIB)
+            except OSError as error:
+                logging.warning("Cannot watch config file %s: %s", self.filename, error)
+                return None
+            self.__inotify = watcher
+        return self.__inotify
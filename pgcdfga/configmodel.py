@@ -0,0 +1,281 @@
+#!/usr/bin/env python
+
+# Copyright 2019 Bol.com
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''
+Module that validates the config file against a schema and compiles it into compact records,
+so that the config is checked up front and doesn't need to be merged and normalized in loops.
+
+=== Authors
+Sebastiaan Mannem <smannem@bol.com>
+Jing Rao <jrao@bol.com>
+'''
+
+import re
+import logging
+import datetime
+from pgcdfga.pgconnection import USER_DEFAULTS, ROLE_DEFAULTS, DB_DEFAULTS, EXTENSION_DEFAULTS
+
+AUTH_ENUM = ['ldapgroup', 'ldapuser', 'password', 'md5', 'clientcert']
+
+ENSURE_ENUM = ['present', 'absent']
+
+# This re finds characters that are not a alphabetical letter / digit
+NON_WORD_CHAR_RE = re.compile('[^0-9a-zA-Z]')
+
+SCALAR = (str, int, float)
+
+
+class ConfigError(Exception):
+    '''
+    This exception is raised when (part of) the config does not match the schema.
+    '''
+
+
+def check_type(path, value, types):
+    '''
+    Raises a ConfigError when value is not of one of types (None is always allowed).
+    '''
+    if value is not None and not isinstance(value, types):
+        raise ConfigError('{}: unexpected value {!r}'.format(path, value))
+    return value
+
+
+def string_list(path, value):
+    '''
+    Returns a tuple of strings from a list (or a single string) in the config.
+    '''
+    if value is None:
+        return ()
+    if isinstance(value, str):
+        return (value, )
+    check_type(path, value, list)
+    return tuple(str(check_type(path, item, SCALAR)) for item in value)
+
+
+def ensure_enum(path, value):
+    '''
+    Returns the (lower case) ensure value, which must be present or absent.
+    '''
+    ensure = str(check_type(path, value, str) or 'present').lower()
+    if ensure not in ENSURE_ENUM:
+        msg = '{}: ensure should be one of {}, not {!r}'
+        raise ConfigError(msg.format(path, ENSURE_ENUM, value))
+    return ensure
+
+
+def normalize_auth(value):
+    '''
+    Returns the normalized auth method (like 'ldapgroup' for 'ldap-group').
+    '''
+    auth = NON_WORD_CHAR_RE.sub('', str(value).lower())
+    if auth not in AUTH_ENUM:
+        auth = 'client_cert'
+    return auth
+
+
+def parse_expiry(path, value):
+    '''
+    Returns the expiry of a user as a datetime (or None).
+    You can set only a small portion (like only year, or only year-month) and the rest will be
+    appended.
+    '''
+    if value is None:
+        return None
+    if isinstance(value, datetime.datetime):
+        return value
+    expiry = str(value)
+    expiry = expiry + '2000-12-31 23:59:59'[len(expiry):]
+    try:
+        return datetime.datetime.strptime(expiry, '%Y-%m-%d %H:%M:%S')
+    except ValueError as error:
+        raise ConfigError('{}: invalid expiry {!r} ({})'.format(path, value, error)) from error
+
+
+def with_defaults(path, data, defaults):
+    '''
+    Returns a new dict with defaults, overwritten by data (which should be a dict or empty).
+    Keys that are not in defaults are logged, since they are probably a typo.
+    '''
+    data = data or {}
+    if not isinstance(data, dict):
+        raise ConfigError('{}: expected a dictionary, not {!r}'.format(path, data))
+    for key in data:
+        if key not in defaults:
+            logging.warning('%s: unknown key %s is ignored', path, key)
+    ret = dict(defaults)
+    ret.update(data)
+    return ret
+
+
+class UserConfig():
+    '''
+    This class holds the (validated) config of a user.
+    '''
+    __slots__ = ('name', 'ensure', 'auth', 'expiry', 'memberof', 'password', 'options',
+                 'ldapbasedn', 'ldapfilter')
+
+    def __init__(self, name, data=None):
+        '''
+        Validates and normalizes the config of a user.
+        '''
+        path = 'users.{}'.format(name)
+        data = with_defaults(path, data, dict(USER_DEFAULTS, ldapbasedn=None,
+                                              ldapfilter=None))
+        self.name = name
+        self.ensure = ensure_enum(path, data['ensure'])
+        self.auth = normalize_auth(check_type(path + '.auth', data['auth'], str) or
+                                   USER_DEFAULTS['auth'])
+        self.expiry = parse_expiry(path + '.expiry', data['expiry'])
+        self.memberof = string_list(path + '.memberof', data['memberof'])
+        password = check_type(path + '.password', data['password'], SCALAR)
+        self.password = None if password is None else str(password)
+        self.options = tuple(option.upper() for option in
+                             string_list(path + '.options', data['options']))
+        self.ldapbasedn = check_type(path + '.ldapbasedn', data['ldapbasedn'], str)
+        self.ldapfilter = check_type(path + '.ldapfilter', data['ldapfilter'], str) or name
+
+    def expired(self, now=None):
+        '''
+        Returns True if the expiry date of this user has passed.
+        '''
+        return bool(self.expiry) and (now or datetime.datetime.now()) > self.expiry
+
+    def ldap_query(self):
+        '''
+        Returns the ldapbasedn and ldapfilter to lookup the members of an ldapgroup.
+        '''
+        return self.ldapbasedn, self.ldapfilter
+
+
+class RoleConfig():
+    '''
+    This class holds the (validated) config of a role.
+    '''
+    __slots__ = ('name', 'ensure', 'memberof', 'options')
+
+    def __init__(self, name, data=None):
+        '''
+        Validates and normalizes the config of a role.
+        '''
+        path = 'roles.{}'.format(name)
+        data = with_defaults(path, data, ROLE_DEFAULTS)
+        self.name = name
+        self.ensure = ensure_enum(path, data['ensure'])
+        self.memberof = string_list(path + '.memberof', data['memberof'])
+        self.options = tuple(option.upper() for option in
+                             string_list(path + '.options', data['options']))
+
+
+class ExtensionConfig():
+    '''
+    This class holds the (validated) config of an extension in a database.
+    '''
+    __slots__ = ('name', 'ensure', 'schema', 'version')
+
+    def __init__(self, name, data=None, path='extensions'):
+        '''
+        Validates and normalizes the config of an extension.
+        '''
+        path = '{}.{}'.format(path, name)
+        data = with_defaults(path, data, EXTENSION_DEFAULTS)
+        self.name = name
+        self.ensure = ensure_enum(path, data['ensure'])
+        self.schema = check_type(path + '.schema', data['schema'], str) or \
+            EXTENSION_DEFAULTS['schema']
+        self.version = check_type(path + '.version', data['version'], SCALAR)
+
+
+class DatabaseConfig():
+    '''
+    This class holds the (validated) config of a database.
+    Extensions that are invalid are left out, and reported in errors.
+    '''
+    __slots__ = ('name', 'ensure', 'owner', 'default_privileges', 'extensions', 'errors')
+
+    def __init__(self, name, data=None):
+        '''
+        Validates and normalizes the config of a database and its extensions.
+        '''
+        path = 'databases.{}'.format(name)
+        data = with_defaults(path, data, DB_DEFAULTS)
+        self.name = name
+        self.ensure = ensure_enum(path, data['ensure'])
+        self.owner = check_type(path + '.owner', data['owner'], str)
+        self.default_privileges = bool(check_type(path + '.default_privileges',
+                                                  data['default_privileges'], bool))
+        self.extensions = []
+        self.errors = []
+        extensions = data['extensions'] or {}
+        if not isinstance(extensions, dict):
+            self.errors.append('{}.extensions: expected a dictionary'.format(path))
+            extensions = {}
+        for extname, extconfig in extensions.items():
+            try:
+                self.extensions.append(ExtensionConfig(extname, extconfig,
+                                                       path + '.extensions'))
+            except ConfigError as error:
+                self.errors.append(str(error))
+
+
+class ConfigModel():
+    '''
+    This class holds the compiled config: lists of UserConfig, RoleConfig and DatabaseConfig
+    records, and the schema errors as (strict chapter, message) tuples.
+    Entries with errors are left out, so they are neither created nor dropped.
+    '''
+    __slots__ = ('users', 'roles', 'databases', 'replication_slots', 'errors')
+
+    def __init__(self):
+        '''
+        Sets some defaults on a new initted (and empty) ConfigModel class.
+        '''
+        self.users = []
+        self.roles = []
+        self.databases = []
+        self.replication_slots = None
+        self.errors = []
+
+
+def compile_config(configdata):
+    '''
+    Validates the users, roles, databases and replication slots in the config and
+    returns a ConfigModel.
+    '''
+    model = ConfigModel()
+    for chapter, record, strict_chapter, records in [
+            ('users', UserConfig, 'users', model.users),
+            ('roles', RoleConfig, 'users', model.roles),
+            ('databases', DatabaseConfig, 'databases', model.databases)]:
+        entries = configdata.get(chapter) or {}
+        if not isinstance(entries, dict):
+            model.errors.append((strict_chapter, '{}: expected a dictionary'.format(chapter)))
+            continue
+        for name, data in entries.items():
+            try:
+                records.append(record(name, data))
+            except ConfigError as error:
+                model.errors.append((strict_chapter, str(error)))
+    for database in model.databases:
+        model.errors += [('extensions', error) for error in database.errors]
+    if 'replication_slots' in configdata:
+        slots = configdata['replication_slots']
+        if isinstance(slots, dict):
+            slots = list(slots)
+        try:
+            model.replication_slots = list(string_list('replication_slots', slots))
+        except ConfigError as error:
+            model.errors.append((None, str(error)))
+    return model
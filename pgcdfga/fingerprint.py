@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+
+# Copyright 2019 Bol.com
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''
+Module that detects if anything changed since the last successful run, so that runs
+where nothing changed can be skipped.
+
+=== Authors
+Sebastiaan Mannem <smannem@bol.com>
+Jing Rao <jrao@bol.com>
+'''
+
+import hashlib
+import json
+import logging
+
+DEFAULT_FULL_RUN_EVERY = 10
+
+
+def digest(*parts):
+    '''
+    Returns a sha256 hex digest of (json serializable) parts.
+    '''
+    data = json.dumps(parts, sort_keys=True, default=str)
+    return hashlib.sha256(data.encode()).hexdigest()
+
+
+class ChangeDetector():
+    '''
+    This class remembers the fingerprint of the last successful run.
+    A run with the same fingerprint can be skipped, except for every full_run_every'th run,
+    which always runs in full (so that drift that is not in the fingerprint is fixed as well).
+    '''
+    def __init__(self, full_run_every=DEFAULT_FULL_RUN_EVERY):
+        '''
+        Sets some defaults on a new initted ChangeDetector class.
+        '''
+        self.full_run_every = full_run_every
+        self.__fingerprint = None
+        self.__skipped_in_a_row = 0
+        self.stats = {'runs': 0, 'skipped': 0}
+
+    def unchanged(self, fingerprint):
+        '''
+        Returns True (and counts a skipped run) if the run with this fingerprint can be skipped.
+        '''
+        self.stats['runs'] += 1
+        if fingerprint != self.__fingerprint:
+            return False
+        if self.__skipped_in_a_row + 1 >= self.full_run_every:
+            logging.debug('Forcing a full run after %d skipped runs', self.__skipped_in_a_row)
+            return False
+        self.__skipped_in_a_row += 1
+        self.stats['skipped'] += 1
+        return True
+
+    def succeeded(self, fingerprint):
+        '''
+        Remember the fingerprint of a successful (full) run.
+        '''
+        self.__fingerprint = fingerprint
+        self.__skipped_in_a_row = 0
+
+    def failed(self):
+        '''
+        Forget the fingerprint, so that the next run will run in full.
+        '''
+        self.__fingerprint = None
+        self.__skipped_in_a_row = 0
+
+    def skip_rate(self):
+        '''
+        Returns the fraction of runs that where skipped.
+        '''
+        if not self.stats['runs']:
+            return 0.0
+        return self.stats['skipped'] / self.stats['runs']
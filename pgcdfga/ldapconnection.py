@@ -24,11 +24,21 @@ Jing Rao <jrao@bol.com>
 """
 
 import logging
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from ldap3 import ServerPool, Server, Connection, SUBTREE, MOCK_SYNC, OFFLINE_SLAPD_2_4
 from ldap3.core.exceptions import LDAPException
+from pgcdfga.metrics import LDAP_SEARCHES, LDAP_PAGES, LDAP_SEARCH_SECONDS, LDAP_GROUP_SECONDS
 
 LDAP_DEFAULTS = {'servers': [], 'user': None, 'password': None, 'port': 636,
-                 'ldapbasedn': 'OU=DC=example,DC=com', 'conn_retries': True}
+                 'ldapbasedn': 'OU=DC=example,DC=com', 'conn_retries': True,
+                 'cache_ttl': 0, 'cache_max_staleness': 3600, 'page_size': 500,
+                 'bulk_size': 50, 'connections': 1}
+
+# Filters like (cn=team1) can be combined into one search (and split out again afterwards)
+SIMPLE_FILTER_RE = re.compile(r'^\(([a-zA-Z][\w-]*)=([^()*\\]+)\)$')
 
 
 class LDAPConnectionException(Exception):
@@ -37,16 +47,109 @@ class LDAPConnectionException(Exception):
     '''
 
 
+class MembershipCache():
+    '''
+    This class caches the members of ldap groups, so that they don't need to be looked up
+    on every run. It lives longer than a LDAPConnection (which is created on every run).
+    Results younger than ttl are returned as is. Older results (up to max_staleness) are
+    returned while they are refreshed in the background, and are also the fallback
+    when ldap is unavailable. Results older than max_staleness are looked up directly.
+    '''
+    def __init__(self):
+        '''
+        Sets some defaults on a new initted (and empty) MembershipCache class.
+        '''
+        self.__entries = {}
+        self.__refreshing = {}
+        self.__lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'stale_hits': 0, 'refreshes': 0,
+                      'refresh_errors': 0}
+
+    def get(self, key, lookup, ttl, max_staleness):
+        '''
+        Returns the cached members for key, calling lookup() to (re)fetch them when needed.
+        '''
+        with self.__lock:
+            entry = self.__entries.get(key)
+            age = time.monotonic() - entry[0] if entry else None
+            if entry and age < ttl:
+                self.stats['hits'] += 1
+                return list(entry[1])
+            if entry and age < max_staleness:
+                self.stats['stale_hits'] += 1
+                if key not in self.__refreshing:
+                    thread = threading.Thread(target=self.__refresh, args=(key, lookup),
+                                              daemon=True)
+                    self.__refreshing[key] = thread
+                    thread.start()
+                return list(entry[1])
+            self.stats['misses'] += 1
+        return list(self.__store(key, lookup()))
+
+    def can_serve(self, key, ttl, max_staleness):
+        '''
+        Returns True if get can return the cached members for key without a lookup
+        (because they are younger than ttl, or can be refreshed in the background).
+        '''
+        with self.__lock:
+            entry = self.__entries.get(key)
+            return bool(entry) and time.monotonic() - entry[0] < max(ttl, max_staleness)
+
+    def __store(self, key, members):
+        '''
+        Store members for key (with the current time).
+        '''
+        members = tuple(members)
+        with self.__lock:
+            self.__entries[key] = (time.monotonic(), members)
+        return members
+
+    def __refresh(self, key, lookup):
+        '''
+        Refresh the members for key (runs in a background thread).
+        On errors the stale result is kept (until it is older than max_staleness).
+        '''
+        event = 'refresh_errors'
+        try:
+            self.__store(key, lookup())
+            event = 'refreshes'
+        except Exception as error:
+            logging.warning('Could not refresh ldap group members for %s: %s', key, error)
+        finally:
+            # Refreshes of other keys run concurrently (in other threads)
+            with self.__lock:
+                self.stats[event] += 1
+                del self.__refreshing[key]
+
+    def join(self):
+        '''
+        Wait for all background refreshes to finish.
+        '''
+        with self.__lock:
+            threads = list(self.__refreshing.values())
+        for thread in threads:
+            thread.join()
+
+
 class LDAPConnection():
     '''
     Init a new ldap connection
     '''
-    def __init__(self, ldapconfig=None):
+    def __init__(self, ldapconfig=None, cache=None):
         '''
         This method initializes a ldap connection object.
+        With a MembershipCache (and ldap cache_ttl set), group members are cached.
         '''
         self.__config = ldapconfig
         self.__connection = None
+        self.__cache = cache
+        # Members of groups that where resolved by resolve_groups
+        self.__resolved = {}
+        # Pool of bound connections, so that groups can be searched simultaneously
+        self.__idle = []
+        self.__pool_size = 0
+        self.__pool_lock = threading.Lock()
+        self.__semaphore = threading.BoundedSemaphore(max(1, self.__get_param('connections', 1)))
 
         if not self.__config.get('enabled', True):
             return
@@ -78,30 +181,80 @@ class LDAPConnection():
         if mock_connection:
             pass
         elif not self.__connection:
-            ldapservers = [Server(ldap_server,
-                                  port=self.__get_param('port', 636),
-                                  use_ssl=self.__get_param('use_ssl', True),
-                                  connect_timeout=1) for ldap_server in
-                           self.__get_param('servers')]
-            con_retries = self.__get_param('conn_retries', 1)
-            serverpool = ServerPool(ldapservers,
-                                    active=con_retries,
-                                    exhaust=(con_retries > 0))
-            logging.debug("Attempting to connect to LDAP servers: %s", serverpool.servers)
-            try:
-                self.__connection = Connection(serverpool,
-                                               self.__get_param('user', ''),
-                                               self.__get_param('password', ''),
-                                               auto_bind=True)
-                logging.debug("Successfully connected to LDAP servers")
-            except LDAPException as error:
-                logging.error("Unable to connect to LDAP servers: %s", str(error))
-                # If we get here then self.__connection will be None,
-                # but let's return it explicitly in case there is some
-                # condition where that isn't the case.
-                raise
+            self.__connection = self.__bind()
         return self.__connection
 
+    def __bind(self):
+        '''
+        This method returns a new bound connection to a(n) ldap server(s).
+        '''
+        if self.__get_param('mockdata', {}):
+            return self.__mock_connection()
+        ldapservers = [Server(ldap_server,
+                              port=self.__get_param('port', 636),
+                              use_ssl=self.__get_param('use_ssl', True),
+                              connect_timeout=1) for ldap_server in
+                       self.__get_param('servers')]
+        con_retries = self.__get_param('conn_retries', 1)
+        serverpool = ServerPool(ldapservers,
+                                active=con_retries,
+                                exhaust=(con_retries > 0))
+        logging.debug("Attempting to connect to LDAP servers: %s", serverpool.servers)
+        try:
+            connection = Connection(serverpool,
+                                    self.__get_param('user', ''),
+                                    self.__get_param('password', ''),
+                                    auto_bind=True)
+            logging.debug("Successfully connected to LDAP servers")
+        except LDAPException as error:
+            logging.error("Unable to connect to LDAP servers: %s", str(error))
+            raise
+        return connection
+
+    def __acquire(self):
+        '''
+        This method returns a connection from the pool (binding a new one if needed).
+        It blocks while all ldap connections are in use.
+        '''
+        self.__semaphore.acquire()
+        with self.__pool_lock:
+            if self.__idle:
+                return self.__idle.pop()
+            first = self.__pool_size == 0
+            self.__pool_size += 1
+        try:
+            # The first connection of the pool is the one that connect() returns
+            conn = self.connect() if first else self.__bind()
+        except Exception:
+            with self.__pool_lock:
+                self.__pool_size -= 1
+            self.__semaphore.release()
+            raise
+        if conn is None:
+            with self.__pool_lock:
+                self.__pool_size -= 1
+            self.__semaphore.release()
+        return conn
+
+    def __release(self, conn, broken=False):
+        '''
+        This method returns a connection (that was returned by __acquire) to the pool.
+        Broken connections are dropped from the pool instead.
+        '''
+        with self.__pool_lock:
+            if not broken:
+                self.__idle.append(conn)
+            else:
+                self.__pool_size -= 1
+                if conn is self.__connection:
+                    self.__connection = None
+        if broken:
+            try:
+                conn.unbind()
+            except Exception as error:
+                logging.debug('Could not unbind broken ldap connection: %s', error)
+        self.__semaphore.release()
+
     def mock_connect(self):
         '''
         This method checks if mocking is needed and if so, creates a mocked
@@ -113,30 +266,31 @@ class LDAPConnection():
         if self.__connection:
             return self.__connection
 
-        mockdata = self.__get_param('mockdata', {})
-        if not mockdata:
+        if not self.__get_param('mockdata', {}):
             return None
+        self.__connection = self.__mock_connection()
+        return self.__connection
 
+    def __mock_connection(self):
+        '''
+        This method creates a new mocked connection with the mockdata from the config.
+        '''
         my_fake_server = Server('my_fake_server', get_info=OFFLINE_SLAPD_2_4)
         connection = Connection(my_fake_server,
                                 user='cn=my_user,ou=test,o=lab',
                                 password='my_password',
                                 client_strategy=MOCK_SYNC)
 
-        for user, userconfig in mockdata.items():
+        for user, userconfig in self.__get_param('mockdata').items():
             connection.strategy.add_entry(user, userconfig)
         connection.bind()
         logging.debug("Mocking the LDAP connection")
-        self.__connection = connection
         return connection
 
-    def ldap_grp_mmbrs(self, ldapbasedn=None, ldapfilter=None):
+    def __query(self, ldapbasedn, ldapfilter):
         '''
-        This function is used to get a list of users in a ldap group
+        This method returns the basedn and filter (with defaults and template applied).
         '''
-        if not self.__get_param('enabled', True):
-            return []
-
         if not ldapbasedn:
             ldapbasedn = self.__get_param('basedn', '')
         if '(' not in ldapfilter:
@@ -146,20 +300,181 @@ class LDAPConnection():
                 raise LDAPConnectionException(msg.format(ldapfilter))
             _ldapfilter = filter_template % ldapfilter
             ldapfilter = _ldapfilter
-        result_set = set()
-        conn = self.connect()
+        return ldapbasedn, ldapfilter
+
+    def __use_cache(self):
+        '''
+        This method returns True if group members should be cached.
+        '''
+        return self.__cache is not None and self.__get_param('cache_ttl', 0) > 0
+
+    def ldap_grp_mmbrs(self, ldapbasedn=None, ldapfilter=None):
+        '''
+        This function is used to get a list of users in a ldap group
+        '''
+        if not self.__get_param('enabled', True):
+            return []
+        with LDAP_GROUP_SECONDS.time():
+            return self.__group_members(ldapbasedn, ldapfilter)
+
+    def __group_members(self, ldapbasedn, ldapfilter):
+        '''
+        This method returns the members of a ldap group (for ldap_grp_mmbrs).
+        '''
+        key = self.__query(ldapbasedn, ldapfilter)
+        if key in self.__resolved and not self.__use_cache():
+            return list(self.__resolved[key])
+        if self.__use_cache():
+            # Groups that where resolved by resolve_groups are stored in the cache by the
+            # lookup, so that every group is counted as a hit, stale hit or miss
+            if key in self.__resolved:
+                resolved = self.__resolved[key]
+
+                def lookup():
+                    return resolved
+            else:
+                def lookup():
+                    return self.__search_members(*key)
+            members = self.__cache.get(key, lookup, self.__get_param('cache_ttl', 0),
+                                       self.__get_param('cache_max_staleness', 0))
+        else:
+            members = self.__search_members(*key)
+        # Within one run (one LDAPConnection), every group is looked up only once
+        self.__resolved[key] = members
+        return list(members)
+
+    def resolve_groups(self, queries):
+        '''
+        This method resolves the members of many ldap groups with a few combined searches.
+        queries is a list of (ldapbasedn, ldapfilter) as they would be sent to ldap_grp_mmbrs.
+        Simple filters (like '(cn=team1)') with the same basedn are combined into OR filters
+        of at most bulk_size filters. Other filters are searched one by one.
+        All searches are run simultaneously on (at most) 'connections' ldap connections.
+        The results are used by ldap_grp_mmbrs afterwards.
+        Groups that the cache can serve (fresh, or stale and refreshed in the background) and
+        groups that failed are left to ldap_grp_mmbrs.
+        '''
+        if not self.__get_param('enabled', True):
+            return
+        filters_per_basedn = {}
+        searches = []
+        for query in queries:
+            key = ldapbasedn, ldapfilter = self.__query(*query)
+            if key in self.__resolved:
+                continue
+            if self.__use_cache() and self.__cache.can_serve(
+                    key, self.__get_param('cache_ttl', 0),
+                    self.__get_param('cache_max_staleness', 0)):
+                continue
+            match = SIMPLE_FILTER_RE.match(ldapfilter)
+            if not match:
+                if key not in searches:
+                    searches.append(key)
+                continue
+            filters = filters_per_basedn.setdefault(ldapbasedn, {})
+            # Filters that only differ in case match the same groups, and share one key
+            same_group = filters.setdefault((match.group(1).lower(), match.group(2).lower()), [])
+            if ldapfilter not in same_group:
+                same_group.append(ldapfilter)
+        bulk_size = self.__get_param('bulk_size', 50)
+        for ldapbasedn, filters in filters_per_basedn.items():
+            items = sorted(filters.items())
+            for start in range(0, len(items), bulk_size):
+                searches.append((ldapbasedn, dict(items[start:start + bulk_size])))
+        connections = self.__get_param('connections', 1)
+        if connections > 1 and len(searches) > 1:
+            with ThreadPoolExecutor(max_workers=connections) as executor:
+                list(executor.map(self.__resolve, searches))
+        else:
+            for search in searches:
+                self.__resolve(search)
+
+    def __resolve(self, search):
+        '''
+        This method runs one search for resolve_groups. Errors are logged, so that the group(s)
+        will be searched again (or read from the cache) by ldap_grp_mmbrs.
+        '''
+        ldapbasedn, filters = search
+        try:
+            if isinstance(filters, dict):
+                self.__search_bulk(ldapbasedn, filters)
+            else:
+                self.__resolved[search] = self.__search_members(ldapbasedn, filters)
+        except Exception as error:
+            logging.warning('Could not resolve ldap groups in %s: %s', ldapbasedn, error)
+
+    def __search_bulk(self, ldapbasedn, filters):
+        '''
+        This method searches ldap for the members of groups with one OR filter,
+        and splits the results out per filter.
+        filters is a dict of {(attribute, lowercase value): [filters]}.
+        '''
+        members = {ldapfilter: set() for same_group in filters.values()
+                   for ldapfilter in same_group}
+        attributes = sorted({attribute for attribute, _ in filters})
+        bulkfilter = '(|{})'.format(''.join(sorted(members)))
+        for group in self.__paged_search(ldapbasedn, bulkfilter, ['memberUid'] + attributes):
+            if 'raw_attributes' not in group:
+                continue
+            raw_attributes = {name.lower(): values for name, values in
+                              group['raw_attributes'].items()}
+            uids = {uid.decode() for uid in raw_attributes.get('memberuid', [])}
+            for attribute in attributes:
+                for value in raw_attributes.get(attribute, []):
+                    for ldapfilter in filters.get((attribute, value.decode().lower()), []):
+                        members[ldapfilter] |= uids
+        for ldapfilter, uids in members.items():
+            uids.discard('dummy')
+            self.__resolved[(ldapbasedn, ldapfilter)] = sorted(uids)
+        logging.debug("LDAP server returned members for %d groups with one search",
+                      len(members))
+
+    def __paged_search(self, ldapbasedn, ldapfilter, attributes):
+        '''
+        This method is a generator that streams all entries that match ldapfilter.
+        The connection is returned to the pool when the generator is exhausted, fails or is
+        closed (e.a. when the consumer stops early).
+        '''
+        conn = self.__acquire()
         if conn is None:
             logging.info("No LDAP connection available to fetch groups members")
-        else:
-            groups = conn.extend.standard.paged_search(search_base=ldapbasedn,
-                                                       search_filter=ldapfilter,
-                                                       search_scope=SUBTREE,
-                                                       attributes=['memberUid'],
-                                                       paged_size=5,
-                                                       generator=True)
-            for group in groups:
-                members = [uid.decode() for uid in group['raw_attributes']['memberUid']]
-                result_set |= set(members)
-            logging.debug("LDAP server returned the groups %s", sorted(result_set))
-            result_set.discard('dummy')
+            return
+        page_size = self.__get_param('page_size', 500)
+        entries = 0
+        LDAP_SEARCHES.inc()
+        start = time.monotonic()
+        released = False
+        try:
+            for entry in conn.extend.standard.paged_search(search_base=ldapbasedn,
+                                                           search_filter=ldapfilter,
+                                                           search_scope=SUBTREE,
+                                                           attributes=attributes,
+                                                           paged_size=page_size,
+                                                           generator=True):
+                entries += 1
+                yield entry
+        except Exception:
+            self.__release(conn, broken=True)
+            released = True
+            raise
+        finally:
+            # Every page but the last one is full
+            LDAP_PAGES.inc(entries // page_size + 1)
+            LDAP_SEARCH_SECONDS.observe(time.monotonic() - start)
+            if not released:
+                self.__release(conn)
+
+    def __search_members(self, ldapbasedn, ldapfilter):
+        '''
+        This method searches ldap for the members of the groups that match ldapfilter.
+        '''
+        result_set = set()
+        for group in self.__paged_search(ldapbasedn, ldapfilter, ['memberUid']):
+            if 'raw_attributes' not in group:
+                # Referrals (e.a. from Active Directory) have no attributes
+                continue
+            members = [uid.decode() for uid in group['raw_attributes'].get('memberUid', [])]
+            result_set |= set(members)
+        logging.debug("LDAP server returned the groups %s", sorted(result_set))
+        result_set.discard('dummy')
         return sorted(result_set)
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+
+# Copyright 2019 Bol.com
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''
+Module that prefixes log lines with the name of the cluster they are about, so that the logs
+of clusters that run concurrently (in threads or on an event loop) can be told apart.
+
+=== Authors
+Sebastiaan Mannem <smannem@bol.com>
+Jing Rao <jrao@bol.com>
+'''
+
+import logging
+import contextvars
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+# The name of the cluster that the current thread (or asyncio task) is working on
+CLUSTER = contextvars.ContextVar('pgcdfga_cluster', default=None)
+
+
+class ClusterFilter(logging.Filter):
+    '''
+    This class prefixes the message of every log record with the name of the cluster (when
+    one is set, see cluster_logging).
+    '''
+    def filter(self, record):
+        '''
+        Prefixes the message of a record, and lets it through.
+        '''
+        name = CLUSTER.get()
+        if name and not hasattr(record, 'cluster'):
+            record.cluster = name
+            record.msg = '{}: {}'.format(name, record.getMessage())
+            record.args = None
+        return True
+
+
+def install():
+    '''
+    Add a ClusterFilter to the root logger (which all modules log to), unless it has one.
+    '''
+    root = logging.getLogger()
+    if not any(isinstance(existing, ClusterFilter) for existing in root.filters):
+        root.addFilter(ClusterFilter())
+
+
+@contextmanager
+def cluster_logging(name):
+    '''
+    Prefix the log lines of the current thread (or asyncio task) with name (None for no
+    prefix) while in the with block.
+    '''
+    token = CLUSTER.set(name)
+    try:
+        yield
+    finally:
+        CLUSTER.reset(token)
+
+
+def run_as(name, function, *args):
+    '''
+    Run a function (with args) with the log lines prefixed with name, and return its result.
+    '''
+    with cluster_logging(name):
+        return function(*args)
+
+
+def worker_pool(max_workers):
+    '''
+    Returns a ThreadPoolExecutor whose workers prefix their log lines with the cluster of the
+    thread that creates it.
+    '''
+    return ThreadPoolExecutor(max_workers=max_workers, initializer=CLUSTER.set,
+                              initargs=(CLUSTER.get(), ))
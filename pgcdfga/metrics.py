@@ -0,0 +1,358 @@
+#!/usr/bin/env python
+
+# Copyright 2019 Bol.com
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''
+Module that holds counters and latency histograms of what pgcdfga does (queries, DDL,
+connections, ldap searches, objects changed and phase durations), and exposes them in the
+Prometheus text format, through a small http endpoint or a textfile (for the node exporter).
+
+=== Authors
+Sebastiaan Mannem <smannem@bol.com>
+Jing Rao <jrao@bol.com>
+'''
+
+import os
+import time
+import logging
+import tempfile
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Latency buckets (in seconds), from a fast query to a slow phase
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0, 30.0, 60.0)
+
+METRICS_DEFAULTS = {'port': 0, 'address': '', 'textfile': None}
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def format_value(value):
+    '''
+    Returns a sample value as Prometheus expects it.
+    '''
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+def format_labels(labels):
+    '''
+    Returns labels (a tuple of (name, value) pairs) as Prometheus expects them, e.a. {a="b"}.
+    '''
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+               for _, value in labels)
+    return '{' + ','.join('{}="{}"'.format(name, value)
+                          for (name, _), value in zip(labels, escaped)) + '}'
+
+
+class Metric():
+    '''
+    This class is the base of all metrics. A metric holds a value per combination of labels.
+    '''
+    metric_type = 'untyped'
+
+    def __init__(self, name, documentation, labelnames=()):
+        '''
+        Sets some defaults on a new initted Metric class.
+        '''
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        '''
+        Returns the labels (given as keyword arguments) as a key for _values.
+        '''
+        if set(labels) != set(self.labelnames):
+            raise ValueError('{} expects labels {}, not {}'.format(self.name, self.labelnames,
+                                                                   sorted(labels)))
+        return tuple((name, str(labels[name])) for name in self.labelnames)
+
+    def samples(self):
+        '''
+        Returns a list of (name, labels, value) of all samples of this metric.
+        '''
+        with self._lock:
+            return [(self.name, key, value) for key, value in sorted(self._values.items())]
+
+    def exposition(self):
+        '''
+        Returns this metric in the Prometheus text format.
+        '''
+        lines = ['# HELP {} {}'.format(self.name, self.documentation),
+                 '# TYPE {} {}'.format(self.name, self.metric_type)]
+        for name, labels, value in self.samples():
+            lines.append('{}{} {}'.format(name, format_labels(labels), format_value(value)))
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    '''
+    This class counts events (per combination of labels).
+    '''
+    metric_type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        '''
+        Increments the counter for labels.
+        '''
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def set(self, value, **labels):
+        '''
+        Sets the counter for labels, for counters that are kept elsewhere (like cache stats).
+        '''
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def value(self, **labels):
+        '''
+        Returns the current value of the counter for labels.
+        '''
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+
+class Gauge(Counter):
+    '''
+    This class holds a value that can go up and down (per combination of labels).
+    '''
+    metric_type = 'gauge'
+
+
+class Histogram(Metric):
+    '''
+    This class counts observations (like latencies) in buckets (per combination of labels).
+    '''
+    metric_type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        '''
+        Sets some defaults on a new initted Histogram class.
+        '''
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'), )
+
+    def observe(self, value, **labels):
+        '''
+        Adds an observation for labels.
+        '''
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * len(self.buckets), 0))
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+            self._values[key] = counts, total + value
+
+    @contextmanager
+    def time(self, **labels):
+        '''
+        Context manager that observes how long the block took (also when it raises).
+        '''
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - start, **labels)
+
+    def count(self, **labels):
+        '''
+        Returns the number of observations for labels.
+        '''
+        with self._lock:
+            counts, _ = self._values.get(self._key(labels), ([0], 0))
+        return counts[-1]
+
+    def samples(self):
+        '''
+        Returns a list of (name, labels, value) of all samples (buckets, sum and count).
+        '''
+        samples = []
+        with self._lock:
+            for key, (counts, total) in sorted(self._values.items()):
+                for bound, count in zip(self.buckets, counts):
+                    samples.append((self.name + '_bucket', key + (('le', format_value(bound)), ),
+                                    count))
+                samples.append((self.name + '_sum', key, total))
+                samples.append((self.name + '_count', key, counts[-1]))
+        return samples
+
+
+class Registry():
+    '''
+    This class holds all metrics, and exposes them in the Prometheus text format.
+    '''
+    def __init__(self):
+        '''
+        Sets some defaults on a new initted (and empty) Registry class.
+        '''
+        self.__metrics = {}
+        self.__lock = threading.Lock()
+
+    def register(self, metric):
+        '''
+        Adds a metric (or returns the metric that was registered with the same name before).
+        '''
+        with self.__lock:
+            return self.__metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, documentation, labelnames=()):
+        '''
+        Returns a new (registered) Counter.
+        '''
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        '''
+        Returns a new (registered) Gauge.
+        '''
+        return self.register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        '''
+        Returns a new (registered) Histogram.
+        '''
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def exposition(self):
+        '''
+        Returns all metrics in the Prometheus text format.
+        '''
+        with self.__lock:
+            metrics = [self.__metrics[name] for name in sorted(self.__metrics)]
+        return ''.join(metric.exposition() + '\n' for metric in metrics)
+
+    def write_textfile(self, filename):
+        '''
+        Writes all metrics to a file for the textfile collector of the node exporter.
+        The file is replaced atomically, so that the collector never reads half a file.
+        '''
+        directory = os.path.dirname(os.path.abspath(filename))
+        handle, tmpname = tempfile.mkstemp(dir=directory, prefix='.pgcdfga', suffix='.prom')
+        try:
+            with os.fdopen(handle, 'w') as tmpfile:
+                tmpfile.write(self.exposition())
+            os.chmod(tmpname, 0o644)
+            os.replace(tmpname, filename)
+        except Exception:
+            os.unlink(tmpname)
+            raise
+
+    def serve(self, port, address=''):
+        '''
+        Serves all metrics over http (on every path) from a daemon thread.
+        Returns the http server (server.server_address holds the actual port).
+        '''
+        registry = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            '''
+            This class answers every GET request with the metrics.
+            '''
+            def do_GET(self):  # pylint: disable=C0103
+                '''
+                Sends the metrics.
+                '''
+                body = registry.exposition().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', CONTENT_TYPE)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):  # pylint: disable=W0622
+                '''
+                Log requests at debug level, instead of to stderr.
+                '''
+                logging.debug('metrics: ' + format, *args)
+
+        server = ThreadingHTTPServer((address, port), MetricsHandler)
+        server.daemon_threads = True
+        thread = threading.Thread(target=server.serve_forever, name='metrics', daemon=True)
+        thread.start()
+        logging.info('Serving metrics on %s:%d', *server.server_address[:2])
+        return server
+
+
+REGISTRY = Registry()
+
+QUERIES = REGISTRY.counter('pgcdfga_queries_total',
+                           'Queries (round trips) sent to postgres', ['database'])
+QUERY_SECONDS = REGISTRY.histogram('pgcdfga_query_duration_seconds',
+                                   'Latency of queries sent to postgres')
+DDL_STATEMENTS = REGISTRY.counter('pgcdfga_ddl_statements_total',
+                                  'DDL statements issued (run immediately or queued in a batch)')
+CONNECTIONS = REGISTRY.counter('pgcdfga_connections_opened_total',
+                               'Connections opened to postgres')
+CONNECT_SECONDS = REGISTRY.histogram('pgcdfga_connect_duration_seconds',
+                                     'Latency of opening a connection to postgres')
+LDAP_SEARCHES = REGISTRY.counter('pgcdfga_ldap_searches_total', 'Searches sent to ldap')
+LDAP_PAGES = REGISTRY.counter('pgcdfga_ldap_pages_total',
+                              'Pages (of at most page_size entries) read from ldap')
+LDAP_SEARCH_SECONDS = REGISTRY.histogram('pgcdfga_ldap_search_duration_seconds',
+                                         'Latency of ldap searches (reading all pages)')
+LDAP_GROUP_SECONDS = REGISTRY.histogram('pgcdfga_ldap_group_lookup_duration_seconds',
+                                        'Latency of looking up the members of a ldap group')
+OBJECTS = REGISTRY.counter('pgcdfga_objects_changed_total',
+                           'Objects created, altered or dropped', ['object', 'action'])
+OPERATION_SECONDS = REGISTRY.histogram('pgcdfga_operation_duration_seconds',
+                                       'Latency of applying operations, per method '
+                                       '(batched DDL is sent when the batch is full)',
+                                       ['method'])
+PHASE_SECONDS = REGISTRY.histogram('pgcdfga_phase_duration_seconds',
+                                   'Duration of the phases of a run', ['phase'])
+RUNS = REGISTRY.counter('pgcdfga_runs_total', 'Runs, per result', ['result'])
+RUN_ERRORS = REGISTRY.counter('pgcdfga_run_errors_total', 'Errors during runs')
+LAST_RUN = REGISTRY.gauge('pgcdfga_last_run_timestamp_seconds',
+                          'Time the last run finished (since epoch)')
+SKIP_RATE = REGISTRY.gauge('pgcdfga_skip_rate',
+                           'Fraction of runs that where skipped because nothing changed')
+LDAP_CACHE = REGISTRY.counter('pgcdfga_ldap_cache_events_total',
+                              'Events of the ldap membership cache', ['event'])
+CONNECTION_POOL = REGISTRY.counter('pgcdfga_connection_pool_events_total',
+                                   'Events of the postgres connection pool', ['event'])
+PREPARED_STATEMENTS = REGISTRY.counter('pgcdfga_prepared_statements_total',
+                                       'Prepared statements prepared (once per connection) '
+                                       'and executed again (hits)', ['statement', 'event'])
+CLUSTER_RUN_SECONDS = REGISTRY.histogram('pgcdfga_cluster_run_duration_seconds',
+                                         'Duration of the runs of a cluster', ['cluster'])
+CLUSTER_ERRORS = REGISTRY.counter('pgcdfga_cluster_errors_total',
+                                  'Errors during the runs of a cluster', ['cluster'])
+DDL_NOTIFICATIONS = REGISTRY.counter('pgcdfga_ddl_notifications_total',
+                                     'Notifications of DDL sent by the event triggers, per '
+                                     'source (this process or others)', ['source'])
+SCRAM_VERIFIERS = REGISTRY.counter('pgcdfga_scram_verifier_events_total',
+                                   'SCRAM-SHA-256 password checks (answered from the memo, or '
+                                   'derived with PBKDF2) and new verifiers created', ['event'])
+
+
+def count_object(kind, action, amount=1):
+    '''
+    Counts objects (roles, grants, databases, etc.) that where created, altered or dropped.
+    '''
+    OBJECTS.inc(amount, object=kind, action=action)
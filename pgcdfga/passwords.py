@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+
+# Copyright 2019 Bol.com
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''
+Module that derives password verifiers (md5 and SCRAM-SHA-256) the way postgres stores them
+(in pg_authid), and checks configured passwords against stored verifiers.
+
+=== Authors
+Sebastiaan Mannem <smannem@bol.com>
+Jing Rao <jrao@bol.com>
+'''
+
+import os
+import re
+import hmac
+import base64
+import hashlib
+import binascii
+import threading
+import stringprep
+import unicodedata
+from concurrent.futures import ThreadPoolExecutor
+from pgcdfga.metrics import SCRAM_VERIFIERS
+
+PASSWORD_ENCRYPTIONS = ['md5', 'scram-sha-256']
+DEFAULT_PASSWORD_ENCRYPTION = 'md5'
+
+# The defaults of postgres for new SCRAM-SHA-256 verifiers
+SCRAM_ITERATIONS = 4096
+SCRAM_SALT_LENGTH = 16
+
+# New SCRAM verifiers are derived by a pool of workers when at least this many passwords change
+PARALLEL_THRESHOLD = 8
+
+# SCRAM-SHA-256$<iterations>:<salt>$<StoredKey>:<ServerKey> (base64 encoded)
+SCRAM_VERIFIER_RE = re.compile(r'SCRAM-SHA-256\$(\d+):([^$:]+)\$([^$:]+):([^$:]+)$')
+MD5_VERIFIER_RE = re.compile(r'md5[0-9a-f]{32}$')
+
+# Characters that are prohibited by SASLprep (RFC 4013)
+SASLPREP_PROHIBITED = [stringprep.in_table_c12, stringprep.in_table_c21,
+                       stringprep.in_table_c22, stringprep.in_table_c3, stringprep.in_table_c4,
+                       stringprep.in_table_c5, stringprep.in_table_c6, stringprep.in_table_c7,
+                       stringprep.in_table_c8, stringprep.in_table_c9, stringprep.in_table_a1]
+
+
+def md5_password(username, password):
+    '''
+    This function returns the md5 hash of a password the way postgres stores it.
+    Passwords that are already md5 hashed are returned as is.
+    '''
+    if len(password) == 35 and password[:3] == 'md5':
+        return password
+    md5 = hashlib.md5()
+    md5.update((password + username).encode())
+    return 'md5' + md5.hexdigest()
+
+
+def saslprep(password):
+    '''
+    This function returns a password normalized with SASLprep, like postgres does before it
+    derives a SCRAM verifier. Like postgres, a password that SASLprep rejects is used as is.
+    '''
+    if password.isascii():
+        return password
+    prepared = ''.join(' ' if stringprep.in_table_c12(char) else char for char in password
+                       if not stringprep.in_table_b1(char))
+    prepared = unicodedata.normalize('NFKC', prepared)
+    if not prepared or any(prohibited(char) for char in prepared
+                           for prohibited in SASLPREP_PROHIBITED):
+        return password
+    if any(stringprep.in_table_d1(char) for char in prepared):
+        # Right to left text can not be mixed with left to right text
+        if any(stringprep.in_table_d2(char) for char in prepared) or \
+                not stringprep.in_table_d1(prepared[0]) or \
+                not stringprep.in_table_d1(prepared[-1]):
+            return password
+    return prepared
+
+
+def scram_keys(password, salt, iterations):
+    '''
+    This function derives the StoredKey and ServerKey of a password (with PBKDF2), which is
+    what a SCRAM-SHA-256 verifier holds.
+    '''
+    salted = hashlib.pbkdf2_hmac('sha256', saslprep(password).encode(), salt, iterations)
+    client_key = hmac.new(salted, b'Client Key', hashlib.sha256).digest()
+    server_key = hmac.new(salted, b'Server Key', hashlib.sha256).digest()
+    return hashlib.sha256(client_key).digest(), server_key
+
+
+def parse_scram_verifier(verifier):
+    '''
+    This function returns the iteration count, salt, StoredKey and ServerKey of a
+    SCRAM-SHA-256 verifier, or None when verifier is not one.
+    '''
+    match = SCRAM_VERIFIER_RE.match(verifier or '')
+    if not match:
+        return None
+    try:
+        salt, stored_key, server_key = [base64.b64decode(part, validate=True)
+                                        for part in match.groups()[1:]]
+    except binascii.Error:
+        return None
+    return int(match.group(1)), salt, stored_key, server_key
+
+
+def scram_verifier(password, salt=None, iterations=SCRAM_ITERATIONS):
+    '''
+    This function returns a new SCRAM-SHA-256 verifier of a password (with a random salt).
+    '''
+    salt = salt or os.urandom(SCRAM_SALT_LENGTH)
+    stored_key, server_key = scram_keys(password, salt, iterations)
+    SCRAM_VERIFIERS.inc(event='created')
+    return 'SCRAM-SHA-256${}:{}${}:{}'.format(iterations, *[base64.b64encode(part).decode()
+                                                            for part in [salt, stored_key,
+                                                                         server_key]])
+
+
+def verifier_encryption(verifier):
+    '''
+    This function returns the encryption (see PASSWORD_ENCRYPTIONS) of a stored verifier, or
+    None if verifier is not a md5 or SCRAM-SHA-256 verifier.
+    '''
+    if MD5_VERIFIER_RE.match(verifier or ''):
+        return 'md5'
+    if parse_scram_verifier(verifier):
+        return 'scram-sha-256'
+    return None
+
+
+class VerifierMemo():
+    '''
+    This class remembers the SCRAM keys that where derived for the configured password of
+    every user, with the salt and iteration count of the stored verifier, so that checking a
+    password that did not change does not run PBKDF2 on every run.
+    Only a digest of the password is kept. The memo is shared by all threads of the process.
+    '''
+    def __init__(self):
+        '''
+        Sets some defaults on a new initted (and empty) VerifierMemo class.
+        '''
+        self.__keys = {}
+        self.__lock = threading.Lock()
+
+    def keys(self, username, password, salt, iterations):
+        '''
+        Returns the StoredKey and ServerKey of a password (see scram_keys), from the memo when
+        the password, salt and iteration count of the user did not change.
+        '''
+        memo_key = (hashlib.sha256(password.encode()).digest(), salt, iterations)
+        with self.__lock:
+            memo = self.__keys.get(username)
+        if memo and memo[0] == memo_key:
+            SCRAM_VERIFIERS.inc(event='hit')
+            return memo[1]
+        keys = scram_keys(password, salt, iterations)
+        SCRAM_VERIFIERS.inc(event='derived')
+        with self.__lock:
+            # One entry per user, so that the memo does not grow when passwords change
+            self.__keys[username] = (memo_key, keys)
+        return keys
+
+    def clear(self):
+        '''
+        Forget all derived keys.
+        '''
+        with self.__lock:
+            self.__keys.clear()
+
+
+VERIFIER_MEMO = VerifierMemo()
+
+
+def password_is_current(username, password, verifier, encryption=DEFAULT_PASSWORD_ENCRYPTION):
+    '''
+    This function checks if the stored verifier (e.a. from pg_authid) of a user is the one of
+    password, with the encryption that new verifiers are stored with. A password that is a
+    verifier itself (hashed in the config) is compared as is.
+    '''
+    if not verifier:
+        return False
+    if verifier_encryption(password):
+        return password == verifier
+    if verifier_encryption(verifier) != encryption:
+        return False
+    if encryption == 'md5':
+        return md5_password(username, password) == verifier
+    iterations, salt, stored_key, server_key = parse_scram_verifier(verifier)
+    derived = VERIFIER_MEMO.keys(username, password, salt, iterations)
+    return hmac.compare_digest(derived[0], stored_key) and \
+        hmac.compare_digest(derived[1], server_key)
+
+
+def password_verifier(username, password, encryption=DEFAULT_PASSWORD_ENCRYPTION):
+    '''
+    This function returns the verifier to store for a password. A password that is a
+    verifier already (hashed in the config) is returned as is.
+    '''
+    if verifier_encryption(password):
+        return password
+    if encryption == 'scram-sha-256':
+        return scram_verifier(password)
+    return md5_password(username, password)
+
+
+def password_verifiers(passwords, encryption=DEFAULT_PASSWORD_ENCRYPTION,
+                       threshold=PARALLEL_THRESHOLD):
+    '''
+    This function returns the verifiers to store for passwords (a dict of {username:
+    password}) as a dict of {username: verifier}. When at least threshold SCRAM verifiers are
+    derived, they are derived by a pool of workers, one per cpu (PBKDF2 of hashlib releases
+    the GIL, so the workers derive in parallel).
+    '''
+    usernames = sorted(passwords)
+    if encryption != 'scram-sha-256' or len(usernames) < threshold:
+        return {username: password_verifier(username, passwords[username], encryption)
+                for username in usernames}
+    with ThreadPoolExecutor(max_workers=os.cpu_count() or 1) as pool:
+        return dict(zip(usernames, pool.map(
+            lambda username: password_verifier(username, passwords[username], encryption),
+            usernames)))
@@ -0,0 +1,289 @@
+#!/usr/bin/env python
+
+# Copyright 2019 Bol.com
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''
+Module that holds an in-memory snapshot of the postgres catalog.
+
+The snapshot is loaded with a few bulk queries and is kept up to date by PGConnection
+while it issues DDL, so that existence and drift checks don't need a round trip each.
+
+=== Authors
+Sebastiaan Mannem <smannem@bol.com>
+Jing Rao <jrao@bol.com>
+'''
+
+import logging
+from pgcdfga.logcontext import worker_pool
+
+ROLE_ATTRIBUTES = ['rolsuper', 'rolinherit', 'rolcreaterole', 'rolcreatedb',
+                   'rolcanlogin', 'rolreplication']
+
+# Attributes of a role that was created with a plain CREATE ROLE
+NEW_ROLE_ATTRIBUTES = {'rolsuper': False, 'rolinherit': True, 'rolcreaterole': False,
+                       'rolcreatedb': False, 'rolcanlogin': False, 'rolreplication': False}
+
+ROLES_QUERY = 'SELECT rolname, ' + ', '.join(ROLE_ATTRIBUTES) + ' FROM pg_roles'
+
+MEMBERS_QUERY = 'SELECT granted.rolname granted_role, grantee.rolname grantee_role \
+                 FROM pg_auth_members auth \
+                 INNER JOIN pg_roles granted ON auth.roleid = granted.oid \
+                 INNER JOIN pg_roles grantee ON auth.member = grantee.oid'
+
+PASSWORDS_QUERY = 'SELECT usename, passwd FROM pg_shadow'
+
+DATABASES_QUERY = 'SELECT db.datname, rol.rolname owner FROM pg_database db \
+                   INNER JOIN pg_roles rol ON db.datdba = rol.oid'
+
+EXTENSIONS_QUERY = 'SELECT extname, extversion FROM pg_extension'
+
+# Light queries (row counts and sums of xmin) that change whenever a catalog table changes
+CLUSTER_FINGERPRINT_QUERY = ' UNION ALL '.join(
+    "SELECT '{0}' AS source, count(*) AS num_rows, \
+     coalesce(sum(xmin::text::bigint), 0) AS xmin_sum FROM {0}".format(table)
+    for table in ['pg_authid', 'pg_auth_members', 'pg_database']) + " UNION ALL \
+    SELECT 'pg_replication_slots', count(*), coalesce(sum(hashtext(slot_name)), 0) \
+    FROM pg_replication_slots"
+
+# pg_class is included, because new tables need to be granted to the readonly role
+DATABASE_FINGERPRINT_QUERY = "SELECT 'pg_extension' AS source, count(*) AS num_rows, \
+    coalesce(sum(xmin::text::bigint), 0) AS xmin_sum FROM pg_extension UNION ALL \
+    SELECT 'pg_class', count(*), coalesce(sum(xmin::text::bigint), 0) FROM pg_class \
+    WHERE relkind IN ('r', 'v', 'm', 'f', 'p') \
+    AND relnamespace::regnamespace::text NOT IN ('pg_catalog', 'information_schema')"
+
+
+def tuple_rows(run_sql):
+    '''
+    Returns a callable like PGConnection.iter_sql on top of a run_sql callable that returns
+    rows as dicts (with the columns in the order of the query).
+    '''
+    def iter_sql(query, parameters=None, database='postgres'):
+        '''
+        Iterate over the rows of a query as tuples.
+        '''
+        for row in run_sql(query, parameters, database=database) or []:
+            yield tuple(row.values())
+    return iter_sql
+
+
+def has_option(attributes, option_expression):
+    '''
+    Check if role attributes (a dict of ROLE_ATTRIBUTES) have an option set, where
+    option_expression is one of the values of VALID_ROLE_OPTIONS, e.a. 'not rolsuper'.
+    '''
+    negate, _, attribute = option_expression.strip().rpartition(' ')
+    if negate:
+        return not attributes[attribute]
+    return bool(attributes[attribute])
+
+
+class PGCatalog():
+    '''
+    This class holds a snapshot of roles, role attributes, role memberships, password hashes
+    and databases of a postgres cluster.
+    Extensions live in every database separately and are loaded per database on request.
+    '''
+    def __init__(self):
+        '''
+        Sets some defaults on a new initted (and empty) PGCatalog class.
+        '''
+        self.current_user = None
+        self.roles = {}
+        self.members = {}
+        self.passwords = {}
+        self.databases = {}
+        self.extensions = {}
+
+    def load(self, run_sql, iter_sql=None):
+        '''
+        Load the snapshot with a handful of bulk queries in one REPEATABLE READ transaction,
+        so that all results are consistent with each other.
+        run_sql is the callable that runs the queries, e.a. PGConnection.run_sql.
+        iter_sql is the callable that streams the rows of the bulk queries as tuples,
+        e.a. PGConnection.iter_sql (default: the rows of run_sql as tuples).
+        '''
+        if iter_sql is None:
+            iter_sql = tuple_rows(run_sql)
+        run_sql('BEGIN ISOLATION LEVEL REPEATABLE READ READ ONLY')
+        try:
+            self.current_user = run_sql('SELECT CURRENT_USER AS usename')[0]['usename']
+            self.roles = {row[0]: dict(zip(ROLE_ATTRIBUTES, row[1:]))
+                          for row in iter_sql(ROLES_QUERY)}
+            self.members = {}
+            for granted, grantee in iter_sql(MEMBERS_QUERY):
+                self.members.setdefault(granted, set()).add(grantee)
+            self.passwords = dict(iter_sql(PASSWORDS_QUERY))
+            self.databases = dict(iter_sql(DATABASES_QUERY))
+        finally:
+            run_sql('COMMIT')
+        self.extensions = {}
+        logging.debug('Loaded catalog snapshot with %d roles, %d databases',
+                      len(self.roles), len(self.databases))
+
+    def load_extensions(self, dbname, run_sql):
+        '''
+        Load the extensions of a database into the snapshot (if not loaded before) and return
+        them as a dict of {extname: extversion}.
+        A database that does not exist (yet) has no extensions.
+        '''
+        if dbname not in self.extensions:
+            if dbname in self.databases:
+                rows = run_sql(EXTENSIONS_QUERY, database=dbname)
+                self.extensions[dbname] = {row['extname']: row['extversion'] for row in rows}
+            else:
+                self.extensions[dbname] = {}
+        return self.extensions[dbname]
+
+    def role_exists(self, rolename, exclude_current_user=False):
+        '''
+        This method checks if a role exists in the snapshot.
+        '''
+        if exclude_current_user and rolename == self.current_user:
+            return False
+        return rolename in self.roles
+
+    def role_has_option(self, rolename, option_expression):
+        '''
+        This method checks if a role has an option set, where option_expression is one of
+        the values of VALID_ROLE_OPTIONS, e.a. 'rolsuper' or 'not rolsuper'.
+        '''
+        try:
+            attributes = self.roles[rolename]
+        except KeyError:
+            return False
+        return has_option(attributes, option_expression)
+
+    def is_member(self, grantee, granted):
+        '''
+        This method checks if grantee is a member of granted.
+        '''
+        return grantee in self.members.get(granted, ())
+
+    def grantees(self, granted):
+        '''
+        This method returns all members of a role.
+        '''
+        return set(self.members.get(granted, ()))
+
+    def password(self, username):
+        '''
+        This method returns a tuple of (can_login, password hash) for a user.
+        Users that cannot login are not listed in pg_shadow, so they have no password either.
+        '''
+        try:
+            return True, self.passwords[username]
+        except KeyError:
+            return False, None
+
+    def add_role(self, rolename):
+        '''
+        This method adds a newly created role to the snapshot.
+        '''
+        self.roles[rolename] = dict(NEW_ROLE_ATTRIBUTES)
+
+    def set_role_option(self, rolename, option_expression):
+        '''
+        This method sets a role option (a value of VALID_ROLE_OPTIONS) in the snapshot.
+        '''
+        negate, _, attribute = option_expression.strip().rpartition(' ')
+        attributes = self.roles.setdefault(rolename, dict(NEW_ROLE_ATTRIBUTES))
+        attributes[attribute] = not negate
+        if attribute == 'rolcanlogin':
+            if negate:
+                self.passwords.pop(rolename, None)
+            else:
+                self.passwords.setdefault(rolename, None)
+
+    def drop_role(self, rolename):
+        '''
+        This method removes a dropped role and all of its memberships from the snapshot.
+        '''
+        self.roles.pop(rolename, None)
+        self.passwords.pop(rolename, None)
+        self.members.pop(rolename, None)
+        for grantees in self.members.values():
+            grantees.discard(rolename)
+
+    def add_member(self, grantee, granted):
+        '''
+        This method adds a granted role membership to the snapshot.
+        '''
+        self.members.setdefault(granted, set()).add(grantee)
+
+    def remove_member(self, grantee, granted):
+        '''
+        This method removes a revoked role membership from the snapshot.
+        '''
+        self.members.get(granted, set()).discard(grantee)
+
+    def set_password(self, username, hashed_password):
+        '''
+        This method sets (or with None resets) the password hash of a user in the snapshot.
+        '''
+        if username in self.passwords:
+            self.passwords[username] = hashed_password
+
+    def set_database(self, dbname, ownername):
+        '''
+        This method adds a created database (or sets the owner of an existing one).
+        '''
+        self.databases[dbname] = ownername
+
+    def drop_database(self, dbname):
+        '''
+        This method removes a dropped database from the snapshot.
+        '''
+        self.databases.pop(dbname, None)
+        self.extensions.pop(dbname, None)
+
+    def set_extension(self, extname, dbname, version=None):
+        '''
+        This method adds a created extension to the snapshot of a (loaded) database.
+        '''
+        if dbname in self.extensions:
+            self.extensions[dbname][extname] = version
+
+    def drop_extension(self, extname, dbname):
+        '''
+        This method removes a dropped extension from the snapshot of a (loaded) database.
+        '''
+        self.extensions.get(dbname, {}).pop(extname, None)
+
+
+def catalog_fingerprint(run_sql, dbnames, parallelism=1):
+    '''
+    Returns a light weight fingerprint of the catalog of a cluster, and of the databases in
+    dbnames that exist, as a list of rows. The fingerprint changes when roles, memberships,
+    databases, replication slots, or extensions and tables in those databases change.
+    '''
+    rows = run_sql(CLUSTER_FINGERPRINT_QUERY)
+    existing = {row['datname'] for row in run_sql('SELECT datname FROM pg_database')}
+    dbnames = sorted(set(dbnames) & existing)
+
+    def database_fingerprint(dbname):
+        '''
+        Returns the fingerprint rows of one database.
+        '''
+        return [dict(row, database=dbname)
+                for row in run_sql(DATABASE_FINGERPRINT_QUERY, database=dbname)]
+    if parallelism < 2 or len(dbnames) < 2:
+        for dbname in dbnames:
+            rows += database_fingerprint(dbname)
+        return rows
+    with worker_pool(parallelism) as pool:
+        for dbrows in pool.map(database_fingerprint, dbnames):
+            rows += dbrows
+    return rows
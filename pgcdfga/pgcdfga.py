@@ -23,19 +23,33 @@ Sebastiaan Mannem <smannem@bol.com>
 Jing Rao <jrao@bol.com>
 '''
 
-from copy import copy
+from copy import copy, deepcopy
 from argparse import ArgumentParser
 import logging
 import sys
+import signal
 import os
-import datetime
-import re
-import time
 import getpass
+import time
+import asyncio
+import contextvars
+from functools import partial
+from concurrent import futures
 import yaml
-from pgcdfga.ldapconnection import LDAPConnection, LDAP_DEFAULTS
-from pgcdfga.pgconnection import PGConnection, DB_DEFAULTS, EXTENSION_DEFAULTS, \
-    ROLE_DEFAULTS, USER_DEFAULTS, STRICT_DEFAULTS
+from pgcdfga.ldapconnection import LDAPConnection, LDAP_DEFAULTS, MembershipCache
+from pgcdfga.pgconnection import PGConnection, STRICT_DEFAULTS, DEFAULT_ITERSIZE
+from pgcdfga.pgpool import DEFAULT_MAX_CONNECTIONS
+from pgcdfga.passwords import DEFAULT_PASSWORD_ENCRYPTION
+from pgcdfga.pgcatalog import catalog_fingerprint
+from pgcdfga.fingerprint import ChangeDetector, DEFAULT_FULL_RUN_EVERY, digest
+from pgcdfga.configloader import ConfigLoader, YAML_LOADER
+from pgcdfga.configmodel import UserConfig, compile_config
+from pgcdfga.planner import DesiredState, plan, apply, describe
+from pgcdfga.metrics import REGISTRY, METRICS_DEFAULTS, RUNS, RUN_ERRORS, LAST_RUN, SKIP_RATE, \
+    LDAP_CACHE, CLUSTER_RUN_SECONDS, CLUSTER_ERRORS
+from pgcdfga.profiler import PROFILER, timed_phase
+from pgcdfga.pgevents import DDLListener, wait_for_ddl, EVENT_TRIGGER_LANGUAGE
+from pgcdfga import aioengine, logcontext
 
 
 def dict_with_defaults(data=None, default=None):
@@ -55,8 +69,6 @@ def dict_with_defaults(data=None, default=None):
     return ret
 
 
-AUTH_ENUM = ['ldapgroup', 'ldapuser', 'password', 'md5', 'clientcert']
-
 LOG_LEVEL_ENUM = {'CRITICAL': logging.CRITICAL,
                   'ERROR': logging.ERROR,
                   'WARNING': logging.WARNING,
@@ -65,186 +77,157 @@ LOG_LEVEL_ENUM = {'CRITICAL': logging.CRITICAL,
                   'NOTSET': logging.NOTSET}
 
 
-# This re finds characters that are not a alphabetical letter / digit
-NON_WORD_CHAR_RE = re.compile('[^0-9a-zA-Z]')
+# batch_size: Number of DDL statements that are sent in one round trip (1 disables batching)
+# parallelism: Number of databases that are processed concurrently
+# event_triggers: Install event triggers in managed databases (requires superuser), and in
+#                 daemon mode run right after DDL in those, instead of after rundelay (0/1)
+# cluster_parallelism: Number of clusters (see cluster_configs) that are run concurrently
+# cluster_timeout: Seconds to wait for the run of a cluster, before continuing without it
+#                  (0 waits for all clusters). A cluster that is still running is skipped.
+GENERAL_DEFAULTS = {'batch_size': 100, 'parallelism': 4,
+                    'full_run_every': DEFAULT_FULL_RUN_EVERY, 'event_triggers': 0,
+                    'cluster_parallelism': 4, 'cluster_timeout': 0}
 
+# Chapters of the config that can be overridden per cluster. Process wide options of the
+# general chapter (cluster_parallelism, cluster_timeout and rundelay) are only read from the
+# top level general chapter.
+CLUSTER_OVERRIDES = ['strict', 'general']
 
-def process_user(pgconn: PGConnection, username: str, userconfig: dict,
-                 ldapconnection: LDAPConnection):
+
+def general_option(configdata, option):
     '''
-    This function is a subfunction of process_users, that is used to process config for a user.
+    This function returns a numeric option from the general chapter of the config.
     '''
-    # merge USER_DEFAULTS into this userconfig
-    userconfig = dict_with_defaults(userconfig, USER_DEFAULTS)
-    # set ensure
-    ensure = userconfig['ensure'].lower()
+    try:
+        return int(configdata['general'][option])
+    except (KeyError, TypeError):
+        return GENERAL_DEFAULTS[option]
 
-    # set expiry
-    expiry = userconfig['expiry']
-    if expiry:
-        # enhance expiry. Basically, you can set only a small portion
-        # (like only year, or only year-month) and the rest will be appended.
-        expiry = str(expiry)
-        expiry = expiry + '2000-12-31 23:59:59'[len(expiry):]
-        expiry = datetime.datetime.strptime(expiry, '%Y-%m-%d %H:%M:%S')
-        # If expiry date has passed, remove account / group
-        if datetime.datetime.now() > expiry:
-            ensure = 'absent'
-            logging.info("User %s is expired", username)
+
+def compile_user(desired: DesiredState, user: UserConfig, ldapconnection: LDAPConnection):
+    '''
+    This function is a subfunction of compile_users, that is used to compile config for a user
+    into the desired state.
+    '''
+    ensure = user.ensure
+    # If expiry date has passed, remove account / group
+    if user.expired():
+        ensure = 'absent'
+        logging.info("User %s is expired", user.name)
 
     # Remove if ensure=absent
     if ensure == 'absent':
-        pgconn.droprole(username)
-        logging.debug("Dropping user %s", username)
+        logging.debug("Dropping user %s", user.name)
+        desired.absent_roles.add(user.name)
         return
 
-    auth = userconfig['auth'].lower()
-    try:
-        ldapbasedn = userconfig['ldapbasedn']
-    except KeyError:
-        ldapbasedn = None
-    auth = NON_WORD_CHAR_RE.sub('', auth)
-    if auth not in AUTH_ENUM:
-        auth = 'client_cert'
-    logging.debug("auth = %s", auth)
-
-    logging.debug("Creating user/role %s", username)
-    if auth == 'ldapgroup':
+    logging.debug("auth = %s", user.auth)
+    logging.debug("Creating user/role %s", user.name)
+    if user.auth == 'ldapgroup':
         # create ldap group with ldap users
         # For ldap group, we don't specify options on group, but rather on direct users.
-        pgconn.createrole(username)
-        try:
-            ldapfilter = userconfig['ldapfilter']
-        except KeyError:
-            ldapfilter = username
-        members = ldapconnection.ldap_grp_mmbrs(ldapbasedn=ldapbasedn,
-                                                ldapfilter=ldapfilter)
+        desired.add_role(user.name)
+        members = ldapconnection.ldap_grp_mmbrs(ldapbasedn=user.ldapbasedn,
+                                                ldapfilter=user.ldapfilter)
         for member in members:
-            logging.info("Creating member %s from LDAP group %s", member, username)
+            logging.debug("Creating member %s from LDAP group %s", member, user.name)
             # For ldap group, we don't specify options on group, but rather on direct users.
-            pgconn.createrole(member, ['LOGIN'] + userconfig['options'])
-            pgconn.grantrole(member, username)
+            desired.add_role(member, ('LOGIN', ) + user.options)
+            desired.add_grant(member, user.name)
             logging.debug("Resetting password for member %s", member)
-            pgconn.resetpassword(member)
+            desired.password_resets.add(member)
     else:
-        pgconn.createrole(username, ['LOGIN'] + userconfig['options'])
+        desired.add_role(user.name, ('LOGIN', ) + user.options)
 
-    if auth in ['ldapuser', 'clientcert', 'ldapgroup']:
-        logging.debug("Resetting password for user %s", username)
-        pgconn.resetpassword(username)
+    if user.auth in ['ldapuser', 'clientcert', 'ldapgroup']:
+        logging.debug("Resetting password for user %s", user.name)
+        desired.password_resets.add(user.name)
     else:
-        if userconfig['password']:
-            pgconn.setpassword(username, userconfig['password'])
+        if user.password:
+            desired.passwords[user.name] = user.password
 
-    for role in userconfig['memberof']:
-        logging.debug("Granting %s to %s", role, username)
-        pgconn.grantrole(username, role)
+    for role in user.memberof:
+        logging.debug("Granting %s to %s", role, user.name)
+        desired.add_grant(user.name, role)
 
 
-def process_users(pgconn: PGConnection, users: dict, ldapconnection: LDAPConnection):
+def ldapgroup_queries(users: list):
     '''
-    This function is a subfunction of main, that is used to process all user config.
+    This function returns the ldap queries of all ldap groups that will be created.
     '''
-    errorcount = 0
-    for username, userconfig in users.items():
-        logging.debug("Processing user %s", username)
-        logging.debug("User config: %s", userconfig)
-        try:
-            process_user(pgconn, username, userconfig, ldapconnection)
-        except Exception as error:
-            pgconn.strict_params['users'] = False
-            logging.exception(str(error))
-            errorcount += 1
-    return errorcount
+    return [user.ldap_query() for user in users
+            if user.auth == 'ldapgroup' and user.ensure != 'absent' and not user.expired()]
 
 
-def process_databases(pgconn: PGConnection, databases: dict):
+def resolve_ldap_groups(ldapconnection: LDAPConnection, users: list):
     '''
-    This function is a subfunction of main, that is used to process all database config.
+    This function resolves the members of all ldap groups of users in bulk (see
+    LDAPConnection.resolve_groups). When that fails, compile_user falls back to a search
+    per group.
     '''
-    errorcount = 0
-    for dbname, dbconfig in databases.items():
-        logging.debug("Processing database %s", dbname)
-        try:
-            # merge USER_DEFAULTS into this databaseconfig
-            dbconfig = dict_with_defaults(dbconfig, DB_DEFAULTS)
-            if dbconfig['ensure'] == 'absent':
-                logging.debug("Dropping database %s", dbname)
-                pgconn.dropdb(dbname)
-            else:
-                logging.debug("Creating database %s", dbname)
-                pgconn.createdb(dbname, dbconfig['owner'])
-        except Exception as error:
-            pgconn.strict_params['databases'] = False
-            logging.exception(str(error))
-            errorcount += 1
-        for extname, extconfig in dbconfig['extensions'].items():
-            try:
-                # merge USER_DEFAULTS into this databaseconfig
-                extconfig = dict_with_defaults(extconfig, EXTENSION_DEFAULTS)
-                if extconfig['ensure'] == 'absent':
-                    logging.debug("Dropping extension %s from database %s", extname, dbname)
-                    pgconn.dropextension(extname, dbname)
-                else:
-                    logging.debug("Creating extension %s in database %s", extname, dbname)
-                    schema = extconfig['schema']
-                    version = extconfig['version']
-                    pgconn.createextension(extname, dbname, schema, version)
-            except Exception as error:
-                pgconn.strict_params['extensions'] = False
-                logging.exception(str(error))
-                errorcount += 1
-    return errorcount
+    try:
+        ldapconnection.resolve_groups(ldapgroup_queries(users))
+    except Exception as error:
+        logging.warning('Could not resolve ldap groups in bulk: %s', error)
 
 
-def process_replication_slots(pgconn: PGConnection, replication_slots: list):
+def compile_users(pgconn: PGConnection, desired: DesiredState, users: list,
+                  ldapconnection: LDAPConnection):
     '''
-    This function is a subfunction of main, that is used to process all replication slot config.
+    This function is a subfunction of plan_fga, that is used to compile all user config.
     '''
     errorcount = 0
-    for replication_slot in replication_slots:
-        logging.debug("Processing replication slot %s", replication_slot)
+    resolve_ldap_groups(ldapconnection, users)
+    for user in users:
+        logging.debug("Processing user %s", user.name)
         try:
-            logging.debug("Creating role %s", replication_slot)
-            pgconn.create_replication_slot(replication_slot)
-        except Exception as error:
-            logging.exception(str(error))
-            errorcount += 1
-    for replication_slot in list(set(pgconn.replication_slots()) - set(replication_slots)):
-        try:
-            logging.debug("Cluster contains replication slot that isn't in the config %s",
-                          replication_slot)
-            pgconn.drop_replication_slot(replication_slot)
+            compile_user(desired, user, ldapconnection)
         except Exception as error:
+            pgconn.strict_params['users'] = False
             logging.exception(str(error))
             errorcount += 1
     return errorcount
 
 
-def process_roles(pgconn: PGConnection, roles: dict):
+def compile_databases(desired: DesiredState, databases: list):
     '''
-    This function is a subfunction of main, that is used to process all role config.
+    This function is a subfunction of plan_fga, that is used to compile all database config.
     '''
-    errorcount = 0
-    for rolename, roleconfig in roles.items():
-        logging.debug("Processing role %s", rolename)
-        try:
-            # merge USER_DEFAULTS into this databaseconfig
-            roleconfig = dict_with_defaults(roleconfig, ROLE_DEFAULTS)
-            if roleconfig['ensure'] == 'absent':
-                logging.debug("Dropping role %s", rolename)
-                pgconn.droprole(rolename)
+    for database in databases:
+        logging.debug("Processing database %s", database.name)
+        if database.ensure == 'absent':
+            logging.debug("Dropping database %s", database.name)
+            desired.absent_databases.add(database.name)
+            continue
+        logging.debug("Creating database %s", database.name)
+        desired.add_database(database.name, database.owner, database.default_privileges)
+        for extension in database.extensions:
+            if extension.ensure == 'absent':
+                logging.debug("Dropping extension %s from database %s", extension.name,
+                              database.name)
+                desired.absent_extensions.setdefault(database.name, set()).add(extension.name)
             else:
-                logging.debug("Creating role %s", rolename)
-                pgconn.createrole(rolename, roleconfig['options'])
-                for parent in roleconfig['memberof']:
-                    logging.debug("Granting role %s to %s", parent, rolename)
-                    pgconn.grantrole(rolename, parent)
-        except Exception as error:
-            pgconn.strict_params['users'] = False
-            logging.exception(str(error))
-            errorcount += 1
-    return errorcount
+                logging.debug("Creating extension %s in database %s", extension.name,
+                              database.name)
+                desired.extensions[database.name][extension.name] = (extension.schema,
+                                                                     extension.version)
+
+
+def compile_roles(desired: DesiredState, roles: list):
+    '''
+    This function is a subfunction of plan_fga, that is used to compile all role config.
+    '''
+    for role in roles:
+        logging.debug("Processing role %s", role.name)
+        if role.ensure == 'absent':
+            logging.debug("Dropping role %s", role.name)
+            desired.absent_roles.add(role.name)
+        else:
+            logging.debug("Creating role %s", role.name)
+            desired.add_role(role.name, role.options)
+            for parent in role.memberof:
+                logging.debug("Granting role %s to %s", parent, role.name)
+                desired.add_grant(role.name, parent)
 
 
 def arguments():
@@ -263,18 +246,33 @@ def arguments():
                         help='Be more verbose')
     parser.add_argument("-d", "--rundelay", type=int, default=0,
                         help='Be more verbose')
+    parser.add_argument("--plan", action='store_true',
+                        help='Print the planned operations and exit without applying them')
+    parser.add_argument("--profile", default=None, metavar='DIRECTORY',
+                        help='Profile the phases of runs, and write pstats files and collapsed \
+                        stacks (for flamegraphs) to this directory')
+    parser.add_argument("--profile-every", type=int, default=1, metavar='N',
+                        help='Only profile every Nth run (in daemon mode)')
+    parser.add_argument("--engine", choices=['threads', 'asyncio'], default='threads',
+                        help='Run clusters in worker threads (default), or on one asyncio \
+                        event loop that waits for the round trips to all databases and ldap \
+                        at the same time (--plan and --profile always use threads)')
     args = parser.parse_args()
 
     return args
 
 
-def config(args):
+def config(args, loader=None):
     '''
     This function reads and returns config data
+    With a ConfigLoader, the config file is only parsed again when it has changed.
     '''
     # Configuration file look up.
-    with open(args.configfile) as configfile:
-        configdata = yaml.load(configfile)
+    if loader:
+        configdata = loader.load()
+    else:
+        with open(args.configfile) as configfile:
+            configdata = yaml.load(configfile, Loader=YAML_LOADER)
 
     if 'ldap' not in configdata:
         configdata['ldap'] = {}
@@ -332,87 +330,688 @@ def config_ldap(configdata):
     return ldapconfig
 
 
-def proces_fga(configdata, pgconn, ldapconn):
+def config_errors(pgconn, model):
     '''
-    This function is a helper function for main.
+    This function logs the schema errors in the config, disables strict mode for the
+    chapters with errors and returns the number of errors.
+    '''
+    for chapter, error in model.errors:
+        logging.error("Invalid config: %s", error)
+        if chapter:
+            pgconn.strict_params[chapter] = False
+    return len(model.errors)
+
+
+def plan_fga(configdata, pgconn, ldapconn, model=None):
+    '''
+    This function compiles the desired state from config and ldap, compares it with the
+    catalog snapshot and returns the planned operations and the number of errors.
     '''
     errorcount = 0
-    if 'users' in configdata:
-        logging.debug("Processing users %s", configdata['users'])
-        errorcount += process_users(pgconn, configdata['users'], ldapconn)
-    else:
-        logging.debug("No user config set in configdata")
-    if 'databases' in configdata:
-        logging.debug("Processing databases %s", configdata['databases'])
-        errorcount += process_databases(pgconn, configdata['databases'])
-    else:
-        logging.debug("No database config set in configdata")
-    if 'replication_slots' in configdata:
-        logging.debug("Processing replication slots %s", configdata['replication_slots'])
-        errorcount += process_replication_slots(pgconn, configdata['replication_slots'])
-    if 'roles' in configdata:
-        logging.debug("Processing roles %s", configdata['roles'])
-        errorcount += process_roles(pgconn, configdata['roles'])
-    else:
-        logging.debug("No database config set in configdata")
-
-    if pgconn.strict_params['users']:
-        logging.debug("Strictifying roles")
-        pgconn.strictifyroles()
-    if pgconn.strict_params['databases']:
-        logging.debug("Strictifying databases")
-        pgconn.strictifydatabases()
-    if pgconn.strict_params['extensions']:
-        logging.debug("Strictifying extensions")
-        pgconn.strictifyextensions()
+    if model is None:
+        model = compile_config(configdata)
+    errorcount += config_errors(pgconn, model)
+    logging.debug("Loading catalog snapshot")
+    with timed_phase('catalog'):
+        pgconn.load_catalog()
+    desired, compile_errors = compile_desired(pgconn, ldapconn, model,
+                                              general_option(configdata, 'event_triggers'))
+    errorcount += compile_errors
+
+    with timed_phase('plan'):
+        operations = plan(desired, pgconn, general_option(configdata, 'parallelism'))
+    logging.info("Planned %d operations", len(operations))
+    return operations, errorcount
+
+
+def compile_desired(pgconn, ldapconn, model, event_triggers=False):
+    '''
+    This function compiles the desired state from the config model and ldap, and returns the
+    DesiredState and the number of errors.
+    With event_triggers, the language of the event trigger function (see pgevents) is a
+    managed extension of every database (unless it is configured to be absent), so that
+    strict extensions do not drop it.
+    '''
+    errorcount = 0
+    desired = DesiredState()
+    with timed_phase('compile'):
+        logging.debug("Processing users %s", [user.name for user in model.users])
+        errorcount += compile_users(pgconn, desired, model.users, ldapconn)
+        logging.debug("Processing databases %s",
+                      [database.name for database in model.databases])
+        compile_databases(desired, model.databases)
+        if event_triggers:
+            for dbname in desired.databases:
+                if EVENT_TRIGGER_LANGUAGE not in desired.absent_extensions.get(dbname, ()):
+                    desired.extensions[dbname].setdefault(EVENT_TRIGGER_LANGUAGE, (None, None))
+        if model.replication_slots is not None:
+            logging.debug("Processing replication slots %s", model.replication_slots)
+            desired.replication_slots = model.replication_slots
+        logging.debug("Processing roles %s", [role.name for role in model.roles])
+        compile_roles(desired, model.roles)
+    return desired, errorcount
+
+
+def run_fingerprint(configdata, model, pgconn, ldapconn, catalog=None):
+    '''
+    This function returns a fingerprint of everything a run depends on: the config, the users
+    that have expired, the members of ldap groups and a light weight catalog fingerprint
+    (which is read here, unless it is passed as catalog).
+    '''
+    with timed_phase('fingerprint'):
+        expired = [user.name for user in model.users if user.expired()]
+        queries = ldapgroup_queries(model.users)
+        ldapconn.resolve_groups(queries)
+        members = [[query, ldapconn.ldap_grp_mmbrs(*query)] for query in queries]
+        if catalog is None:
+            catalog = catalog_fingerprint(pgconn.run_prepared,
+                                          [database.name for database in model.databases],
+                                          general_option(configdata, 'parallelism'))
+        return digest(configdata, expired, members, catalog)
+
+
+def proces_fga(configdata, pgconn, ldapconn, detector=None, model=None):
+    '''
+    This function is a helper function for main.
+    With a ChangeDetector, runs where nothing changed since the last successful run are skipped.
+    model is the ConfigModel of configdata (it is compiled here when it is not given).
+    '''
+    if model is None:
+        model = compile_config(configdata)
+    fingerprint = None
+    if detector:
+        try:
+            fingerprint = run_fingerprint(configdata, model, pgconn, ldapconn)
+        except Exception as error:
+            logging.warning('Could not fingerprint this run (running in full): %s', error)
+        if fingerprint and detector.unchanged(fingerprint):
+            logging.info("Nothing changed since the last run, skipping (skip rate %.0f%%)",
+                         100 * detector.skip_rate())
+            RUNS.inc(result='skipped')
+            return 0
+    RUNS.inc(result='applied')
+    operations, errorcount = plan_fga(configdata, pgconn, ldapconn, model)
+    errorcount += apply(pgconn, operations,
+                        batch_size=general_option(configdata, 'batch_size'),
+                        parallelism=general_option(configdata, 'parallelism'))
+    if detector:
+        try:
+            if errorcount or not fingerprint:
+                detector.failed()
+            else:
+                if operations:
+                    # Applying the operations changed the catalog (and thus its fingerprint)
+                    fingerprint = run_fingerprint(configdata, model, pgconn, ldapconn)
+                detector.succeeded(fingerprint)
+        except Exception as error:
+            logging.warning('Could not fingerprint this run: %s', error)
+            detector.failed()
+        logging.info("Skipped %d of %d runs (skip rate %.0f%%)", detector.stats['skipped'],
+                     detector.stats['runs'], 100 * detector.skip_rate())
     return errorcount
 
 
-def main():
+async def proces_fga_async(configdata, pgconn, apgconn, ldapconn, call, detector=None,
+                           ldap_resolved=None, model=None):
     '''
-    This function runs the main part of the script.
+    This function is the asyncio counterpart of proces_fga. The catalog snapshot and the
+    fingerprint are read while the ldap groups are resolved, and the databases are read
+    concurrently, on the connections of apgconn (an aioengine.AsyncPGConnection).
+    call is a coroutine function that runs a blocking function (with args) in a worker thread.
+    ldap_resolved is the future that resolves the ldap groups (shared by all clusters of a
+    run), which is started here when it is not given. Like ldap_resolved, the ConfigModel of
+    configdata (model) is compiled here when it is not given.
     '''
-    parsed_args = arguments()
+    if model is None:
+        model = compile_config(configdata)
+    dbnames = [database.name for database in model.databases]
+    parallelism = general_option(configdata, 'parallelism')
+    if ldap_resolved is None:
+        ldap_resolved = asyncio.ensure_future(call(resolve_ldap_groups, ldapconn, model.users))
+
+    async def run_fingerprint_async():
+        '''
+        Returns the fingerprint of this run (see run_fingerprint), reading the catalog of all
+        databases concurrently, or None when the run can not be fingerprinted.
+        '''
+        try:
+            catalog = await aioengine.catalog_fingerprint(apgconn, dbnames)
+            await asyncio.shield(ldap_resolved)
+            return await call(run_fingerprint, configdata, model, None, ldapconn, catalog)
+        except Exception as error:
+            logging.warning('Could not fingerprint this run: %s', error)
+            return None
+
+    fingerprint = None
+    if detector:
+        fingerprint = await run_fingerprint_async()
+        if fingerprint and detector.unchanged(fingerprint):
+            logging.info("Nothing changed since the last run, skipping (skip rate %.0f%%)",
+                         100 * detector.skip_rate())
+            RUNS.inc(result='skipped')
+            return 0
+    RUNS.inc(result='applied')
+    errorcount = config_errors(pgconn, model)
+    await call(pgconn.load_catalog)
+    await aioengine.load_extensions(pgconn.catalog, apgconn, dbnames)
+    await asyncio.shield(ldap_resolved)
+    desired, compile_errors = await call(compile_desired, pgconn, ldapconn, model,
+                                         general_option(configdata, 'event_triggers'))
+    errorcount += compile_errors
+    operations = await call(plan, desired, pgconn, parallelism)
+    logging.info("Planned %d operations", len(operations))
+    errorcount += await aioengine.apply(pgconn, operations, call,
+                                        batch_size=general_option(configdata, 'batch_size'),
+                                        parallelism=parallelism)
+    if detector:
+        if not errorcount and fingerprint and operations:
+            # Applying the operations changed the catalog (and thus its fingerprint)
+            fingerprint = await run_fingerprint_async()
+        if errorcount or not fingerprint:
+            detector.failed()
+        else:
+            detector.succeeded(fingerprint)
+        logging.info("Skipped %d of %d runs (skip rate %.0f%%)", detector.stats['skipped'],
+                     detector.stats['runs'], 100 * detector.skip_rate())
+    return errorcount
+
+
+def config_metrics(configdata):
+    '''
+    This function returns the config for exposing metrics (with defaults).
+    '''
+    try:
+        return dict_with_defaults(configdata['metrics'], METRICS_DEFAULTS)
+    except (KeyError, TypeError):
+        return copy(METRICS_DEFAULTS)
+
+
+def export_metrics(metricsconfig, errorcount, detectors, ldapcache):
+    '''
+    This function updates the metrics of a run (with the ChangeDetectors of all clusters),
+    and writes all metrics to a file for the textfile collector (when metrics/textfile is set).
+    '''
+    RUN_ERRORS.inc(errorcount)
+    LAST_RUN.set(time.time())
+    runs = sum(detector.stats['runs'] for detector in detectors)
+    skipped = sum(detector.stats['skipped'] for detector in detectors)
+    SKIP_RATE.set(skipped / runs if runs else 0.0)
+    for event, value in ldapcache.stats.items():
+        LDAP_CACHE.set(value, event=event)
+    if metricsconfig['textfile']:
+        textfile = os.path.realpath(os.path.expanduser(metricsconfig['textfile']))
+        try:
+            REGISTRY.write_textfile(textfile)
+        except OSError as error:
+            logging.error('Could not write metrics to %s: %s', textfile, error)
+
+
+def watch_ddl(listener, configdata, pgconn, model=None):
+    '''
+    This function starts (or stops) listening to DDL in the managed databases, according to
+    general/event_triggers, and returns the DDLListener (or None when disabled).
+    '''
+    if not general_option(configdata, 'event_triggers'):
+        if listener:
+            listener.close()
+        return None
+    if listener is None:
+        listener = DDLListener(pgconn.new_connection)
+    if model is None:
+        model = compile_config(configdata)
+    listener.watch(pgconn, [database.name for database in model.databases
+                            if database.ensure != 'absent'])
+    return listener
+
+
+def cluster_name(dsn, index):
+    '''
+    This function returns the name of a cluster without a name (from the host and port of the
+    dsn, or its position in the list of clusters).
+    '''
+    if not isinstance(dsn, dict) or 'host' not in dsn:
+        return 'cluster{}'.format(index)
+    if 'port' in dsn:
+        return '{}:{}'.format(dsn['host'], dsn['port'])
+    return str(dsn['host'])
 
-    while True:
+
+def cluster_configs(configdata):
+    '''
+    This function returns the config of every cluster as a list of (name, configdata).
+    The postgresql chapter holds one cluster, a list of clusters, or a dict of clusters keyed
+    by name. Every cluster has a dsn, and can have a name and strict and general chapters,
+    which override the top level ones. The other chapters are shared by all clusters.
+    '''
+    clusters = configdata.get('postgresql') or {}
+    if isinstance(clusters, dict):
+        if 'dsn' in clusters or not all(isinstance(pgconfig, dict)
+                                        for pgconfig in clusters.values()):
+            clusters = [clusters]
+        else:
+            clusters = [dict(pgconfig, name=name) for name, pgconfig in clusters.items()]
+    configs = []
+    for index, pgconfig in enumerate(clusters):
+        pgconfig = dict(pgconfig)
+        name = str(pgconfig.pop('name', None) or cluster_name(pgconfig.get('dsn'), index))
+        if name in [existing for existing, _ in configs]:
+            raise ValueError('Cluster {} is in the postgresql config more than once'.format(name))
+        # The chapters are read only, so clusters share them (like users) without copies
+        clusterdata = dict(configdata, postgresql=pgconfig)
+        for chapter in CLUSTER_OVERRIDES:
+            overrides = pgconfig.pop(chapter, None)
+            if overrides:
+                clusterdata[chapter] = dict(configdata.get(chapter) or {}, **overrides)
+        configs.append((name, clusterdata))
+    return configs
+
+
+class Cluster():
+    '''
+    This class keeps the state of a managed cluster over runs: its connections (and the
+    statements prepared on them), its ChangeDetector, its DDLListener and its current run.
+    run is called from worker threads, run_async from the event loop of the asyncio engine,
+    and the other methods only from the main thread.
+    '''
+    def __init__(self, name):
+        '''
+        Sets some defaults on a new initted Cluster class.
+        '''
+        self.name = name
+        self.pgconn = None
+        self.detector = ChangeDetector()
+        self.listener = None
+        self.apgconn = None
+        self.future = None
+        self.__jobs = set()
+        self.__pgconfig = None
+        self.__listener_pgconn = None
+
+    def run(self, configdata, ldapconn, plan_only=False, prefix='', model=None):
+        '''
+        Applies the config to the cluster (or prints the planned operations, prefixed with
+        prefix, with plan_only), and returns the number of errors. model is the ConfigModel of
+        the config (see ConfigLoader.model).
+        '''
+        start = time.monotonic()
         errorcount = 0
         try:
-            configdata = config(parsed_args)
-            ldapconfig = config_ldap(configdata)
-            try:
-                strict = dict_with_defaults(configdata['strict'], STRICT_DEFAULTS)
-            except KeyError:
-                strict = copy(STRICT_DEFAULTS)
+            pgconn = self.__start(configdata)
+            if plan_only:
+                operations, errorcount = plan_fga(configdata, pgconn, ldapconn, model)
+                for operation in operations:
+                    print(prefix + describe(operation))
+            else:
+                self.detector.full_run_every = general_option(configdata, 'full_run_every')
+                errorcount += proces_fga(configdata, pgconn, ldapconn, self.detector, model)
+                logging.info("Finished applying config to cluster %s", self.name)
+        except Exception:
+            errorcount += self.__failed()
+        self.__finish(start, errorcount)
+        return errorcount
+
+    async def run_async(self, configdata, ldapconn, executor, ldap_resolved=None, model=None):
+        '''
+        Applies the config to the cluster with the asyncio engine (see proces_fga_async),
+        running blocking calls in executor, and returns the number of errors.
+        '''
+        start = time.monotonic()
+        errorcount = 0
+        try:
+            pgconn = await self.call(executor, self.__start, configdata)
+            if self.apgconn is None:
+                self.apgconn = aioengine.AsyncPGConnection(partial(pgconn.new_connection,
+                                                                   async_=True))
+            self.apgconn.max_connections = self.__pgconfig.get('max_connections',
+                                                               DEFAULT_MAX_CONNECTIONS)
+            self.apgconn.max_queries = general_option(configdata, 'parallelism')
+            self.detector.full_run_every = general_option(configdata, 'full_run_every')
+            errorcount += await proces_fga_async(configdata, pgconn, self.apgconn, ldapconn,
+                                                 partial(self.call, executor), self.detector,
+                                                 ldap_resolved, model)
+            logging.info("Finished applying config to cluster %s", self.name)
+        except Exception:
+            errorcount += self.__failed()
+        self.__finish(start, errorcount)
+        return errorcount
+
+    async def call(self, executor, function, *args):
+        '''
+        Runs a blocking function (with args) in executor, for run_async, and returns its
+        result. Until all calls have returned, the cluster is busy, also when run_async is
+        cancelled (e.a. after general/cluster_timeout) while waiting for one.
+        '''
+        # The worker prefixes its log lines with the cluster of the task (see logcontext)
+        job = executor.submit(contextvars.copy_context().run, function, *args)
+        self.__jobs.add(job)
+        job.add_done_callback(self.__jobs.discard)
+        return await asyncio.wrap_future(job)
+
+    def __start(self, configdata):
+        '''
+        Returns the PGConnection for a run, with the strict options of the config set.
+        '''
+        try:
+            strict = dict_with_defaults(configdata['strict'], STRICT_DEFAULTS)
+        except KeyError:
+            strict = copy(STRICT_DEFAULTS)
+        pgconn = self.__connection(configdata['postgresql'])
+        pgconn.strict_params = strict
+        if pgconn.is_standby():
+            raise Exception('Postgres ({}) cluster is standby'.format(pgconn.dsn()))
+        return pgconn
+
+    def __failed(self):
+        '''
+        Logs the exception that failed a run, and returns the number of errors it adds.
+        '''
+        logging.exception('Error occurred while processing cluster %s:', self.name)
+        RUNS.inc(result='failed')
+        # Start over with new connections, in case the error broke one
+        self.__disconnect()
+        return 1
+
+    def __finish(self, start, errorcount):
+        '''
+        Logs and exports the duration and number of errors of a run.
+        '''
+        duration = time.monotonic() - start
+        CLUSTER_RUN_SECONDS.observe(duration, cluster=self.name)
+        CLUSTER_ERRORS.inc(errorcount, cluster=self.name)
+        if self.pgconn:
+            logging.debug('Connection pool statistics: %s', self.pgconn.pool_stats())
+            logging.debug('Prepared statement statistics: %s', self.pgconn.prepared_stats())
+            self.pgconn.export_metrics()
+        logging.info("Cluster %s: %d errors in %.3f seconds", self.name, errorcount, duration)
+
+    def __disconnect(self):
+        '''
+        Closes the connections of the cluster (except the ones of the DDLListener).
+        '''
+        if self.apgconn:
+            self.apgconn.close()
+            self.apgconn = None
+        if self.pgconn:
+            self.pgconn.close()
+            self.pgconn = None
+
+    def __connection(self, pgconfig):
+        '''
+        Returns the PGConnection of this cluster. Connections are kept over runs while the
+        postgresql config of the cluster stays the same.
+        '''
+        if self.pgconn and pgconfig != self.__pgconfig:
+            logging.info('Postgres config of cluster %s changed, reconnecting', self.name)
+            self.__disconnect()
+        if not self.pgconn:
+            self.__pgconfig = deepcopy(pgconfig)
+            self.pgconn = PGConnection(dsn_params=copy(pgconfig['dsn']),
+                                       max_connections=pgconfig.get('max_connections',
+                                                                    DEFAULT_MAX_CONNECTIONS),
+                                       itersize=pgconfig.get('itersize', DEFAULT_ITERSIZE),
+                                       password_encryption=pgconfig.get(
+                                           'password_encryption', DEFAULT_PASSWORD_ENCRYPTION))
+        return self.pgconn
+
+    def busy(self):
+        '''
+        Returns True if the cluster is still running (in a worker thread).
+        '''
+        return bool(self.__jobs) or (self.future is not None and not self.future.done())
+
+    def watch_ddl(self, configdata, model=None):
+        '''
+        Starts (or stops) listening to DDL in the managed databases of the cluster (see
+        watch_ddl), and returns the DDLListener (or None).
+        '''
+        if self.listener and self.__listener_pgconn is not self.pgconn:
+            # The connections where replaced (after an error or a config change)
+            self.listener.close()
+            self.listener = None
+        if self.pgconn:
+            self.listener = watch_ddl(self.listener, configdata, self.pgconn, model)
+            self.__listener_pgconn = self.pgconn
+        return self.listener
+
+    def close(self):
+        '''
+        Stops listening to DDL, and closes all connections of the cluster.
+        '''
+        if self.listener:
+            self.listener.close()
+            self.listener = None
+        self.__disconnect()
+
+
+def run_clusters(clusters, configdata, targets, ldapconn, plan_only=False, concurrent=True,
+                 model=None):
+    '''
+    This function runs every cluster in targets (a list of (name, configdata), see
+    cluster_configs), and returns the number of errors. The Cluster objects in clusters are
+    kept over runs. With concurrent and more than one cluster, clusters are run by a pool of
+    (general/cluster_parallelism) workers. Ldap groups are resolved once, for all clusters.
+    A cluster that does not finish within general/cluster_timeout seconds counts as an error
+    and keeps running in the background. It is skipped until it finished.
+    These process wide options are read from configdata (the top level config), not from the
+    general overrides of a cluster. model is the ConfigModel of configdata, which all clusters
+    share (it is compiled here when it is not given).
+    '''
+    if model is None:
+        model = compile_config(configdata)
+    if len(targets) > 1:
+        resolve_ldap_groups(ldapconn, model.users)
+    # With more than one cluster, planned operations and log lines are prefixed with the
+    # cluster name
+    prefix = '{}: ' if len(targets) > 1 else ''
+    errorcount = 0
+    if not concurrent or len(targets) < 2:
+        for name, clusterdata in targets:
+            cluster = clusters.setdefault(name, Cluster(name))
+            errorcount += logcontext.run_as(name if prefix else None, cluster.run, clusterdata,
+                                            ldapconn, plan_only, prefix.format(name), model)
+        return errorcount
+
+    executor = futures.ThreadPoolExecutor(
+        max_workers=max(1, general_option(configdata, 'cluster_parallelism')))
+    running = {}
+    try:
+        for name, clusterdata in targets:
+            cluster = clusters.setdefault(name, Cluster(name))
+            if cluster.busy():
+                logging.warning('Cluster %s is still running, skipping it this run', name)
+                errorcount += 1
+                continue
+            cluster.future = executor.submit(logcontext.run_as, name, cluster.run, clusterdata,
+                                             ldapconn, plan_only, prefix.format(name), model)
+            running[cluster.future] = name
+        timeout = general_option(configdata, 'cluster_timeout') or None
+        done, not_done = futures.wait(running, timeout=timeout)
+        for future in done:
+            errorcount += future.result()
+        for future in not_done:
+            logging.error('Cluster %s did not finish within %d seconds, continuing without it',
+                          running[future], timeout)
+            errorcount += 1
+    finally:
+        # Workers that are still running finish in the background
+        executor.shutdown(wait=False)
+    return errorcount
 
-            pgconn = PGConnection(dsn_params=configdata['postgresql']['dsn'],
-                                  strict_params=strict)
-            ldapconn = LDAPConnection(ldapconfig)
 
-            if pgconn.is_standby():
-                raise Exception('Postgres ({}) cluster is standby'.format(pgconn.dsn()))
+def run_clusters_async(clusters, configdata, targets, ldapconn, model=None):
+    '''
+    This function is the asyncio counterpart of run_clusters: it runs every cluster in targets
+    (see Cluster.run_async) on one event loop, and returns the number of errors. Blocking
+    calls run in a pool of worker threads, that is sized for general/cluster_parallelism
+    clusters with general/parallelism databases each (from configdata, the top level config).
+    '''
+    executor = futures.ThreadPoolExecutor(
+        max_workers=max(1, general_option(configdata, 'cluster_parallelism')) *
+        max(1, general_option(configdata, 'parallelism')) + 1)
+    try:
+        return asyncio.run(reconcile_clusters(clusters, configdata, targets, ldapconn,
+                                              executor, model))
+    finally:
+        # Calls of clusters that did not finish in time finish in the background
+        executor.shutdown(wait=False)
 
-            errorcount += proces_fga(configdata, pgconn, ldapconn)
 
-            logging.info("Finished applying config")
+async def reconcile_clusters(clusters, configdata, targets, ldapconn, executor, model=None):
+    '''
+    This function runs the clusters of run_clusters_async as tasks, at most
+    general/cluster_parallelism at a time. Ldap groups are resolved once, for all clusters,
+    while the clusters read their catalogs. A cluster that does not finish within
+    general/cluster_timeout seconds is cancelled, counts as an error and is skipped until its
+    calls that where running have finished.
+    '''
+    limit = asyncio.Semaphore(max(1, general_option(configdata, 'cluster_parallelism')))
+    if model is None:
+        model = compile_config(configdata)
+    ldap_resolved = asyncio.ensure_future(asyncio.get_running_loop().run_in_executor(
+        executor, resolve_ldap_groups, ldapconn, model.users))
+
+    async def run(cluster, clusterdata):
+        '''
+        Run a cluster (when the limit allows it), with its log lines prefixed with its name
+        when there is more than one cluster.
+        '''
+        async with limit:
+            with logcontext.cluster_logging(cluster.name if len(targets) > 1 else None):
+                return await cluster.run_async(clusterdata, ldapconn, executor, ldap_resolved,
+                                               model)
 
-        except Exception:
-            logging.exception('Error occurred while processing:')
+    errorcount = 0
+    running = {}
+    for name, clusterdata in targets:
+        cluster = clusters.setdefault(name, Cluster(name))
+        if cluster.busy():
+            logging.warning('Cluster %s is still running, skipping it this run', name)
             errorcount += 1
+            continue
+        running[asyncio.ensure_future(run(cluster, clusterdata))] = name
+    if not running:
+        return errorcount
+    timeout = general_option(configdata, 'cluster_timeout') or None
+    done, not_done = await asyncio.wait(running, timeout=timeout)
+    for task in done:
+        errorcount += task.result()
+    for task in not_done:
+        logging.error('Cluster %s did not finish within %d seconds, continuing without it',
+                      running[task], timeout)
+        task.cancel()
+        errorcount += 1
+    return errorcount
+
+
+def terminate(signum, _frame):
+    '''
+    This function handles SIGTERM by leaving through SystemExit, so that finally blocks and
+    atexit handlers (like cleaning up copies of key files) run, as they do on a normal exit.
+    '''
+    logging.info('Received signal %s, stopping', signum)
+    sys.exit(128 + signum)
+
+
+def main():
+    '''
+    This function runs the main part of the script.
+    '''
+    parsed_args = arguments()
+    signal.signal(signal.SIGTERM, terminate)
+    logcontext.install()
+    # Cache ldap group members over runs (when ldap cache_ttl is set)
+    ldapcache = MembershipCache()
+    loader = ConfigLoader(parsed_args.configfile)
+    metricsconfig = copy(METRICS_DEFAULTS)
+    metrics_server = None
+    # Per cluster, connections (and the statements prepared on them) are kept over runs while
+    # its postgresql config stays the same, and runs where nothing changed are skipped
+    clusters = {}
+    PROFILER.directory = parsed_args.profile
+    PROFILER.every = max(1, parsed_args.profile_every)
+
+    try:
+        while True:
+            errorcount = 0
+            targets = []
+            model = None
+            PROFILER.start_run()
+            try:
+                configdata = config(parsed_args, loader)
+                # Validated once per change of the config file, and shared by all clusters
+                model = loader.model()
+                metricsconfig = config_metrics(configdata)
+                if metricsconfig['port'] and not metrics_server and not parsed_args.plan:
+                    # The endpoint is started once, and keeps serving while the daemon runs
+                    metrics_server = REGISTRY.serve(int(metricsconfig['port']),
+                                                    metricsconfig['address'])
+                ldapconfig = config_ldap(configdata)
+                targets = cluster_configs(configdata)
+                for name in set(clusters) - {name for name, _ in targets}:
+                    logging.info('Cluster %s was removed from the config', name)
+                    clusters.pop(name).close()
+                ldapconn = LDAPConnection(ldapconfig, cache=ldapcache)
+                if parsed_args.plan or PROFILER.directory:
+                    # Profiles and plans are per run (not per cluster), so clusters run one by one
+                    errorcount += run_clusters(clusters, configdata, targets, ldapconn,
+                                               parsed_args.plan, concurrent=False, model=model)
+                elif parsed_args.engine == 'asyncio':
+                    errorcount += run_clusters_async(clusters, configdata, targets, ldapconn,
+                                                     model)
+                else:
+                    errorcount += run_clusters(clusters, configdata, targets, ldapconn,
+                                               model=model)
+                logging.debug('LDAP cache stats: %s', ldapcache.stats)
+
+            except Exception:
+                logging.exception('Error occurred while processing:')
+                RUNS.inc(result='failed')
+                errorcount += 1
+
             # returncode is actually % 256, so if that is 0, add an additional 1
             if errorcount and not errorcount % 256:
                 errorcount += 1
-
-        try:
-            if parsed_args.rundelay:
-                delay = parsed_args.rundelay
+            try:
+                PROFILER.finish_run()
+            except OSError as error:
+                logging.error('Could not write profile: %s', error)
+            if parsed_args.plan:
+                break
+            export_metrics(metricsconfig, errorcount,
+                           [cluster.detector for cluster in clusters.values()], ldapcache)
+            try:
+                if parsed_args.rundelay:
+                    delay = parsed_args.rundelay
+                else:
+                    delay = configdata['general']['rundelay']
+            except (KeyError, AttributeError, TypeError, UnboundLocalError):
+                print('rundelay not set')
+                break
+            if delay > 0:
+                logging.debug("Waiting for %s", str(delay))
+                listeners = {name: clusters[name].watch_ddl(clusterdata, model)
+                             for name, clusterdata in targets
+                             if name in clusters and not clusters[name].busy()}
+                listeners.update({name: cluster.listener for name, cluster in clusters.items()
+                                  if cluster.busy() and cluster.listener})
+                listeners = {name: listener for name, listener in listeners.items() if listener}
+                if listeners:
+                    # Returns early on DDL in a managed database (or a changed config file)
+                    changed = wait_for_ddl(listeners, delay,
+                                           {name: clusters[name].pgconn.backend_pids()
+                                            for name in listeners if clusters[name].pgconn},
+                                           loader)
+                    for name, databases in sorted(changed.items()):
+                        logging.info("DDL in databases %s of cluster %s, reconciling",
+                                     ', '.join(sorted(databases)), name)
+                        clusters[name].detector.failed()
+                else:
+                    # Returns early when the config file changes (with inotify)
+                    loader.wait(delay)
             else:
-                delay = configdata['general']['rundelay']
-        except (KeyError, AttributeError, TypeError, UnboundLocalError):
-            print('rundelay not set')
-            break
-        if delay > 0:
-            logging.debug("Waiting for %s", str(delay))
-            time.sleep(delay)
-        else:
-            break
+                break
+    finally:
+        # Also on unexpected exits, like KeyboardInterrupt
+        for cluster in clusters.values():
+            cluster.close()
     sys.exit(errorcount)
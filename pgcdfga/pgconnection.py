@@ -23,12 +23,25 @@ Jing Rao <jrao@bol.com>
 '''
 
 import os
+import re
+import atexit
 from copy import copy
 import logging
 import hashlib
 import tempfile
+import threading
+import itertools
 import psycopg2
 from psycopg2 import sql
+from psycopg2.errorcodes import DUPLICATE_PREPARED_STATEMENT, INVALID_SQL_STATEMENT_NAME
+from psycopg2.extras import NamedTupleCursor
+from pgcdfga.pgcatalog import PGCatalog, ROLES_QUERY, has_option
+from pgcdfga.pgpool import PGConnectionPool, DEFAULT_MAX_CONNECTIONS
+from pgcdfga.logcontext import worker_pool
+from pgcdfga.metrics import QUERIES, QUERY_SECONDS, DDL_STATEMENTS, CONNECTIONS, \
+    CONNECT_SECONDS, CONNECTION_POOL, PREPARED_STATEMENTS, count_object
+from pgcdfga.passwords import PASSWORD_ENCRYPTIONS, DEFAULT_PASSWORD_ENCRYPTION, \
+    password_is_current, password_verifier
 
 VALID_ROLE_OPTIONS = {'SUPERUSER': 'rolsuper',
                       'NOSUPERUSER': 'not rolsuper',
@@ -52,7 +65,13 @@ PROTECTED_ROLES = ['aq_administrator_role', 'enterprisedb', 'postgres',
 
 PROTECTED_DBS = ['postgres', 'template0', 'template1']
 
-DB_DEFAULTS = {'owner': None, 'ensure': 'present', 'extensions': {}}
+# Password literals in statements, e.g. "with encrypted password 'md5...'"
+PASSWORD_LITERAL_RE = re.compile(r"(password\s+)'(?:[^']|'')*'", re.IGNORECASE)
+
+# Rows fetched per round trip by iter_sql
+DEFAULT_ITERSIZE = 2000
+
+DB_DEFAULTS = {'owner': None, 'ensure': 'present', 'extensions': {}, 'default_privileges': False}
 
 EXTENSION_DEFAULTS = {'schema': 'public',
                       'version': None,
@@ -72,6 +91,48 @@ USER_DEFAULTS = {'ensure': 'present',
 STRICT_DEFAULTS = {'users': True, 'databases': False, 'extensions': True}
 
 
+def redact(statement):
+    '''
+    Returns a statement (as it is sent to postgres) with password literals masked, so that it
+    can be logged without leaking password hashes.
+    '''
+    if not isinstance(statement, str):
+        # psycopg2.sql objects hold parameters as %s placeholders
+        return statement
+    return PASSWORD_LITERAL_RE.sub(r"\1'********'", statement)
+
+
+def is_system_role(rolename):
+    '''
+    Returns True for roles that are predefined by postgres (or a distribution of postgres).
+    Postgres reserves the pg_ prefix, and newer versions add predefined roles (like
+    pg_database_owner and pg_read_all_data), which can not be dropped.
+    '''
+    return rolename in PROTECTED_ROLES or rolename.startswith('pg_')
+
+
+def prepared_name(query):
+    '''
+    Returns the name of the prepared statement of a query, e.a. 'pgcdfga_3c1f9e0a52b7d8e4'.
+    '''
+    return 'pgcdfga_' + hashlib.sha1(' '.join(query.split()).encode()).hexdigest()[:16]
+
+
+def prepared_statement(query, parameters=None):
+    '''
+    Returns the name of the prepared statement of a query (with $1, $2, etc. as placeholders
+    for the parameters), the statement that prepares and executes it in one round trip, and
+    the statement that executes it (once prepared).
+    '''
+    name = prepared_name(query)
+    execute = 'EXECUTE ' + name
+    if parameters:
+        execute += ' ({})'.format(', '.join(['%s'] * len(parameters)))
+        # The query is sent along with the parameters, so its own % signs need escaping
+        query = query.replace('%', '%%')
+    return name, 'PREPARE {} AS {};\n{}'.format(name, query, execute), execute
+
+
 class PGConnectionException(Exception):
     '''
     This exception is raised when invalid data is fed to a PGConnectionException
@@ -84,19 +145,39 @@ class PGConnection():
     This class is used to connect to a postgres cluster and to run logical functionality
     through methods of this class, like dropdb, createdb, etc.
     '''
-    def __init__(self, dsn_params=None, strict_params=copy(STRICT_DEFAULTS)):
+    def __init__(self, dsn_params=None, strict_params=copy(STRICT_DEFAULTS),
+                 max_connections=DEFAULT_MAX_CONNECTIONS, itersize=DEFAULT_ITERSIZE,
+                 password_encryption=DEFAULT_PASSWORD_ENCRYPTION):
         '''
         Sets some defaults on a new initted PGConnection class.
+        At most max_connections connections (one per database) are kept open.
+        itersize is the number of rows iter_sql fetches per round trip.
+        password_encryption is the encryption of the passwords that setpassword stores (one of
+        PASSWORD_ENCRYPTIONS).
         '''
         if not isinstance(dsn_params, dict) or not dsn_params:
             raise PGConnectionException('Init PGConnection class with a dict of connection \
                                          parameters')
+        if password_encryption not in PASSWORD_ENCRYPTIONS:
+            raise PGConnectionException('Invalid password_encryption', password_encryption)
+        self.password_encryption = password_encryption
         self.__dsn_params = dsn_params
-        self.__conn = {}
-        self.__rolegrants = {}
-        self.__databases = set()
-        self.__extensions = {}
+        self.__pool = PGConnectionPool(self.__new_connection, max_connections)
         self.strict_params = strict_params
+        self.catalog = None
+        self.itersize = itersize
+        self.__cursor_ids = itertools.count(1)
+        # Per database, the names of the statements that are prepared on its connection
+        self.__prepared = {}
+        self.__prepare_locks = {}
+        self.__prepared_stats = {}
+        # The connection pool statistics that where added to the metrics (see export_metrics)
+        self.__exported_pool_stats = {}
+        self.__prepare_lock = threading.Lock()
+        # Backend pids of the pooled connections that where opened (see backend_pids)
+        self.__backend_pids = set()
+        # DDL batches are per thread, so that workers can batch DDL for their own database
+        self.__local = threading.local()
 
     def dsn(self, dsn_params=None):
         '''
@@ -129,11 +210,70 @@ class PGConnection():
         thats already set during init, or a previous connect.
         If a succesful connection is already there, connect will be skipped.
         '''
-        try:
-            if not self.__conn[database].closed:
-                return
-        except (KeyError, AttributeError):
-            pass
+        self.__pool.acquire(database)
+        self.__pool.release(database)
+
+    def close(self):
+        '''
+        Close all connections and log connection pool statistics.
+        '''
+        logging.info('Connection pool statistics: %s', self.pool_stats())
+        logging.info('Prepared statement statistics: %s', self.prepared_stats())
+        self.export_metrics()
+        self.__pool.close()
+
+    def export_metrics(self):
+        '''
+        Adds the connection pool events since the last export to the metrics. Connections are
+        kept over runs (and only closed on exit), so this is called after every run too.
+        '''
+        stats = dict(self.__pool.stats)
+        for event, value in stats.items():
+            CONNECTION_POOL.inc(value - self.__exported_pool_stats.get(event, 0), event=event)
+        self.__exported_pool_stats = stats
+
+    def pool_stats(self):
+        '''
+        Returns the connection pool statistics (hits, misses, evictions, invalidated).
+        '''
+        return dict(self.__pool.stats, open=len(self.__pool))
+
+    def prepared_stats(self):
+        '''
+        Returns the statistics of prepared statements (see run_prepared), as
+        {name: {'prepares': x, 'hits': y}}, where hits are executions of a statement that
+        was prepared on the connection before.
+        '''
+        with self.__prepare_lock:
+            return {name: dict(stats) for name, stats in self.__prepared_stats.items()}
+
+    def backend_pids(self):
+        '''
+        Returns the backend pids of the pooled connections that are open, or that where opened
+        since the previous call, so that notifications sent by this process can be recognized.
+        '''
+        with self.__prepare_lock:
+            pids, self.__backend_pids = self.__backend_pids, set()
+        return pids | self.__pool.backend_pids()
+
+    def __new_connection(self, database):
+        '''
+        Open a new connection to a database (used by the connection pool).
+        '''
+        # Prepared statements live in a session, so a new connection starts without any
+        with self.__prepare_lock:
+            self.__prepared.setdefault(database, set()).clear()
+        conn = self.new_connection(database)
+        with self.__prepare_lock:
+            self.__backend_pids.add(conn.get_backend_pid())
+        return conn
+
+    def new_connection(self, database: str = 'postgres', async_: bool = False):
+        '''
+        Open a new connection (in autocommit) to a database, that is not part of the pool.
+        With async_, the connection is an asynchronous psycopg2 connection (which is always in
+        autocommit), that is still connecting when it is returned (see aioengine.wait_ready).
+        '''
         # Split 'host=127.0.0.1 dbname=postgres' in {'host': '127.0.0.1', 'dbname': 'postgres'}
         dsn_params = copy(self.__dsn_params)
         dsn_params['dbname'] = database
@@ -141,11 +281,11 @@ class PGConnection():
         # Work around. Secrets don't get proper permissions when uid!=0.
         # That breaks client authentication. Therefore copying fle contents to a new file
         # (in RAM) with proper permissions so that at least client auth works.
-        # And cleaning it up when connection is made
+        # The copy is reused for all connections and cleaned up at exit (see KeyFileCache).
         newkeyfile = None
         if 'sslkey' in dsn_params:
             try:
-                dsn_params['sslkey'] = newkeyfile = set_correct_permissions(dsn_params['sslkey'])
+                dsn_params['sslkey'] = newkeyfile = KEY_FILE_CACHE.get(dsn_params['sslkey'])
             except (OSError, FileNotFoundError) as error:
                 logging.debug('Could not set proper permissions for key file %s.\n'
                               'Trying without sslkey in connectstring.',
@@ -160,10 +300,12 @@ class PGConnection():
         # Join {'host': '127.0.0.1', 'dbname': 'postgres'} into 'host=127.0.0.1 dbname=postgres'
         dsn = self.dsn(dsn_params)
 
-        self.__conn[database] = conn = psycopg2.connect(dsn)
-        conn.autocommit = True
-        if newkeyfile:
-            clean_key_file(newkeyfile)
+        with CONNECT_SECONDS.time():
+            conn = psycopg2.connect(dsn, async_=async_) if async_ else psycopg2.connect(dsn)
+        CONNECTIONS.inc()
+        if not async_:
+            conn.autocommit = True
+        return conn
 
     def run_sql(self, query, parameters=None, database: str = 'postgres'):
         '''
@@ -171,21 +313,296 @@ class PGConnection():
         as a list of dictionaries, e.a.:
           [{'name': 'postgres', 'oid': 12345}, {'name': 'template1', 'oid': 12346}]).
         '''
-        self.connect(database=database)
-        cur = self.__conn[database].cursor()
+        conn = self.__pool.acquire(database)
+        QUERIES.inc(database=database)
         try:
-            logging.debug('query: %s', query)
-            cur.execute(query, parameters)
-        except Exception as error:
-            logging.exception(str(error))
-            raise
+            cur = conn.cursor()
+            with QUERY_SECONDS.time():
+                try:
+                    logging.debug('query: %s', redact(query))
+                    cur.execute(query, parameters)
+                except Exception as error:
+                    # Errors of postgres quote the statement, which can hold a password
+                    logging.error(redact(str(error)))
+                    raise
+                try:
+                    columns = [i[0] for i in cur.description]
+                except TypeError:
+                    return None
+                rows = cur.fetchall()
+            ret = [dict(zip(columns, row)) for row in rows]
+            cur.close()
+            return ret
+        finally:
+            self.__pool.release(database)
+
+    def run_prepared(self, query, parameters=None, database: str = 'postgres'):
+        '''
+        Run a query with $1, $2, etc. as placeholders for the parameters, and return the
+        results like run_sql does. The query is prepared (PREPARE) on first use on the
+        connection to a database and executed (EXECUTE) from then on, so that postgres parses
+        and plans a query that runs over and over again only once per connection.
+        PREPARE is sent in the same round trip as the first EXECUTE.
+        '''
+        name, prepare, execute = prepared_statement(query, parameters)
+        with self.__prepare_lock:
+            prepared = self.__prepared.setdefault(database, set())
+            lock = self.__prepare_locks.setdefault(database, threading.Lock())
+            stats = self.__prepared_stats.setdefault(name, {'prepares': 0, 'hits': 0})
+        # Only threads that use the connection to the same database wait for each other
+        with lock:
+            event = 'hit' if name in prepared else 'prepare'
+            try:
+                result = self.run_sql(execute if event == 'hit' else prepare, parameters,
+                                      database=database)
+            except psycopg2.Error as error:
+                # The connection was replaced since (or prepared by a failed round trip before)
+                if error.pgcode == INVALID_SQL_STATEMENT_NAME:
+                    event, statement = 'prepare', prepare
+                elif error.pgcode == DUPLICATE_PREPARED_STATEMENT:
+                    event, statement = 'hit', execute
+                else:
+                    raise
+                result = self.run_sql(statement, parameters, database=database)
+            prepared.add(name)
+        with self.__prepare_lock:
+            stats[event + 's'] += 1
+        PREPARED_STATEMENTS.inc(statement=name, event=event)
+        return result
+
+    def iter_sql(self, query, parameters=None, database: str = 'postgres', itersize=None,
+                 namedtuples=False):
+        '''
+        Run a query that returns rows, and iterate over the rows as tuples (or namedtuples).
+        Unlike run_sql, the rows are streamed from a server side cursor, itersize (default
+        self.itersize) rows per round trip, so that large results (like all roles of a big
+        cluster) are never held in memory as a whole.
+        The connection is in use until the iteration is finished (or the iterator is closed).
+        '''
+        conn = self.__pool.acquire(database)
+        QUERIES.inc(database=database)
         try:
-            columns = [i[0] for i in cur.description]
-        except TypeError:
-            return None
-        ret = [dict(zip(columns, row)) for row in cur.fetchall()]
-        cur.close()
-        return ret
+            # WITH HOLD, because connections run in autocommit and a cursor without it would
+            # be closed at the end of the implicit transaction of the DECLARE.
+            cur = conn.cursor(name='pgcdfga_{}'.format(next(self.__cursor_ids)), withhold=True,
+                              cursor_factory=NamedTupleCursor if namedtuples else None)
+            cur.itersize = itersize or self.itersize
+            try:
+                with QUERY_SECONDS.time():
+                    try:
+                        logging.debug('query: %s', redact(query))
+                        cur.execute(query, parameters)
+                    except Exception as error:
+                        logging.error(redact(str(error)))
+                        raise
+                yield from cur
+            finally:
+                cur.close()
+        finally:
+            self.__pool.release(database)
+
+    def load_catalog(self):
+        '''
+        Load a snapshot of the catalog (roles, memberships, passwords and databases).
+        From then on, existence and drift checks are answered from the snapshot instead of
+        querying postgres for every object, and the snapshot is updated as DDL is issued.
+        '''
+        catalog = PGCatalog()
+        catalog.load(self.run_sql, self.iter_sql)
+        self.catalog = catalog
+        return catalog
+
+    def __role_exists(self, rolename, exclude_current_user=False):
+        '''
+        Check if a role exists (from the catalog snapshot if one is loaded).
+        '''
+        if self.catalog:
+            return self.catalog.role_exists(rolename, exclude_current_user)
+        query = 'SELECT rolname FROM pg_roles WHERE rolname = $1'
+        if exclude_current_user:
+            query += ' AND rolname != CURRENT_USER'
+        return bool(self.run_prepared(query, [rolename]))
+
+    def __existing_roles(self, rolenames):
+        '''
+        Returns the roles (except the current user) that exist, in one query (or from the
+        catalog snapshot if one is loaded).
+        '''
+        if self.catalog:
+            return [rolename for rolename in rolenames
+                    if self.catalog.role_exists(rolename, exclude_current_user=True)]
+        if not rolenames:
+            return []
+        query = 'SELECT rolname FROM pg_roles WHERE rolname = ANY($1) \
+                 AND rolname != CURRENT_USER'
+        existing = {row['rolname'] for row in self.run_prepared(query, [list(rolenames)])}
+        return [rolename for rolename in rolenames if rolename in existing]
+
+    def __role_attributes(self, rolename):
+        '''
+        Returns the attributes of a role (a dict of ROLE_ATTRIBUTES) in one query (or from
+        the catalog snapshot if one is loaded), or None if the role does not exist.
+        '''
+        if self.catalog:
+            return self.catalog.roles.get(rolename)
+        rows = self.run_prepared(ROLES_QUERY + ' WHERE rolname = $1', [rolename])
+        return rows[0] if rows else None
+
+    def __is_member(self, username, rolename):
+        '''
+        Check if a role is granted to a user (from the catalog snapshot if one is loaded).
+        '''
+        if self.catalog:
+            return self.catalog.is_member(username, rolename)
+        return bool(self.run_prepared("select granted.rolname granted_role, grantee.rolname \
+                                       grantee_role from pg_auth_members auth inner join \
+                                       pg_roles granted on auth.roleid = granted.oid inner \
+                                       join pg_roles grantee on auth.member = grantee.oid \
+                                       where granted.rolname = $1 and grantee.rolname = $2",
+                                      [rolename, username]))
+
+    def __password_differs(self, username, password):
+        '''
+        Check if a user exists and has another password than password (or has it stored with
+        another encryption than password_encryption), from the catalog snapshot if one is
+        loaded. See passwords.password_is_current.
+        '''
+        if self.catalog:
+            can_login, verifier = self.catalog.password(username)
+        else:
+            result = self.run_prepared('SELECT passwd FROM pg_shadow WHERE usename = $1',
+                                       [username])
+            can_login, verifier = bool(result), result[0]['passwd'] if result else None
+        return can_login and not password_is_current(username, password, verifier,
+                                                     self.password_encryption)
+
+    def __has_password(self, username):
+        '''
+        Check if a user (other than the current user) has a password set
+        (from the catalog snapshot if one is loaded).
+        '''
+        if self.catalog:
+            if username == self.catalog.current_user:
+                return False
+            return self.catalog.password(username)[1] is not None
+        return bool(self.run_prepared('SELECT usename FROM pg_shadow WHERE usename = $1 AND \
+                                       passwd IS NOT NULL AND usename != CURRENT_USER',
+                                      [username]))
+
+    def __database_exists(self, dbname):
+        '''
+        Check if a database exists (from the catalog snapshot if one is loaded).
+        '''
+        if self.catalog:
+            return dbname in self.catalog.databases
+        return bool(self.run_prepared('SELECT datname FROM pg_database WHERE datname = $1',
+                                      [dbname]))
+
+    def __database_owned_by(self, dbname, ownername):
+        '''
+        Check if a database is owned by a role (from the catalog snapshot if one is loaded).
+        '''
+        if self.catalog:
+            return self.catalog.databases.get(dbname) == ownername
+        return bool(self.run_prepared('SELECT datname FROM pg_database db inner join pg_roles \
+                                       rol on db.datdba = rol.oid WHERE datname = $1 and \
+                                       rolname = $2', [dbname, ownername]))
+
+    def run_ddl(self, query, *args, **kwargs):
+        '''
+        Run a DDL statement. This method takes the same arguments as run_sql.
+        Outside of a batch (see start_batch), the statement runs immediately.
+        Inside a batch, it is queued and sent with other statements on flush_ddl.
+        '''
+        DDL_STATEMENTS.inc()
+        batch = getattr(self.__local, 'ddl_batch', None)
+        if batch is None:
+            return self.run_sql(query, *args, **kwargs)
+        parameters, database = sql_arguments(*args, **kwargs)
+        conn = self.__pool.acquire(database)
+        try:
+            cur = conn.cursor()
+            statement = cur.mogrify(query, parameters).decode()
+            cur.close()
+        finally:
+            self.__pool.release(database)
+        logging.debug('queued (%s): %s', database, redact(statement))
+        batch.append((database, statement))
+        if len(batch) >= self.__local.ddl_batch_size:
+            self.__flush_ddl()
+        return None
+
+    def start_batch(self, batch_size=100):
+        '''
+        From now on, queue DDL statements (see run_ddl) and send them in batches of at most
+        batch_size statements (per database) when flush_ddl is called, or the batch is full.
+        Batching applies to the calling thread only.
+        '''
+        self.__local.ddl_batch = []
+        self.__local.ddl_batch_size = batch_size
+        self.__local.ddl_errors = 0
+
+    def stop_batch(self):
+        '''
+        Flush all queued DDL and run DDL statements immediately from now on.
+        Returns the number of statements that failed (like flush_ddl).
+        '''
+        errorcount = self.flush_ddl()
+        self.__local.ddl_batch = None
+        return errorcount
+
+    def flush_ddl(self):
+        '''
+        Send all queued DDL statements to postgres, and return the number of statements that
+        failed since the previous call to flush_ddl.
+        '''
+        self.__flush_ddl()
+        errorcount = getattr(self.__local, 'ddl_errors', 0)
+        self.__local.ddl_errors = 0
+        return errorcount
+
+    def __flush_ddl(self):
+        '''
+        Send all queued DDL statements to postgres.
+        Consecutive statements for the same database are sent as one batch, so that the order
+        in which statements where queued is kept.
+        '''
+        batch = getattr(self.__local, 'ddl_batch', None)
+        if not batch:
+            return
+        self.__local.ddl_batch = []
+        statements = []
+        for index, (database, statement) in enumerate(batch):
+            statements.append(statement)
+            if index + 1 == len(batch) or batch[index + 1][0] != database:
+                self.__local.ddl_errors += self.__run_batch(statements, database)
+                statements = []
+
+    def __run_batch(self, statements, database):
+        '''
+        Run a batch of DDL statements in one transaction and one round trip.
+        If the batch fails, it is rolled back and retried one statement at a time with a
+        savepoint per statement, so that only the failing statements are lost.
+        Returns the number of failed statements.
+        '''
+        try:
+            self.run_sql('BEGIN;\n' + ';\n'.join(statements) + ';\nCOMMIT', database=database)
+            return 0
+        except psycopg2.Error:
+            self.run_sql('ROLLBACK', database=database)
+        logging.info('Batch of %d statements failed. Retrying one by one.', len(statements))
+        errorcount = 0
+        self.run_sql('BEGIN', database=database)
+        for statement in statements:
+            self.run_sql('SAVEPOINT pgcdfga_batch', database=database)
+            try:
+                self.run_sql(statement, database=database)
+                self.run_sql('RELEASE SAVEPOINT pgcdfga_batch', database=database)
+            except psycopg2.Error:
+                self.run_sql('ROLLBACK TO SAVEPOINT pgcdfga_batch', database=database)
+                errorcount += 1
+        self.run_sql('COMMIT', database=database)
+        return errorcount
 
     def is_standby(self):
         '''
@@ -202,16 +619,23 @@ class PGConnection():
             logging.info('Not dropping database %s (config/strict/databases is not True)', dbname)
             return False
 
-        if self.run_sql('SELECT datname FROM pg_database WHERE datname = %s', [dbname]):
+        if self.__database_exists(dbname):
             query = sql.SQL("DROP DATABASE {}").format(sql.Identifier(dbname))
+            # DROP DATABASE cannot run inside a transaction (batch)
+            self.__flush_ddl()
             self.run_sql(query)
+            if self.catalog:
+                self.catalog.drop_database(dbname)
+            count_object('database', 'dropped')
             logging.info("Dropped database '%s'", dbname)
             return True
         return False
 
-    def createdb(self, dbname, ownername=None):
+    def createdb(self, dbname, ownername=None, default_privileges=False):
         '''
         This method will create a database if it does not exist.
+        With default_privileges, tables that the owner creates are granted to the readonly role
+        automatically (see grantreadonly).
         '''
         ret = False
         if not ownername:
@@ -219,21 +643,25 @@ class PGConnection():
         readonlyrolename = '{}_readonly'.format(dbname)
         database = sql.Identifier(dbname)
         owner = sql.Identifier(ownername)
-        readonlyrole = sql.Identifier(readonlyrolename)
-        self.__databases.add(dbname)
         if self.createrole(ownername):
             ret = True
-        if not self.run_sql('SELECT datname FROM pg_database WHERE datname = %s', [dbname]):
+        if not self.__database_exists(dbname):
             createquery = sql.SQL("CREATE DATABASE {}").format(database)
+            # CREATE DATABASE cannot run inside a transaction (batch)
+            self.__flush_ddl()
             self.run_sql(createquery)
+            if self.catalog:
+                self.catalog.set_database(dbname, self.catalog.current_user)
+            count_object('database', 'created')
             logging.info("Created database '%s'", dbname)
             ret = True
 
-        if not self.run_sql('SELECT datname FROM pg_database db inner join pg_roles rol \
-                             on db.datdba = rol.oid WHERE datname = %s and \
-                             rolname = %s', [dbname, ownername]):
+        if not self.__database_owned_by(dbname, ownername):
             alterquery = sql.SQL("ALTER DATABASE {} OWNER TO {}").format(database, owner)
-            self.run_sql(alterquery)
+            self.run_ddl(alterquery)
+            if self.catalog:
+                self.catalog.set_database(dbname, ownername)
+            count_object('database', 'altered')
             logging.info("Altered database owner on '%s' to '%s'", dbname, ownername)
             ret = True
         # opex role has full permissions on every user database
@@ -241,100 +669,240 @@ class PGConnection():
             ret = True
         if self.grantrole('readonly', readonlyrolename):
             ret = True
+        self.grantreadonly(dbname, default_privileges)
+        return ret
 
-        ungranted_schemas_query = "select distinct schemaname from pg_tables \
-            where schemaname not in ('pg_catalog','information_schema') \
-            and schemaname||'.'||tablename not in (SELECT table_schema||'.'||table_name \
-                FROM information_schema.role_table_grants \
-                WHERE grantee = %s \
-                and privilege_type = 'SELECT')"
+    def grantreadonly(self, dbname, default_privileges=False):
+        '''
+        This method grants select on all tables in a database to the readonly role of that
+        database, for all schemas that have tables where that is not granted yet.
+        With default_privileges, it also makes sure that tables that the database owner creates
+        in the future are granted to the readonly role (ALTER DEFAULT PRIVILEGES).
+        Tables that are created by other roles are still found by the check on existing tables.
+        '''
+        readonlyrolename = '{}_readonly'.format(dbname)
+        readonlyrole = sql.Identifier(readonlyrolename)
+        ret = False
+        if default_privileges and self.__grant_default_privileges(dbname, readonlyrolename):
+            ret = True
+        # has_table_privilege over pg_class is a lot cheaper than information_schema views
+        ungranted_schemas_query = "SELECT DISTINCT n.nspname AS schemaname \
+            FROM pg_class c INNER JOIN pg_namespace n ON c.relnamespace = n.oid \
+            WHERE c.relkind IN ('r', 'p') \
+            AND n.nspname NOT IN ('pg_catalog', 'information_schema') \
+            AND n.nspname NOT LIKE 'pg\\_%' \
+            AND NOT has_table_privilege($1, c.oid, 'SELECT')"
 
-        for schemaname in self.run_sql(ungranted_schemas_query, [readonlyrolename],
-                                       database=dbname):
+        for schemaname in self.run_prepared(ungranted_schemas_query, [readonlyrolename],
+                                            database=dbname):
             schema = sql.Identifier(schemaname['schemaname'])
             grant_query = sql.SQL("GRANT SELECT ON ALL TABLES IN SCHEMA {} TO {}")
             grant_query = grant_query.format(schema, readonlyrole)
             logging.debug(grant_query)
-            self.run_sql(grant_query, database=dbname)
+            self.run_ddl(grant_query, database=dbname)
+            count_object('schema_grant', 'created')
+            ret = True
         return ret
 
+    def __grant_default_privileges(self, dbname, readonlyrolename):
+        '''
+        This method makes sure that tables the database owner creates (in any schema) are
+        granted to the readonly role automatically. Returns True if that was not the case yet.
+        '''
+        default_privileges_query = "SELECT db.datname, o.rolname AS owner, EXISTS ( \
+                SELECT 1 FROM pg_default_acl d, aclexplode(d.defaclacl) acl \
+                WHERE d.defaclrole = db.datdba AND d.defaclnamespace = 0 \
+                AND d.defaclobjtype = 'r' AND acl.privilege_type = 'SELECT' \
+                AND acl.grantee = (SELECT oid FROM pg_roles WHERE rolname = $1)) AS granted \
+            FROM pg_database db INNER JOIN pg_roles o ON db.datdba = o.oid \
+            WHERE db.datname = current_database()"
+        for row in self.run_prepared(default_privileges_query, [readonlyrolename],
+                                     database=dbname):
+            if row['granted']:
+                return False
+            query = sql.SQL("ALTER DEFAULT PRIVILEGES FOR ROLE {} GRANT SELECT ON TABLES TO {}")
+            query = query.format(sql.Identifier(row['owner']), sql.Identifier(readonlyrolename))
+            self.run_ddl(query, database=dbname)
+            count_object('default_privileges', 'created')
+            logging.info("Granted select on future tables of '%s' to '%s'", row['owner'],
+                         readonlyrolename)
+            return True
+        return False
+
     def droprole(self, rolename):
         '''
         This method will remove a user / role if it exists.
         '''
+        return self.droproles([rolename])
+
+    def droproles(self, rolenames, parallelism=1):
+        '''
+        This method will remove users / roles that exist.
+        Objects of the roles are reassigned to the database owner, and their privileges are
+        dropped, only in databases where the roles have dependencies (according to
+        pg_shdepend), with one statement for all roles per database.
+        Databases are processed by up to parallelism workers (with a connection each).
+        When a statement for all roles fails, it is retried for every role separately, so
+        that one role that can not be dropped does not keep the others.
+        System roles (see is_system_role) are never dropped.
+        '''
         if not self.strict_option('users'):
-            logging.info('Not dropping user/role %s (config/strict/roless is not True)', rolename)
+            logging.info('Not dropping users/roles %s (config/strict/roless is not True)',
+                         ', '.join(rolenames))
             return False
 
-        if self.run_sql('SELECT rolname FROM pg_roles WHERE rolname = %s \
-                         AND rolname != CURRENT_USER', [rolename]):
-            role = sql.Identifier(rolename)
-            db_query = "select db.datname, o.rolname as owner from pg_database db inner join \
-                        pg_roles o on db.datdba = o.oid where db.datname != 'template0'"
-            databases = [(db['datname'], db['owner']) for db in self.run_sql(db_query)]
-            for database, ownername in databases:
-                new_owner = sql.Identifier(ownername)
-                reassign_query = sql.SQL("REASSIGN OWNED BY {} TO {}").format(role, new_owner)
-                self.run_sql(query=reassign_query, database=database)
-            drop_query = sql.SQL("DROP ROLE {}").format(role)
-            self.run_sql(drop_query)
+        system_roles = [rolename for rolename in rolenames if is_system_role(rolename)]
+        if system_roles:
+            logging.info('Not dropping system roles %s', ', '.join(system_roles))
+        rolenames = self.__existing_roles([rolename for rolename in rolenames
+                                           if not is_system_role(rolename)])
+        if not rolenames:
+            return False
+        # Dependencies on shared objects (dbid 0, e.a. databases) are reassigned in postgres
+        dependencies_query = "SELECT DISTINCT db.datname, o.rolname AS owner, r.rolname \
+                              FROM pg_shdepend dep \
+                              INNER JOIN pg_roles r ON dep.refobjid = r.oid \
+                              INNER JOIN pg_database db ON db.oid = CASE dep.dbid \
+                                  WHEN 0 THEN (SELECT oid FROM pg_database \
+                                               WHERE datname = 'postgres') \
+                                  ELSE dep.dbid END \
+                              INNER JOIN pg_roles o ON db.datdba = o.oid \
+                              WHERE dep.refclassid = 'pg_authid'::regclass \
+                              AND dep.deptype != 'p' AND db.datname != 'template0' \
+                              AND r.rolname = ANY($1)"
+        dependencies = {}
+        for row in self.run_prepared(dependencies_query, [rolenames]):
+            dependencies.setdefault((row['datname'], row['owner']), set()).add(row['rolname'])
+
+        def drop_owned(database_owner):
+            '''
+            Reassign objects and drop privileges of the roles in one database.
+            Returns the roles for which that failed.
+            '''
+            database, ownername = database_owner
+            new_owner = sql.Identifier(ownername)
+            if ownername in rolenames:
+                new_owner = sql.SQL('CURRENT_USER')
+
+            def query(roles):
+                roles = sql.SQL(', ').join(sql.Identifier(rolename) for rolename in roles)
+                return sql.SQL("REASSIGN OWNED BY {} TO {}; DROP OWNED BY {}").format(
+                    roles, new_owner, roles)
+            return self.__run_per_role(query, sorted(dependencies[database_owner]), database)
+
+        # Queued statements (like revokes) go first, and the roles should be without
+        # dependencies before they are dropped. Statements of droproles run immediately, so
+        # that failing roles are known.
+        self.__flush_ddl()
+        if parallelism > 1 and len(dependencies) > 1:
+            with worker_pool(parallelism) as pool:
+                failed = set().union(*pool.map(drop_owned, sorted(dependencies)))
+        else:
+            failed = set().union(*map(drop_owned, sorted(dependencies)))
+        failed |= self.__run_per_role(
+            lambda roles: sql.SQL("DROP ROLE {}").format(
+                sql.SQL(', ').join(sql.Identifier(rolename) for rolename in roles)),
+            [rolename for rolename in rolenames if rolename not in failed])
+        dropped = [rolename for rolename in rolenames if rolename not in failed]
+        count_object('role', 'dropped', len(dropped))
+        for rolename in dropped:
+            if self.catalog:
+                self.catalog.drop_role(rolename)
             logging.info("Dropped role '%s'", rolename)
-            return True
-        return False
+        if failed:
+            raise PGConnectionException('Could not drop roles', sorted(failed))
+        return True
 
-    def createrole(self, rolename, options=None):
+    def __run_per_role(self, query, rolenames, database='postgres'):
         '''
-        This method will create a role if it does not exist.
+        Runs the statement that query(rolenames) returns for all roles at once. If that fails,
+        the statement is run for every role separately.
+        Returns the set of roles for which the statement failed.
         '''
-        if rolename not in self.__rolegrants:
-            self.__rolegrants[rolename] = set()
+        if not rolenames:
+            return set()
+        DDL_STATEMENTS.inc()
+        try:
+            self.run_sql(query(rolenames), database=database)
+            return set()
+        except psycopg2.Error as error:
+            if len(rolenames) == 1:
+                return set(rolenames)
+            logging.info('Statement for roles %s failed (%s). Retrying per role.',
+                         ', '.join(rolenames), redact(str(error)).strip())
+        failed = set()
+        for rolename in rolenames:
+            DDL_STATEMENTS.inc()
+            try:
+                self.run_sql(query([rolename]), database=database)
+            except psycopg2.Error:
+                failed.add(rolename)
+        return failed
 
-        ret = False
-        role = sql.Identifier(rolename)
-        if not self.run_sql('SELECT rolname FROM pg_roles WHERE rolname = %s', [rolename]):
-            query = sql.SQL("CREATE ROLE {}").format(role)
-            self.run_sql(query)
-            logging.info("Created role '%s'", rolename)
-            ret = True
-        if not isinstance(options, list):
+    def createrole(self, rolename, options=None, memberof=None):
+        '''
+        This method will create a role if it does not exist, and set role options.
+        A new role is created with its options (and granted the roles in memberof) in one
+        statement. For an existing role, all options that differ are set in one statement.
+        The roles in memberof should exist.
+        '''
+        if not isinstance(options, (list, tuple)):
             options = []
         options = {option.upper() for option in options}
-        valid_role_options_set = set(VALID_ROLE_OPTIONS.keys())
-        for option in options & valid_role_options_set:
-            logging.debug('createrole %s %s', rolename, option)
-            option_check_query = sql.SQL('SELECT rolname FROM pg_roles \
-                                          WHERE rolname = %s \
-                                          AND ' + VALID_ROLE_OPTIONS[option])
-            if not self.run_sql(option_check_query, [rolename]):
-                logging.debug('createrole ALTER %s %s', rolename, option)
-                option_set_query = sql.SQL('ALTER ROLE {} WITH ' + option).format(role)
-                self.run_sql(option_set_query)
-                ret = True
-        if options - valid_role_options_set:
+        invalid_options = options - set(VALID_ROLE_OPTIONS.keys())
+        if invalid_options:
             raise PGConnectionException('Creating roles with invalid role options',
-                                        rolename, options - valid_role_options_set)
-        return ret
+                                        rolename, invalid_options)
+        role = sql.Identifier(rolename)
+        attributes = self.__role_attributes(rolename)
+        if attributes is None:
+            query = sql.SQL("CREATE ROLE {}").format(role)
+            if options:
+                query += sql.SQL(' WITH ' + ' '.join(sorted(options)))
+            if memberof:
+                query += sql.SQL(' IN ROLE ') + sql.SQL(', ').join(
+                    sql.Identifier(granted) for granted in memberof)
+            self.run_ddl(query)
+            if self.catalog:
+                self.catalog.add_role(rolename)
+            for granted in memberof or []:
+                if self.catalog:
+                    self.catalog.add_member(rolename, granted)
+            count_object('role', 'created')
+            count_object('membership', 'created', len(memberof or []))
+            logging.info("Created role '%s'", rolename)
+        else:
+            options = {option for option in options
+                       if not has_option(attributes, VALID_ROLE_OPTIONS[option])}
+            if not options:
+                return False
+            logging.debug('createrole ALTER %s %s', rolename, sorted(options))
+            query = sql.SQL('ALTER ROLE {} WITH ' + ' '.join(sorted(options))).format(role)
+            self.run_ddl(query)
+            count_object('role', 'altered')
+        if self.catalog:
+            for option in options:
+                self.catalog.set_role_option(rolename, VALID_ROLE_OPTIONS[option])
+        return True
 
     def setpassword(self, username, password):
         '''
         This method changes the password of a user.
-        It encrypts using md5, so that the cleartext password doe not end up in the log.
+        It encrypts using md5 or SCRAM-SHA-256 (see password_encryption), so that the
+        cleartext password doe not end up in the log. Passwords that are hashed already are
+        stored as is.
         Of coarse, there are a lot of more secure solutions, like ldap and client certificates.
         But for setting a password, this is the best solution, currently provided.
         '''
 
         user = sql.Identifier(username)
-
-        if len(password) == 35 and password[:3] == 'md5':
-            hashed_password = password
-        else:
-            md5 = hashlib.md5()
-            md5.update((password + username).encode())
-            hashed_password = 'md5' + md5.hexdigest()
-        if self.run_sql('SELECT usename FROM pg_shadow WHERE usename = %s \
-                         AND COALESCE(passwd, %s) != %s', [username, '', hashed_password]):
+        if self.__password_differs(username, password):
+            hashed_password = password_verifier(username, password, self.password_encryption)
             query = sql.SQL('alter user {} with encrypted password %s').format(user)
-            self.run_sql(query, [hashed_password])
+            self.run_ddl(query, [hashed_password])
+            if self.catalog:
+                self.catalog.set_password(username, hashed_password)
+            count_object('password', 'altered')
             return True
         return False
 
@@ -345,10 +913,12 @@ class PGConnection():
 
         user = sql.Identifier(username)
 
-        if self.run_sql('SELECT usename FROM pg_shadow WHERE usename = %s AND \
-                         passwd IS NOT NULL AND usename != CURRENT_USER', [username]):
+        if self.__has_password(username):
             query = sql.SQL('alter user {} with password NULL').format(user)
-            self.run_sql(query)
+            self.run_ddl(query)
+            if self.catalog:
+                self.catalog.set_password(username, None)
+            count_object('password', 'dropped')
             return True
         return False
 
@@ -360,20 +930,14 @@ class PGConnection():
         for role_tobe_created in [rolename, username]:
             if self.createrole(role_tobe_created):
                 ret = True
-        try:
-            self.__rolegrants[rolename].add(username)
-        except KeyError:
-            self.__rolegrants[rolename] = set([username])
-        if not self.run_sql("select granted.rolname granted_role, grantee.rolname \
-                                 grantee_role from pg_auth_members auth inner join pg_roles \
-                                 granted on auth.roleid = granted.oid inner join pg_roles \
-                                 grantee on auth.member = grantee.oid where \
-                                 granted.rolname = %s and grantee.rolname = %s",
-                            [rolename, username]):
+        if not self.__is_member(username, rolename):
             user = sql.Identifier(username)
             role = sql.Identifier(rolename)
             query = sql.SQL("GRANT {} TO {}").format(role, user)
-            self.run_sql(query)
+            self.run_ddl(query)
+            if self.catalog:
+                self.catalog.add_member(username, rolename)
+            count_object('membership', 'created')
             logging.info("Granted role '%s' to user '%s'", rolename, username)
             ret = True
         return ret
@@ -382,101 +946,43 @@ class PGConnection():
         '''
         This method will revoke a role from a user.
         '''
-        check_query = 'SELECT rolname FROM pg_roles WHERE rolname = %s and rolname != CURRENT_USER'
-        userexists = self.run_sql(check_query, [username])
-        roleexists = self.run_sql(check_query, [rolename])
+        userexists = self.__role_exists(username, exclude_current_user=True)
+        roleexists = self.__role_exists(rolename, exclude_current_user=True)
         if not userexists or not roleexists:
             return False
         user = sql.Identifier(username)
         role = sql.Identifier(rolename)
         query = sql.SQL("REVOKE {} FROM {}").format(role, user)
-        self.run_sql(query)
+        self.run_ddl(query)
+        if self.catalog:
+            self.catalog.remove_member(username, rolename)
+        count_object('membership', 'dropped')
         logging.info("Revoked role '%s' from '%s'", rolename, username)
         return True
 
-    def strictifyroles(self):
-        '''
-        If you call this method when all role grants have been put in place,
-        all grants that where not specified will be revoked.
-        This limits role grants to only as specified in the underlying config.
-        '''
-        try:
-            grantees_query = 'SELECT rolname grantee FROM pg_roles r JOIN pg_auth_members a \
-                              ON r.oid=a.member WHERE a.roleid = (SELECT oid FROM \
-                                 pg_roles WHERE rolname = %s)'
-            revoked_or_dropped = 0
-            all_managed_roles = set(PROTECTED_ROLES)
-
-            for granted, grantees in self.__rolegrants.items():
-                all_managed_roles.add(granted)
-                all_managed_roles |= set(grantees)
-                actual_grantees = self.run_sql(grantees_query, [granted])
-                actual_grantees = {r['grantee'] for r in actual_grantees}
-                overgranted = actual_grantees - grantees
-                for grantee in overgranted:
-                    self.revokerole(grantee, granted)
-                    revoked_or_dropped += 1
-
-            all_existing_roles = self.run_sql('SELECT rolname FROM pg_roles')
-            for role in all_existing_roles:
-                rolename = role['rolname']
-                if rolename in all_managed_roles:
-                    continue
-                self.droprole(rolename)
-                revoked_or_dropped += 1
-        except Exception as error:
-            logging.exception(str(error))
-
-        if revoked_or_dropped:
-            return True
-        return False
-
-    def strictifydatabases(self):
-        '''
-        If you call this method when all databases have been created,
-        all databases that are not managed by this programm, will be cleaned
-        This limits database to only as specified in the underlying config.
-        Use with care.
-        '''
-        dropped = 0
-        try:
-            for dbrow in self.run_sql('SELECT datname FROM pg_database'):
-                dbname = dbrow['datname']
-                if dbname in self.__databases:
-                    continue
-                if dbname in PROTECTED_DBS:
-                    continue
-                self.dropdb(dbname)
-                dropped += 1
-        except Exception as error:
-            logging.exception(str(error))
-        if dropped:
-            return True
-        return False
-
-    def strictifyextensions(self):
+    def revokeroles(self, rolename, usernames):
         '''
-        If you call this method when all extensions have been created,
-        all extensions that are not managed by this programm, will be cleaned
-        This limits extensions to only as specified in the underlying config.
+        This method will revoke a role from many users with one statement.
+        With a catalog snapshot loaded, users that are not a member (or don't exist) are skipped.
+        Without it, the caller is trusted to only pass users that are a member.
         '''
-        dropped = 0
-        try:
-            for dbname in self.__databases:
-                try:
-                    managedextensions = self.__extensions[dbname]
-                except KeyError:
-                    managedextensions = []
-                for extrow in self.run_sql('SELECT extname FROM pg_extension', database=dbname):
-                    extname = extrow['extname']
-                    if extname not in managedextensions:
-                        self.dropextension(extname, dbname)
-                        dropped += 1
-        except Exception as error:
-            logging.exception(str(error))
-        if dropped:
-            return True
-        return False
+        if self.catalog:
+            if not self.__role_exists(rolename, exclude_current_user=True):
+                return False
+            usernames = [username for username in usernames
+                         if self.__role_exists(username, exclude_current_user=True) and
+                         self.catalog.is_member(username, rolename)]
+        if not usernames:
+            return False
+        users = sql.SQL(', ').join(sql.Identifier(username) for username in usernames)
+        query = sql.SQL("REVOKE {} FROM {}").format(sql.Identifier(rolename), users)
+        self.run_ddl(query)
+        count_object('membership', 'dropped', len(usernames))
+        for username in usernames:
+            if self.catalog:
+                self.catalog.remove_member(username, rolename)
+            logging.info("Revoked role '%s' from '%s'", rolename, username)
+        return True
 
     def dropextension(self, extension, database):
         '''
@@ -487,9 +993,12 @@ class PGConnection():
                          extension)
             return False
 
-        if self.run_sql('SELECT datname FROM pg_database WHERE datname = %s', [database]):
+        if self.__database_exists(database):
             query = sql.SQL("DROP EXTENSION IF EXISTS {}").format(sql.Identifier(extension))
-            self.run_sql(query, database=database)
+            self.run_ddl(query, database=database)
+            if self.catalog:
+                self.catalog.drop_extension(extension, database)
+            count_object('extension', 'dropped')
             logging.info("Dropped extension '%s' from '%s'", extension, database)
             return True
         return False
@@ -499,18 +1008,21 @@ class PGConnection():
         '''
         This method will drop an extension from a database.
         '''
-        if version:
+        if self.catalog:
+            extensions = self.catalog.load_extensions(dbname, self.run_prepared)
+            if version and extensions.get(extensionname, str(version)) != str(version):
+                self.dropextension(extensionname, dbname)
+        elif version:
             version_query = 'SELECT extname FROM pg_extension \
-                             WHERE extname = %s and extversion != %s'
-            if self.run_sql(version_query, [extensionname, str(version)]):
+                             WHERE extname = $1 and extversion != $2'
+            if self.run_prepared(version_query, [extensionname, str(version)], dbname):
                 self.dropextension(extensionname, dbname)
-        try:
-            self.__extensions[dbname].add(extensionname)
-        except KeyError:
-            self.__extensions[dbname] = set([extensionname])
-
-        if not self.run_sql('SELECT extname FROM pg_extension WHERE extname = %s',
-                            [extensionname], dbname):
+        if self.catalog:
+            extension_exists = extensionname in extensions
+        else:
+            extension_exists = self.run_prepared('SELECT extname FROM pg_extension \
+                                                  WHERE extname = $1', [extensionname], dbname)
+        if not extension_exists:
             extension = sql.Identifier(extensionname)
             create_query = []
             create_query.append(sql.SQL('CREATE EXTENSION IF NOT EXISTS {}').format(extension))
@@ -520,8 +1032,11 @@ class PGConnection():
                 create_query.append(schema_query)
             if version:
                 create_query.append(sql.SQL('VERSION {}').format(sql.Identifier(str(version))))
-            self.run_sql(sql.SQL(' ').join(create_query),
+            self.run_ddl(sql.SQL(' ').join(create_query),
                          database=dbname)
+            if self.catalog:
+                self.catalog.set_extension(extensionname, dbname, version and str(version))
+            count_object('extension', 'created')
             logging.info("Created extension '%s' on '%s'", extensionname, dbname)
             return True
         return False
@@ -537,6 +1052,7 @@ class PGConnection():
             query = sql.SQL("SELECT pg_create_physical_replication_slot({})") \
                        .format(sql.Literal(slot_name))
             if self.run_sql(query):
+                count_object('replication_slot', 'created')
                 logging.info("Created replication slot '%s'", slot_name)
                 return True
             logging.error("Failed to create replication slot '%s'", slot_name)
@@ -550,6 +1066,7 @@ class PGConnection():
             logging.debug("Replication slot '%s' found. Will drop it.", slot_name)
             query = sql.SQL("SELECT pg_drop_replication_slot({})").format(sql.Literal(slot_name))
             if self.run_sql(query):
+                count_object('replication_slot', 'dropped')
                 logging.info("Dropped replication slot '%s'", slot_name)
                 return True
             logging.error("Failed to drop replication slot '%s'", slot_name)
@@ -573,9 +1090,8 @@ class PGConnection():
         '''
         Check if the named replication slot_name exists.
         '''
-        query = sql.SQL("SELECT EXISTS (SELECT 1 FROM pg_replication_slots WHERE slot_name = {})") \
-                   .format(sql.Literal(slot_name))
-        result = self.run_sql(query)
+        result = self.run_prepared('SELECT EXISTS (SELECT 1 FROM pg_replication_slots \
+                                    WHERE slot_name = $1)', [slot_name])
         if result and ('exists' in result[0]):
             return result[0]['exists']
 
@@ -584,6 +1100,13 @@ class PGConnection():
         return True
 
 
+def sql_arguments(parameters=None, database='postgres'):
+    '''
+    This function returns the parameters and database from the arguments of run_sql.
+    '''
+    return parameters, database
+
+
 def set_correct_permissions(filename):
     '''
     Libpq requires client cert private keys to have very specific permissions (0600).
@@ -596,8 +1119,8 @@ def set_correct_permissions(filename):
         logging.info('Fixing permissions on key file %s (%s)', keyfile, keyfilemode)
         with open(keyfile, 'rb') as keyfile_hnd:
             key = keyfile_hnd.read()
-        _nkf_handle, newkeyfile = tempfile.mkstemp()
-        with open(newkeyfile, 'wb') as keyfile_hnd:
+        nkf_handle, newkeyfile = tempfile.mkstemp()
+        with os.fdopen(nkf_handle, 'wb') as keyfile_hnd:
             keyfile_hnd.write(key)
         logging.debug('New key file %s is created with correct permissions', newkeyfile)
         return newkeyfile
@@ -618,3 +1141,58 @@ def clean_key_file(filename):
             with open(keyfile, 'wb') as keyfile_hnd:
                 keyfile_hnd.write(obfuscate)
     os.remove(keyfile)
+
+
+class KeyFileCache():
+    '''
+    This class prepares a copy with correct permissions (see set_correct_permissions) of a key
+    file once, and returns that copy for every connection.
+    When the key file changes (e.a. a rotated kubernetes secret), a new copy is prepared and the
+    old copy is cleaned. All copies are cleaned when the process exits.
+    '''
+    def __init__(self):
+        '''
+        Sets some defaults on a new initted KeyFileCache class.
+        '''
+        self.__lock = threading.Lock()
+        self.__copies = {}
+
+    def get(self, filename):
+        '''
+        Returns the path of the copy of a key file (or None if the key file has correct
+        permissions already, like set_correct_permissions does).
+        '''
+        keyfile = os.path.expanduser(filename)
+        realkeyfile = os.path.realpath(keyfile)
+        keyfilestat = os.stat(realkeyfile)
+        signature = (realkeyfile, keyfilestat.st_dev, keyfilestat.st_ino,
+                     keyfilestat.st_mtime_ns, keyfilestat.st_size, keyfilestat.st_mode)
+        with self.__lock:
+            try:
+                cached_signature, newkeyfile = self.__copies[keyfile]
+                if cached_signature == signature and \
+                        (newkeyfile is None or os.path.exists(newkeyfile)):
+                    return newkeyfile
+                logging.info('Key file %s has changed', keyfile)
+                del self.__copies[keyfile]
+                if newkeyfile and os.path.exists(newkeyfile):
+                    clean_key_file(newkeyfile)
+            except KeyError:
+                pass
+            newkeyfile = set_correct_permissions(realkeyfile)
+            self.__copies[keyfile] = (signature, newkeyfile)
+            return newkeyfile
+
+    def clean(self):
+        '''
+        Cleans all copies of key files.
+        '''
+        with self.__lock:
+            for _signature, newkeyfile in self.__copies.values():
+                if newkeyfile and os.path.exists(newkeyfile):
+                    clean_key_file(newkeyfile)
+            self.__copies = {}
+
+
+KEY_FILE_CACHE = KeyFileCache()
+atexit.register(KEY_FILE_CACHE.clean)
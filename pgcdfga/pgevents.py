@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+
+# Copyright 2019 Bol.com
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''
+Module that installs event triggers in managed databases, and waits for the notifications
+they send (with LISTEN), so that drift is reconciled right after DDL instead of after the
+next rundelay.
+
+=== Authors
+Sebastiaan Mannem <smannem@bol.com>
+Jing Rao <jrao@bol.com>
+'''
+
+import time
+import select
+import logging
+import psycopg2
+from psycopg2 import sql
+from pgcdfga.configloader import DEBOUNCE_DELAY
+from pgcdfga.metrics import DDL_NOTIFICATIONS
+
+NOTIFY_CHANNEL = 'pgcdfga_ddl'
+EVENT_TRIGGER = 'pgcdfga_ddl'
+# Event trigger functions can not be written in sql, so strictify must not drop this extension
+EVENT_TRIGGER_LANGUAGE = 'plpgsql'
+
+# After a notification, wait this long (in seconds) for more notifications (a storm of DDL),
+# but never longer than MAX_NOTIFY_DELAY after the first one.
+NOTIFY_DEBOUNCE = 1.0
+MAX_NOTIFY_DELAY = 10.0
+
+# Sends the tag of every DDL command (e.a. 'CREATE TABLE' or 'GRANT') to NOTIFY_CHANNEL
+NOTIFY_FUNCTION = sql.SQL("CREATE OR REPLACE FUNCTION public.{}() RETURNS event_trigger \
+                           LANGUAGE {} AS $$ BEGIN PERFORM pg_notify({}, tg_tag); END $$")
+
+
+def install_event_trigger(pgconn, database):
+    '''
+    Install the event trigger (and its function) that notifies NOTIFY_CHANNEL at the end of
+    every DDL command in a database, unless it is there already. This requires superuser.
+    Roles and databases are shared objects, which do not fire event triggers, so changes of
+    those are still only noticed on the next run.
+    '''
+    query = 'SELECT evtname FROM pg_event_trigger WHERE evtname = $1'
+    if pgconn.run_prepared(query, [EVENT_TRIGGER], database):
+        return False
+    function = sql.Identifier(EVENT_TRIGGER)
+    pgconn.run_ddl(NOTIFY_FUNCTION.format(function, sql.Identifier(EVENT_TRIGGER_LANGUAGE),
+                                          sql.Literal(NOTIFY_CHANNEL)), database=database)
+    query = sql.SQL("CREATE EVENT TRIGGER {} ON ddl_command_end EXECUTE PROCEDURE public.{}()")
+    pgconn.run_ddl(query.format(sql.Identifier(EVENT_TRIGGER), function), database=database)
+    logging.info("Installed event trigger %s in database %s", EVENT_TRIGGER, database)
+    return True
+
+
+class DDLListener():
+    '''
+    This class keeps a connection that LISTENs on NOTIFY_CHANNEL per watched database
+    (notifications only reach listeners of the same database), and waits on their sockets.
+    Notifications are debounced and coalesced into the set of databases that changed.
+    '''
+    def __init__(self, connect):
+        '''
+        Sets some defaults on a new initted DDLListener class.
+        connect is a callable that returns a new connection (in autocommit) to a database.
+        '''
+        self.__connect = connect
+        self.__connections = {}
+        self.debounce = NOTIFY_DEBOUNCE
+        self.max_delay = MAX_NOTIFY_DELAY
+
+    def watch(self, pgconn, databases):
+        '''
+        Install the event trigger in, and listen to, every database in databases (and stop
+        listening to databases that are not in there anymore).
+        A database where that fails is logged and tried again on the next call.
+        '''
+        for database in set(self.__connections) - set(databases):
+            self.__close(database)
+        for database in sorted(set(databases) - set(self.__connections)):
+            try:
+                install_event_trigger(pgconn, database)
+                conn = self.__connect(database)
+                cur = conn.cursor()
+                cur.execute(sql.SQL('LISTEN {}').format(sql.Identifier(NOTIFY_CHANNEL)))
+                cur.close()
+                self.__connections[database] = conn
+            except psycopg2.Error as error:
+                logging.warning('Cannot listen to DDL in database %s: %s', database,
+                                str(error).strip())
+
+    def databases(self):
+        '''
+        Returns the databases that are listened to.
+        '''
+        return set(self.__connections)
+
+    def wait(self, delay, ignore_pids=(), loader=None):
+        '''
+        Sleeps for delay seconds, or less when DDL is notified, and returns the databases
+        where DDL was notified (an empty set after delay seconds without notifications).
+        Notifications sent by the backends in ignore_pids (the own connections) are ignored.
+        When a ConfigLoader is given, this also returns early when the config file changes.
+        '''
+        changed = wait_for_ddl({None: self}, delay, {None: ignore_pids}, loader)
+        return changed.get(None, set())
+
+    def sockets(self):
+        '''
+        Returns the databases that are listened to per file descriptor (to wait on).
+        '''
+        return {conn.fileno(): database for database, conn in self.__connections.items()}
+
+    def notified(self, database, ignore_pids=()):
+        '''
+        Read the notifications of a database, and return True if any of them where sent by
+        another process. A connection that is broken (e.a. the database was dropped) is
+        closed, and opened again by the next call to watch.
+        '''
+        conn = self.__connections[database]
+        try:
+            conn.poll()
+        except psycopg2.Error as error:
+            logging.warning('Stopped listening to DDL in database %s: %s', database,
+                            str(error).strip())
+            self.__close(database)
+            return False
+        notified = False
+        for notify in conn.notifies:
+            if notify.pid in ignore_pids:
+                DDL_NOTIFICATIONS.inc(source='self')
+                continue
+            DDL_NOTIFICATIONS.inc(source='other')
+            logging.debug('DDL in database %s: %s', database, notify.payload)
+            notified = True
+        conn.notifies.clear()
+        return notified
+
+    def __close(self, database):
+        '''
+        Stop listening to a database.
+        '''
+        conn = self.__connections.pop(database)
+        try:
+            conn.close()
+        except Exception as error:
+            logging.debug('Could not close connection to database %s: %s', database, error)
+
+    def close(self):
+        '''
+        Stop listening to all databases.
+        '''
+        for database in list(self.__connections):
+            self.__close(database)
+
+
+def wait_for_ddl(listeners, delay, ignore_pids=None, loader=None):
+    '''
+    Sleeps for delay seconds, or less when DDL is notified to one of the listeners (a dict of
+    DDLListeners, e.a. one per cluster), and returns the databases where DDL was notified per
+    key of listeners (an empty dict after delay seconds without notifications).
+    Notifications are debounced (see DDLListener.debounce and DDLListener.max_delay).
+    ignore_pids holds the backend pids of the own connections per key of listeners.
+    When a ConfigLoader is given, this also returns early when the config file changes.
+    '''
+    ignore_pids = ignore_pids or {}
+    debounce = min(listener.debounce for listener in listeners.values())
+    max_delay = min(listener.max_delay for listener in listeners.values())
+    deadline = time.monotonic() + delay
+    changed = {}
+    first = quiet_since = None
+    while True:
+        if changed:
+            deadline = min(quiet_since + debounce, first + max_delay)
+        timeout = deadline - time.monotonic()
+        if timeout <= 0:
+            return changed
+        sockets = {}
+        for key, listener in listeners.items():
+            for fd, database in listener.sockets().items():
+                sockets[fd] = key, database
+        watched = list(sockets)
+        config_fd = loader.fileno() if loader else None
+        if config_fd is not None:
+            watched.append(config_fd)
+        readable = select.select(watched, [], [], timeout)[0]
+        now = time.monotonic()
+        for key, database in [sockets[fd] for fd in readable if fd in sockets]:
+            if listeners[key].notified(database, ignore_pids.get(key, ())):
+                changed.setdefault(key, set()).add(database)
+                first = first or now
+                quiet_since = now
+        if config_fd in readable and loader.wait(DEBOUNCE_DELAY):
+            return changed
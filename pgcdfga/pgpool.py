@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+
+# Copyright 2019 Bol.com
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''
+Module that holds a bounded pool of postgres connections (one per database).
+
+=== Authors
+Sebastiaan Mannem <smannem@bol.com>
+Jing Rao <jrao@bol.com>
+'''
+
+import logging
+import threading
+from collections import OrderedDict
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE, TRANSACTION_STATUS_UNKNOWN
+
+DEFAULT_MAX_CONNECTIONS = 10
+
+
+class PGConnectionPool():
+    '''
+    This class keeps at most max_connections connections open (one per database).
+    When a connection to another database is needed, the least recently used connection
+    that is not in use (and not in a transaction) is closed.
+    If all connections are in use, the limit is exceeded temporarily rather than waiting.
+    '''
+    def __init__(self, connect, max_connections=DEFAULT_MAX_CONNECTIONS):
+        '''
+        Sets some defaults on a new initted PGConnectionPool class.
+        connect is a callable that returns a new connection to a database.
+        '''
+        self.__connect = connect
+        self.max_connections = max_connections
+        self.__connections = OrderedDict()
+        self.__in_use = {}
+        self.__lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'invalidated': 0}
+
+    def acquire(self, database):
+        '''
+        Return a (validated) connection to a database, and mark it as in use until release.
+        '''
+        with self.__lock:
+            self.__in_use[database] = self.__in_use.get(database, 0) + 1
+            conn = self.__connections.get(database)
+            if conn is not None:
+                if is_valid(conn):
+                    self.stats['hits'] += 1
+                    self.__connections.move_to_end(database)
+                    return conn
+                logging.debug('Connection to database %s is not valid anymore', database)
+                self.stats['invalidated'] += 1
+                self.__close(database)
+            self.stats['misses'] += 1
+            self.__evict()
+        try:
+            conn = self.__connect(database)
+        except Exception:
+            self.release(database)
+            raise
+        with self.__lock:
+            existing = self.__connections.get(database)
+            if existing is not None and is_valid(existing):
+                # Another thread connected to the same database in the mean time
+                conn.close()
+                return existing
+            self.__connections[database] = conn
+        return conn
+
+    def release(self, database):
+        '''
+        Mark a connection that was returned by acquire as not in use anymore.
+        '''
+        with self.__lock:
+            self.__in_use[database] -= 1
+
+    def __evict(self):
+        '''
+        Close least recently used connections until there is room for a new connection.
+        '''
+        for database in list(self.__connections):
+            if len(self.__connections) < self.max_connections:
+                return
+            if self.__in_use.get(database, 0) > 0:
+                continue
+            if self.__connections[database].get_transaction_status() != \
+                    TRANSACTION_STATUS_IDLE:
+                continue
+            logging.debug('Closing least recently used connection to database %s', database)
+            self.stats['evictions'] += 1
+            self.__close(database)
+        if len(self.__connections) >= self.max_connections:
+            logging.debug('All %d connections are in use. Exceeding max_connections.',
+                          len(self.__connections))
+
+    def __close(self, database):
+        '''
+        Close and forget the connection to a database.
+        '''
+        conn = self.__connections.pop(database)
+        try:
+            conn.close()
+        except Exception as error:
+            logging.debug('Could not close connection to database %s: %s', database, error)
+
+    def close(self):
+        '''
+        Close all connections in the pool.
+        '''
+        with self.__lock:
+            for database in list(self.__connections):
+                self.__close(database)
+
+    def backend_pids(self):
+        '''
+        Returns the backend pids of the open connections (without a round trip).
+        '''
+        with self.__lock:
+            return {conn.get_backend_pid() for conn in self.__connections.values()
+                    if not conn.closed}
+
+    def __len__(self):
+        '''
+        Returns the number of open connections.
+        '''
+        return len(self.__connections)
+
+
+def is_valid(conn):
+    '''
+    Check (without a round trip) if a connection can still be used.
+    '''
+    return not conn.closed and conn.get_transaction_status() != TRANSACTION_STATUS_UNKNOWN
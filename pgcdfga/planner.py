@@ -0,0 +1,368 @@
+#!/usr/bin/env python
+
+# Copyright 2019 Bol.com
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''
+Module that compares the desired state (from config and ldap) with the actual state of a
+postgres cluster (from a catalog snapshot) and plans the operations to get from one to the
+other. The plan can be printed (dry run) or applied on a PGConnection.
+
+=== Authors
+Sebastiaan Mannem <smannem@bol.com>
+Jing Rao <jrao@bol.com>
+'''
+
+import logging
+from collections import namedtuple, OrderedDict
+from pgcdfga.pgconnection import VALID_ROLE_OPTIONS, PROTECTED_ROLES, PROTECTED_DBS, \
+    redact, is_system_role
+from pgcdfga.logcontext import worker_pool
+from pgcdfga.passwords import DEFAULT_PASSWORD_ENCRYPTION, password_is_current, \
+    password_verifiers
+from pgcdfga.metrics import OPERATION_SECONDS
+from pgcdfga.profiler import timed_phase
+
+# Phases are applied in this order. All operations of a phase run before the next phase.
+PHASES = ['roles', 'passwords', 'grants', 'databases', 'extensions', 'replication_slots',
+          'drops', 'strictify']
+
+# An operation is a call of a PGConnection method (with args).
+# The chapter is the strict chapter (users, databases, extensions) that is disabled when the
+# operation fails. Operations in the strictify phase are skipped for a disabled chapter.
+# The database is set for operations that run inside a specific database.
+Operation = namedtuple('Operation', ['phase', 'chapter', 'method', 'args', 'database'])
+
+
+class DesiredState():
+    '''
+    This class holds the desired state of a postgres cluster, compiled from config and ldap.
+    '''
+    def __init__(self):
+        '''
+        Sets some defaults on a new initted (and empty) DesiredState class.
+        '''
+        self.roles = {}
+        self.passwords = {}
+        self.password_resets = set()
+        self.grants = set()
+        self.absent_roles = set()
+        self.databases = {}
+        self.default_privileges = set()
+        self.absent_databases = set()
+        self.extensions = {}
+        self.absent_extensions = {}
+        self.replication_slots = None
+
+    def add_role(self, rolename, options=None):
+        '''
+        Add a role with (additional) role options to the desired state.
+        '''
+        self.roles.setdefault(rolename, set()).update(option.upper() for option in options or [])
+
+    def add_grant(self, username, rolename):
+        '''
+        Add a role grant to the desired state. Both roles are added too.
+        '''
+        self.add_role(rolename)
+        self.add_role(username)
+        self.grants.add((username, rolename))
+
+    def add_database(self, dbname, ownername=None, default_privileges=False):
+        '''
+        Add a database with its owner, readonly role and default grants to the desired state.
+        With default_privileges, future tables of the owner are granted to the readonly role.
+        '''
+        ownername = ownername or dbname
+        self.databases[dbname] = ownername
+        if default_privileges:
+            self.default_privileges.add(dbname)
+        self.extensions.setdefault(dbname, {})
+        # opex role has full permissions on every user database
+        self.add_grant('opex', ownername)
+        self.add_grant('readonly', '{}_readonly'.format(dbname))
+
+    def grantees(self, rolename):
+        '''
+        Return all users that should be granted a role.
+        '''
+        return {username for username, granted in self.grants if granted == rolename}
+
+    def resolve_conflicts(self):
+        '''
+        Roles that are explicitly absent are not created (and not granted) at all.
+        '''
+        for rolename in self.absent_roles:
+            self.roles.pop(rolename, None)
+            self.passwords.pop(rolename, None)
+            self.password_resets.discard(rolename)
+        self.grants = {(username, rolename) for username, rolename in self.grants
+                       if username in self.roles and rolename in self.roles}
+
+
+def role_is_drifted(catalog, rolename, options):
+    '''
+    Check if a role does not exist, or misses one of its options.
+    '''
+    if not catalog.role_exists(rolename):
+        return True
+    for option in options:
+        try:
+            if not catalog.role_has_option(rolename, VALID_ROLE_OPTIONS[option]):
+                return True
+        except KeyError:
+            # Invalid option. Let createrole raise on it.
+            return True
+    return False
+
+
+def plan_roles(desired, catalog, parallelism=1, password_encryption=DEFAULT_PASSWORD_ENCRYPTION):
+    '''
+    Plan creating roles and setting role options, passwords and grants, and dropping roles.
+    Roles are dropped with one operation, which processes up to parallelism databases at a time.
+    Passwords are checked against the stored verifiers, and only the passwords that changed
+    (or are stored with another encryption than password_encryption) get a new verifier.
+    '''
+    operations = []
+    # New roles are granted roles that exist already in the same statement (CREATE ROLE IN ROLE)
+    granted_on_create = set()
+    for rolename in sorted(desired.roles):
+        options = sorted(desired.roles[rolename])
+        if not catalog.role_exists(rolename):
+            memberof = sorted(granted for username, granted in desired.grants
+                              if username == rolename and catalog.role_exists(granted))
+            granted_on_create |= {(rolename, granted) for granted in memberof}
+            args = (rolename, options, memberof) if memberof else (rolename, options)
+            operations.append(Operation('roles', 'users', 'createrole', args, None))
+        elif role_is_drifted(catalog, rolename, options):
+            operations.append(Operation('roles', 'users', 'createrole', (rolename, options), None))
+    changed = {username: password for username, password in desired.passwords.items()
+               if not catalog.role_exists(username) or
+               not password_is_current(username, password, catalog.password(username)[1],
+                                       password_encryption)}
+    for username, verifier in sorted(password_verifiers(changed, password_encryption).items()):
+        operations.append(Operation('passwords', 'users', 'setpassword', (username, verifier),
+                                    None))
+    for username in sorted(desired.password_resets):
+        if username != catalog.current_user and catalog.password(username)[1] is not None:
+            operations.append(Operation('passwords', 'users', 'resetpassword', (username,),
+                                        None))
+    for username, rolename in sorted(desired.grants - granted_on_create):
+        if not catalog.is_member(username, rolename):
+            operations.append(Operation('grants', 'users', 'grantrole', (username, rolename),
+                                        None))
+    absent_roles = tuple(rolename for rolename in sorted(desired.absent_roles)
+                         if catalog.role_exists(rolename, exclude_current_user=True))
+    if absent_roles:
+        operations.append(Operation('drops', 'users', 'droproles', (absent_roles, parallelism),
+                                    None))
+    return operations
+
+
+def prefetch_extensions(pgconn, dbnames, parallelism=1):
+    '''
+    Load the extensions of all databases into the catalog snapshot, with one worker (and one
+    connection) per database, up to parallelism databases at a time.
+    '''
+    catalog = pgconn.catalog
+    dbnames = [dbname for dbname in dbnames if dbname not in catalog.extensions]
+    if parallelism < 2 or len(dbnames) < 2:
+        for dbname in dbnames:
+            catalog.load_extensions(dbname, pgconn.run_prepared)
+        return
+    with worker_pool(parallelism) as pool:
+        for _extensions in pool.map(
+                lambda dbname: catalog.load_extensions(dbname, pgconn.run_prepared), dbnames):
+            pass
+
+
+def plan_databases(desired, pgconn, parallelism=1):
+    '''
+    Plan creating and dropping databases and extensions, and readonly grants in databases.
+    '''
+    catalog = pgconn.catalog
+    operations = []
+    prefetch_extensions(pgconn, sorted(desired.databases), parallelism)
+    for dbname in sorted(desired.absent_databases):
+        if dbname in catalog.databases:
+            operations.append(Operation('databases', 'databases', 'dropdb', (dbname,), None))
+    for dbname in sorted(desired.databases):
+        ownername = desired.databases[dbname]
+        default_privileges = (True, ) if dbname in desired.default_privileges else ()
+        if catalog.databases.get(dbname) != ownername:
+            operations.append(Operation('databases', 'databases', 'createdb',
+                                        (dbname, ownername) + default_privileges, None))
+        else:
+            operations.append(Operation('databases', 'databases', 'grantreadonly',
+                                        (dbname, ) + default_privileges, dbname))
+    for dbname in sorted(desired.databases):
+        extensions = catalog.load_extensions(dbname, pgconn.run_prepared)
+        for extname in sorted(desired.absent_extensions.get(dbname, ())):
+            if extname in extensions:
+                operations.append(Operation('extensions', 'extensions', 'dropextension',
+                                            (extname, dbname), dbname))
+        for extname, (schemaname, version) in sorted(desired.extensions[dbname].items()):
+            if extname not in extensions or \
+                    (version and extensions[extname] != str(version)):
+                operations.append(Operation('extensions', 'extensions', 'createextension',
+                                            (extname, dbname, schemaname, version), dbname))
+    return operations
+
+
+def plan_replication_slots(desired, pgconn):
+    '''
+    Plan creating and dropping replication slots.
+    '''
+    operations = []
+    if desired.replication_slots is None:
+        return operations
+    existing = set(pgconn.replication_slots())
+    for slot_name in desired.replication_slots:
+        if slot_name not in existing:
+            operations.append(Operation('replication_slots', None, 'create_replication_slot',
+                                        (slot_name,), None))
+    for slot_name in sorted(existing - set(desired.replication_slots)):
+        operations.append(Operation('replication_slots', None, 'drop_replication_slot',
+                                    (slot_name,), None))
+    return operations
+
+
+def plan_strictify(desired, pgconn, parallelism=1):
+    '''
+    Plan revoking grants and dropping roles, databases and extensions that are not managed.
+    '''
+    catalog = pgconn.catalog
+    operations = []
+    if pgconn.strict_option('users'):
+        all_managed_roles = set(PROTECTED_ROLES) | set(desired.roles)
+        for rolename in sorted(desired.roles):
+            overgranted = catalog.grantees(rolename) - desired.grantees(rolename)
+            if overgranted:
+                operations.append(Operation('strictify', 'users', 'revokeroles',
+                                            (rolename, tuple(sorted(overgranted))), None))
+        unmanaged_roles = tuple(sorted(rolename for rolename in set(catalog.roles) -
+                                       all_managed_roles - desired.absent_roles -
+                                       {catalog.current_user}
+                                       if not is_system_role(rolename)))
+        if unmanaged_roles:
+            operations.append(Operation('strictify', 'users', 'droproles',
+                                        (unmanaged_roles, parallelism), None))
+    if pgconn.strict_option('databases'):
+        managed_dbs = set(PROTECTED_DBS) | set(desired.databases) | desired.absent_databases
+        for dbname in sorted(set(catalog.databases) - managed_dbs):
+            operations.append(Operation('strictify', 'databases', 'dropdb', (dbname,), None))
+    if pgconn.strict_option('extensions'):
+        for dbname in sorted(desired.databases):
+            extensions = catalog.load_extensions(dbname, pgconn.run_prepared)
+            unmanaged = set(extensions) - set(desired.extensions[dbname]) - \
+                desired.absent_extensions.get(dbname, set())
+            for extname in sorted(unmanaged):
+                operations.append(Operation('strictify', 'extensions', 'dropextension',
+                                            (extname, dbname), dbname))
+    return operations
+
+
+def plan(desired, pgconn, parallelism=1):
+    '''
+    Compare the desired state with the catalog snapshot of pgconn and return the list of
+    operations (in order of PHASES) that brings the cluster in the desired state.
+    The extensions of up to parallelism databases are read concurrently.
+    '''
+    if not pgconn.catalog:
+        pgconn.load_catalog()
+    desired.resolve_conflicts()
+    operations = plan_roles(desired, pgconn.catalog, parallelism, pgconn.password_encryption)
+    operations += plan_databases(desired, pgconn, parallelism)
+    operations += plan_replication_slots(desired, pgconn)
+    operations += plan_strictify(desired, pgconn, parallelism)
+    operations.sort(key=lambda operation: PHASES.index(operation.phase))
+    return operations
+
+
+def describe(operation):
+    '''
+    Return a human readable description of an operation (without exposing passwords).
+    '''
+    args = operation.args
+    if operation.method == 'setpassword':
+        args = (args[0], '********')
+    return '{}: {}({})'.format(operation.phase, operation.method,
+                               ', '.join(repr(arg) for arg in args))
+
+
+def apply(pgconn, operations, batch_size=0, parallelism=1):
+    '''
+    Apply a list of operations on a PGConnection, and return the number of failed operations.
+    A failed operation disables its strict chapter, so that the strictify phase doesn't
+    remove objects based on an incomplete picture.
+    With a batch_size > 1, the DDL of every phase is sent in batches (see
+    PGConnection.start_batch). Failures in a batch count as errors of that phase.
+    With a parallelism > 1, operations that run inside a specific database are run by a pool
+    of workers, one database per worker. Cluster wide operations always run serialized.
+    '''
+    errorcount = 0
+    for phase in PHASES:
+        phase_operations = [operation for operation in operations if operation.phase == phase]
+        if not phase_operations:
+            continue
+        cluster_operations = [operation for operation in phase_operations
+                              if operation.database is None]
+        database_operations = OrderedDict()
+        for operation in phase_operations:
+            if operation.database is not None:
+                database_operations.setdefault(operation.database, []).append(operation)
+
+        with timed_phase(phase):
+            errorcount += apply_operations(pgconn, cluster_operations, batch_size)
+            if parallelism > 1 and len(database_operations) > 1:
+                with worker_pool(parallelism) as pool:
+                    errorcount += sum(pool.map(lambda ops: apply_operations(pgconn, ops,
+                                                                            batch_size),
+                                               database_operations.values()))
+            else:
+                for ops in database_operations.values():
+                    errorcount += apply_operations(pgconn, ops, batch_size)
+    return errorcount
+
+
+def apply_operations(pgconn, operations, batch_size=0):
+    '''
+    Apply operations (of one phase) in the calling thread and return the number of errors.
+    '''
+    errorcount = 0
+    if not operations:
+        return errorcount
+    if batch_size > 1:
+        pgconn.start_batch(batch_size)
+    try:
+        for operation in operations:
+            if operation.phase == 'strictify' and not pgconn.strict_option(operation.chapter):
+                logging.debug('Skipping %s (config/strict/%s is not True)', describe(operation),
+                              operation.chapter)
+                continue
+            logging.debug('Applying %s', describe(operation))
+            try:
+                with OPERATION_SECONDS.time(method=operation.method):
+                    getattr(pgconn, operation.method)(*operation.args)
+            except Exception as error:
+                if operation.chapter:
+                    pgconn.strict_params[operation.chapter] = False
+                logging.error(redact(str(error)))
+                errorcount += 1
+    finally:
+        batch_errors = pgconn.stop_batch() if batch_size > 1 else 0
+    if batch_errors:
+        for chapter in {operation.chapter for operation in operations if operation.chapter}:
+            pgconn.strict_params[chapter] = False
+    return errorcount + batch_errors
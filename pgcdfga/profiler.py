@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+
+# Copyright 2019 Bol.com
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''
+Module that profiles the phases of a run with cProfile (when enabled with --profile), and
+writes a pstats file per phase and collapsed stacks (for flamegraph tools) per run.
+
+=== Authors
+Sebastiaan Mannem <smannem@bol.com>
+Jing Rao <jrao@bol.com>
+'''
+
+import os
+import logging
+import cProfile
+import pstats
+import threading
+from contextlib import contextmanager
+from pgcdfga.metrics import PHASE_SECONDS
+
+# Paths through the call graph deeper than this are cut off in collapsed stacks
+MAX_STACK_DEPTH = 100
+
+# Paths through the call graph that took less than this (in seconds) are left out
+MIN_STACK_TIME = 0.000001
+
+
+def frame_label(func):
+    '''
+    Returns a label for a function in the stats of cProfile, e.a. 'pgconnection.py:192:run_sql'.
+    '''
+    filename, lineno, funcname = func
+    if filename == '~':
+        # Built in functions, e.a. <method 'execute' of 'psycopg2.extensions.cursor' objects>
+        return funcname
+    return '{}:{}:{}'.format(os.path.basename(filename), lineno, funcname)
+
+
+def collapsed_stacks(stats, root=None):
+    '''
+    Returns a dict of {collapsed stack: microseconds} from the stats of cProfile
+    (pstats.Stats(...).stats). A collapsed stack is a ; separated list of frames, root first.
+    cProfile only records callers and callees, not full stacks. Time of a function that is
+    called from multiple places is divided over those places in proportion to the time spent
+    when called from there. Recursion is left out of the stacks.
+    '''
+    callees = {}
+    for func, (_, _, _, _, callers) in stats.items():
+        for caller, (_, _, _, cumulative) in callers.items():
+            callees.setdefault(caller, []).append((func, cumulative))
+    stacks = {}
+
+    def walk(func, stack, share, on_stack):
+        '''
+        Adds the own time of func (share is the fraction of its time spent on this path)
+        to the stack, and walks its callees.
+        '''
+        _, _, own_time, _, _ = stats[func]
+        stack = stack + [frame_label(func)]
+        microseconds = int(own_time * share * 1000000)
+        if microseconds:
+            key = ';'.join(stack)
+            stacks[key] = stacks.get(key, 0) + microseconds
+        if len(stack) >= MAX_STACK_DEPTH:
+            return
+        for callee, callee_time in callees.get(func, []):
+            callee_total = stats[callee][3]
+            if callee in on_stack or not callee_total or callee_time * share < MIN_STACK_TIME:
+                continue
+            walk(callee, stack, share * min(1.0, callee_time / callee_total),
+                 on_stack | {callee})
+    roots = [func for func, (_, _, _, _, callers) in stats.items() if not callers]
+    for func in sorted(roots):
+        walk(func, [root] if root else [], 1.0, {func})
+    return stacks
+
+
+class Profiler():
+    '''
+    This class profiles phases of a run with cProfile. A run is only profiled when profiling
+    is enabled (with a directory to write to), and then only every every'th run, so that
+    a daemon can be profiled without slowing down every run.
+    Phases are profiled in the thread that runs them. Work done by worker threads (with
+    parallelism > 1) shows up as waiting for those threads.
+    '''
+    def __init__(self, directory=None, every=1):
+        '''
+        Sets some defaults on a new initted Profiler class.
+        '''
+        self.directory = directory
+        self.every = max(1, every)
+        self.runs = 0
+        self.__profiles = None
+        self.__local = threading.local()
+
+    def start_run(self):
+        '''
+        Starts a new run, which is profiled if profiling is enabled and it is an every'th run.
+        Returns True if this run is profiled.
+        '''
+        self.runs += 1
+        if self.directory and (self.runs - 1) % self.every == 0:
+            self.__profiles = {}
+        else:
+            self.__profiles = None
+        return self.__profiles is not None
+
+    @contextmanager
+    def profile(self, phase):
+        '''
+        Context manager that profiles the block as (part of) a phase of a profiled run.
+        A phase that is entered within another phase is profiled as part of the outer phase.
+        '''
+        profiles = self.__profiles
+        if profiles is None or getattr(self.__local, 'active', False):
+            yield
+            return
+        profile = profiles.setdefault(phase, cProfile.Profile())
+        self.__local.active = True
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            self.__local.active = False
+
+    def finish_run(self):
+        '''
+        Writes a pstats file per phase, and one file with the collapsed stacks of all phases
+        (with the phase as root frame) of a profiled run. Returns the names of all files.
+        '''
+        profiles, self.__profiles = self.__profiles, None
+        if not profiles:
+            return []
+        os.makedirs(self.directory, exist_ok=True)
+        prefix = os.path.join(self.directory, 'pgcdfga-{0:05}'.format(self.runs))
+        filenames = []
+        stacks = {}
+        for phase, profile in profiles.items():
+            stats = pstats.Stats(profile)
+            filename = '{}-{}.pstats'.format(prefix, phase)
+            stats.dump_stats(filename)
+            filenames.append(filename)
+            stacks.update(collapsed_stacks(stats.stats, phase))
+        filename = prefix + '.folded'
+        with open(filename, 'w') as foldedfile:
+            for stack, microseconds in sorted(stacks.items()):
+                foldedfile.write('{} {}\n'.format(stack, microseconds))
+        filenames.append(filename)
+        logging.info('Wrote profile of run %d to %s', self.runs, ', '.join(filenames))
+        return filenames
+
+
+PROFILER = Profiler()
+
+
+@contextmanager
+def timed_phase(name):
+    '''
+    Context manager that times a phase of a run (see PHASE_SECONDS), and profiles it when
+    the run is profiled (see PROFILER).
+    '''
+    with PHASE_SECONDS.time(phase=name), PROFILER.profile(name):
+        yield
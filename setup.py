@@ -49,6 +49,10 @@ setup(
     version=find_version(),
     packages=find_packages(exclude=['contrib', 'docs', 'tests']),
     install_requires=INSTALL_REQUIREMENTS,
+    extras_require={
+        # Reload the config as soon as it changes, instead of after rundelay
+        'inotify': ['inotify_simple'],
+    },
     entry_points={
         'console_scripts': [
             'pgcdfga=pgcdfga.pgcdfga:main',
@@ -0,0 +1,1061 @@
+#!/usr/bin/env python3
+
+# Copyright 2019 Bol.com
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''
+This module holds a benchmark harness that runs proces_fga at synthetic scale.
+
+It generates a config (with the ldap groups for a MOCK_SYNC ldap directory), runs proces_fga
+against an in-memory fake postgres cluster, and reports wall time, round trips, ldap searches
+and peak memory per phase. test_benchmark fails on regressions against the baselines in
+benchmark_baselines.json. After an intended change, save new baselines with:
+
+    python -m tests.benchmark --scale small --save
+'''
+import asyncio
+import collections
+import gc
+import itertools
+import json
+import logging
+import os
+import random
+import re
+import select
+import threading
+import time
+import tracemalloc
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import partial, wraps
+from unittest.mock import patch
+import ldap3
+import psycopg2
+from psycopg2 import sql
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE, POLL_OK, POLL_READ
+from pgcdfga import pgcdfga
+from pgcdfga.aioengine import AsyncPGConnection
+from pgcdfga.fingerprint import ChangeDetector
+from pgcdfga.ldapconnection import LDAPConnection
+from pgcdfga.pgcatalog import PGCatalog, ROLE_ATTRIBUTES, ROLES_QUERY, MEMBERS_QUERY, \
+    PASSWORDS_QUERY, DATABASES_QUERY, EXTENSIONS_QUERY, CLUSTER_FINGERPRINT_QUERY, \
+    DATABASE_FINGERPRINT_QUERY
+from pgcdfga.pgconnection import PGConnection, VALID_ROLE_OPTIONS, PROTECTED_DBS
+
+SCALES = {'small': {'users': 200, 'groups': 20, 'databases': 10, 'extensions': 5},
+          'medium': {'users': 2000, 'groups': 200, 'databases': 100, 'extensions': 20},
+          'full': {'users': 10000, 'groups': 1000, 'databases': 500, 'extensions': 50}}
+
+BASEDN = 'OU=bench,DC=example,DC=com'
+
+BASELINES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              'benchmark_baselines.json')
+
+METRICS = ['wall_time', 'round_trips', 'ldap_searches', 'peak_memory']
+
+# A metric regresses when it is more than baseline * factor + slack
+TOLERANCES = {'wall_time': (3.0, 0.1), 'round_trips': (1.0, 0), 'ldap_searches': (1.0, 0),
+              'peak_memory': (1.5, 1 << 20)}
+
+# Metrics that are counted are the same on every machine, and are checked by default.
+# Measured metrics depend on the machine (and its load), and are only checked on request.
+COUNTED_METRICS = ['round_trips', 'ldap_searches']
+MEASURED_METRICS = ['wall_time', 'peak_memory']
+
+# Functions (of the pgcdfga module, unless a class is given) that implement the phases
+PHASES = [('config', pgcdfga, 'compile_config'), ('fingerprint', pgcdfga, 'run_fingerprint'),
+          ('catalog', PGConnection, 'load_catalog'), ('users', pgcdfga, 'compile_users'),
+          ('plan', pgcdfga, 'plan'), ('apply', pgcdfga, 'apply')]
+
+# Schemas (with tables) in every database that is created
+TABLE_SCHEMAS = ['public', 'app']
+
+ROLE_OPTIONS = {option.strip(): expression for option, expression in VALID_ROLE_OPTIONS.items()}
+
+IDENT = r'"((?:[^"]|"")*)"'
+IDENTS = r'((?:"(?:[^"]|"")*"(?:, )?)+)'
+
+
+def generate_config(users=200, groups=20, databases=10, extensions=5, seed=0):
+    '''
+    Returns config data (with ldap mockdata) at a synthetic scale.
+    Every user is a member of 1 to 3 ldap groups, every ldap group is a config user (with auth
+    ldap-group) that is granted 2 database owners, and every database has up to 3 extensions.
+    '''
+    rand = random.Random(seed)
+    dbnames = ['db{0:04}'.format(index) for index in range(databases)]
+    extnames = ['ext{0:03}'.format(index) for index in range(extensions)]
+    groupnames = ['team{0:04}'.format(index) for index in range(groups)]
+    members = {groupname: [] for groupname in groupnames}
+    for index in range(users):
+        for groupname in rand.sample(groupnames, min(groups, rand.randint(1, 3))):
+            members[groupname].append('user{0:05}'.format(index))
+    mockdata = {}
+    userconfig = {}
+    for groupname in groupnames:
+        mockdata['cn={},{}'.format(groupname, BASEDN)] = {
+            'objectClass': ['posixGroup'], 'cn': [groupname],
+            'memberUid': members[groupname] or ['dummy']}
+        userconfig[groupname] = {'auth': 'ldap-group',
+                                 'ldapfilter': '(cn={})'.format(groupname),
+                                 'memberof': rand.sample(dbnames, min(databases, 2))}
+    userconfig['backup_user'] = {'auth': 'password', 'password': 'backup',
+                                 'memberof': ['backup']}
+    userconfig['monitor'] = {'auth': 'clientcert', 'memberof': ['pg_monitor']}
+    dbconfig = {}
+    for dbname in dbnames:
+        dbconfig[dbname] = {'default_privileges': rand.random() < 0.5, 'extensions': {
+            extname: {'schema': 'public', 'version': rand.choice([None, '1.0', '1.1'])}
+            for extname in rand.sample(extnames, min(extensions, rand.randint(0, 3)))}}
+    return {'general': {'batch_size': 100, 'parallelism': 4, 'full_run_every': 1000},
+            'strict': {'users': True, 'databases': True, 'extensions': True},
+            'ldap': {'enabled': True, 'servers': ['ldap.example.com'], 'user': 'bench',
+                     'password': 'bench', 'basedn': BASEDN, 'mockdata': mockdata,
+                     'connections': 4},
+            'postgresql': {'dsn': {'host': 'fake', 'user': 'postgres'}},
+            'users': userconfig,
+            'roles': {'dba': {'options': ['SUPERUSER'], 'memberof': ['opex']},
+                      'backup': {'options': ['REPLICATION']}},
+            'databases': dbconfig}
+
+
+PREPARE_PATTERN = re.compile(r'\s*PREPARE (\w+) AS (.*)', re.DOTALL)
+EXECUTE_PATTERN = re.compile(r'\s*EXECUTE (\w+)(?: \((.*)\))?\s*$', re.DOTALL)
+# Arguments of EXECUTE as quote renders them (arrays, strings and other literals)
+ARGUMENT_PATTERN = re.compile(r"ARRAY\[[^\]]*\]|'(?:[^']|'')*'|[^,\s]+")
+
+
+def quote(value):
+    '''
+    Returns a value as a SQL literal (like psycopg2 would send it).
+    '''
+    if value is None:
+        return 'NULL'
+    if isinstance(value, bool):
+        return str(value).lower()
+    if isinstance(value, (int, float)):
+        return str(value)
+    if isinstance(value, (list, tuple)):
+        return 'ARRAY[{}]'.format(', '.join(quote(item) for item in value))
+    return "'{}'".format(str(value).replace("'", "''"))
+
+
+def render(query, parameters=None):
+    '''
+    Returns the text of a query (a string or psycopg2.sql object) with parameters filled in,
+    without the connection that psycopg2 would need for that.
+    '''
+    if isinstance(query, sql.Composed):
+        text = ''.join(render(part) for part in query.seq)
+    elif isinstance(query, sql.SQL):
+        text = query.string
+    elif isinstance(query, sql.Identifier):
+        return '.'.join('"{}"'.format(string.replace('"', '""')) for string in query.strings)
+    elif isinstance(query, sql.Literal):
+        return quote(query.wrapped)
+    else:
+        text = query
+    if parameters is None:
+        return text
+    return text % tuple(quote(parameter) for parameter in parameters)
+
+
+def split_statements(text):
+    '''
+    Returns the (whitespace normalized) statements in a query, split on ; outside of quotes.
+    '''
+    statements = re.findall(r'''(?:[^;'"]|'[^']*'|"[^"]*")+''', text)
+    return [' '.join(statement.split()) for statement in statements if statement.strip()]
+
+
+def identifiers(text):
+    '''
+    Returns the names in a list of quoted identifiers, e.a. '"a", "b"'.
+    '''
+    return [name.replace('""', '"') for name in re.findall(IDENT, text)]
+
+
+class FakeSQLError(psycopg2.ProgrammingError):
+    '''
+    This exception is raised by the fake cluster for statements that would fail in postgres,
+    and for queries that it does not implement.
+    '''
+
+
+class FakeCluster():
+    '''
+    This class is an in-memory fake of a postgres cluster. It answers the queries (and runs
+    the DDL) that PGConnection issues, with a configurable latency per round trip.
+    Roles, memberships, passwords, databases and extensions are kept in a PGCatalog.
+    All statements of one round trip are parsed before any of them is applied, so that a batch
+    with a statement that is not understood fails as a whole.
+    '''
+    def __init__(self, latency=0.0, current_user='postgres'):
+        '''
+        Sets some defaults on a new initted FakeCluster class (with only the current user,
+        the protected databases and no replication slots).
+        '''
+        self.latency = latency
+        self.state = PGCatalog()
+        self.state.current_user = current_user
+        self.state.add_role(current_user)
+        for option in ['SUPERUSER', 'LOGIN']:
+            self.state.set_role_option(current_user, ROLE_OPTIONS[option])
+        for dbname in PROTECTED_DBS:
+            self.state.set_database(dbname, current_user)
+            self.state.extensions[dbname] = {'plpgsql': '1.0'}
+        # {dbname: {schemaname: roles that are granted select on all tables in the schema}}
+        self.schemas = {}
+        self.backend_pids = itertools.count(1000)
+        # {(dbname, owner, grantee)} for ALTER DEFAULT PRIVILEGES
+        self.default_acl = set()
+        self.slots = set()
+        # Stand in for xmin in fingerprints
+        self.changes = 0
+        self.stats = {'round_trips': 0, 'connects': 0}
+        self.__lock = threading.Lock()
+        self.__queries = [(re.compile(pattern + '$'), handler) for pattern, handler in [
+            (r'(BEGIN|COMMIT|ROLLBACK|SAVEPOINT|RELEASE SAVEPOINT)\b.*', self.__noop),
+            (r'SELECT CURRENT_USER AS usename', self.__current_user),
+            (r'SELECT pg_is_in_recovery\(\) AS recovery', self.__recovery),
+            (re.escape(' '.join(ROLES_QUERY.split())) + r"(?: WHERE rolname = '(.*)')?",
+             self.__roles),
+            (re.escape(' '.join(MEMBERS_QUERY.split())), self.__members),
+            (re.escape(' '.join(PASSWORDS_QUERY.split())), self.__passwords),
+            (re.escape(' '.join(DATABASES_QUERY.split())), self.__databases),
+            (r'SELECT datname FROM pg_database', self.__datnames),
+            (re.escape(' '.join(EXTENSIONS_QUERY.split())), self.__extensions),
+            (r'SELECT extname FROM pg_extension', self.__extensions),
+            (re.escape(' '.join(CLUSTER_FINGERPRINT_QUERY.split())),
+             self.__cluster_fingerprint),
+            (re.escape(' '.join(DATABASE_FINGERPRINT_QUERY.split())),
+             self.__database_fingerprint),
+            (r'SELECT DISTINCT n\.nspname AS schemaname .*'
+             r"has_table_privilege\('(.*)', c\.oid, 'SELECT'\)", self.__ungranted_schemas),
+            (r'SELECT db\.datname, o\.rolname AS owner, EXISTS .*'
+             r"WHERE rolname = '(.*)'\)\) AS granted .*", self.__default_privileges),
+            (r'SELECT DISTINCT db\.datname, o\.rolname AS owner, r\.rolname FROM pg_shdepend .*'
+             r'r\.rolname = ANY\(ARRAY\[(.*)\]\)', self.__dependencies),
+            (r'SELECT slot_name FROM pg_replication_slots', self.__slots),
+            (r'SELECT EXISTS \(SELECT 1 FROM pg_replication_slots '
+             r"WHERE slot_name = '(.*)'\)", self.__slot_exists),
+            (r"SELECT pg_create_physical_replication_slot\('(.*)'\)", self.__create_slot),
+            (r"SELECT pg_drop_replication_slot\('(.*)'\)", self.__drop_slot),
+            (r'CREATE ROLE {}(?: WITH ([A-Z ]+?))?(?: IN ROLE {})?'.format(IDENT, IDENTS),
+             self.__create_role),
+            (r'ALTER ROLE {} WITH ([A-Z ]+)'.format(IDENT), self.__alter_role),
+            (r"(?i:alter user) {} (?i:with encrypted password) '(.*)'".format(IDENT),
+             self.__set_password),
+            (r'(?i:alter user) {} (?i:with password null)()'.format(IDENT), self.__set_password),
+            (r'GRANT {0} TO {0}'.format(IDENT), self.__grant_role),
+            (r'REVOKE {} FROM {}'.format(IDENT, IDENTS), self.__revoke_role),
+            (r'DROP ROLE {}'.format(IDENTS), self.__drop_roles),
+            (r'REASSIGN OWNED BY {} TO ({}|CURRENT_USER)'.format(IDENTS, IDENT),
+             self.__reassign_owned),
+            (r'DROP OWNED BY {}'.format(IDENTS), self.__drop_owned),
+            (r'CREATE DATABASE {}'.format(IDENT), self.__create_database),
+            (r'ALTER DATABASE {0} OWNER TO {0}'.format(IDENT), self.__alter_database),
+            (r'DROP DATABASE {}'.format(IDENT), self.__drop_database),
+            (r'CREATE EXTENSION IF NOT EXISTS {0}(?: SCHEMA {0})?(?: VERSION {0})?'.format(
+                IDENT), self.__create_extension),
+            (r'DROP EXTENSION IF EXISTS {}'.format(IDENT), self.__drop_extension),
+            (r'GRANT SELECT ON ALL TABLES IN SCHEMA {0} TO {0}'.format(IDENT),
+             self.__grant_tables),
+            (r'ALTER DEFAULT PRIVILEGES FOR ROLE {0} GRANT SELECT ON TABLES TO {0}'.format(
+                IDENT), self.__alter_default_privileges)]]
+
+    @contextmanager
+    def patched(self):
+        '''
+        Context manager that makes psycopg2.connect connect to this fake cluster.
+        '''
+        with patch('psycopg2.connect', self.connect):
+            yield self
+
+    def connect(self, dsn, async_=False):
+        '''
+        Returns a new FakeConnection to the database in dsn (like psycopg2.connect).
+        '''
+        params = dict(param.split('=', 1) for param in dsn.split())
+        with self.__lock:
+            self.stats['connects'] += 1
+        conn = FakeConnection(self, params.get('dbname', 'postgres'), async_)
+        if async_:
+            conn.wait()
+        else:
+            time.sleep(self.latency)
+        return conn
+
+    def execute(self, database, text, wait=True):
+        '''
+        Runs the statement(s) in text in a database, as one round trip. Returns a tuple of
+        (column names, rows) for the last statement, or (None, None) if it returns no rows.
+        Without wait, the caller waits for the latency (see FakeConnection.wait).
+        '''
+        self.round_trip(wait)
+        calls = []
+        for statement in split_statements(text):
+            for pattern, handler in self.__queries:
+                match = pattern.match(statement)
+                if match:
+                    calls.append((handler, match.groups()))
+                    break
+            else:
+                raise FakeSQLError('FakeCluster does not implement: {}'.format(statement))
+        result = None, None
+        with self.__lock:
+            if database not in self.state.databases:
+                raise FakeSQLError('database "{}" does not exist'.format(database))
+            for handler, groups in calls:
+                result = handler(database, *groups) or (None, None)
+        return result
+
+    def round_trip(self, wait=True):
+        '''
+        Counts a round trip, and waits for the latency (with wait).
+        '''
+        with self.__lock:
+            self.stats['round_trips'] += 1
+        if wait:
+            time.sleep(self.latency)
+
+    def drift(self, fraction=0.1, seed=0):
+        '''
+        Makes a fraction of the memberships and extensions drift from what they where, resets
+        the passwords of that fraction of users, and adds an unmanaged role.
+        '''
+        rand = random.Random(seed)
+        with self.__lock:
+            for granted in sorted(self.state.members):
+                for grantee in sorted(self.state.members[granted]):
+                    if rand.random() < fraction:
+                        self.state.remove_member(grantee, granted)
+            for username in sorted(self.state.passwords):
+                if rand.random() < fraction:
+                    self.state.set_password(username, None)
+            for dbname in sorted(self.state.extensions):
+                for extname in sorted(self.state.extensions[dbname]):
+                    if rand.random() < fraction:
+                        self.state.drop_extension(extname, dbname)
+            self.state.add_role('unmanaged')
+            self.changes += 1
+
+    def __role(self, rolename):
+        '''
+        Raises a FakeSQLError if a role does not exist.
+        '''
+        if rolename not in self.state.roles:
+            raise FakeSQLError('role "{}" does not exist'.format(rolename))
+
+    @staticmethod
+    def __noop(_database, *_groups):
+        '''
+        Transaction control statements don't change anything.
+        '''
+
+    def __current_user(self, _database):
+        '''
+        SELECT CURRENT_USER
+        '''
+        return ['usename'], [(self.state.current_user, )]
+
+    @staticmethod
+    def __recovery(_database):
+        '''
+        The fake cluster is never a standby.
+        '''
+        return ['recovery'], [(False, )]
+
+    def __roles(self, _database, rolename=None):
+        '''
+        The roles query of the catalog, for all roles or one.
+        '''
+        columns = ['rolname'] + ROLE_ATTRIBUTES
+        return columns, [tuple([name] + [attributes[column] for column in columns[1:]])
+                         for name, attributes in sorted(self.state.roles.items())
+                         if rolename is None or name == rolename]
+
+    def __members(self, _database):
+        '''
+        The members query of the catalog.
+        '''
+        return ['granted_role', 'grantee_role'], [
+            (granted, grantee) for granted, grantees in sorted(self.state.members.items())
+            for grantee in sorted(grantees)]
+
+    def __passwords(self, _database):
+        '''
+        The passwords query of the catalog.
+        '''
+        return ['usename', 'passwd'], sorted(self.state.passwords.items())
+
+    def __databases(self, _database):
+        '''
+        The databases query of the catalog.
+        '''
+        return ['datname', 'owner'], sorted(self.state.databases.items())
+
+    def __datnames(self, _database):
+        '''
+        The names of all databases.
+        '''
+        return ['datname'], [(dbname, ) for dbname in sorted(self.state.databases)]
+
+    def __extensions(self, database):
+        '''
+        The extensions of a database.
+        '''
+        return ['extname', 'extversion'], sorted(self.state.extensions[database].items())
+
+    def __cluster_fingerprint(self, _database):
+        '''
+        Row counts of the shared catalog tables (and the number of changes instead of xmin).
+        '''
+        num_rows = {'pg_authid': len(self.state.roles),
+                    'pg_auth_members': sum(len(grantees)
+                                           for grantees in self.state.members.values()),
+                    'pg_database': len(self.state.databases),
+                    'pg_replication_slots': len(self.slots)}
+        return ['source', 'num_rows', 'xmin_sum'], [(source, count, self.changes)
+                                                    for source, count in num_rows.items()]
+
+    def __database_fingerprint(self, database):
+        '''
+        Row counts of the catalog tables in a database (and the number of changes).
+        '''
+        return ['source', 'num_rows', 'xmin_sum'], [
+            ('pg_extension', len(self.state.extensions[database]), self.changes),
+            ('pg_class', len(self.schemas.get(database, {})), self.changes)]
+
+    def __ungranted_schemas(self, database, rolename):
+        '''
+        Schemas with tables that are not granted to a role.
+        '''
+        return ['schemaname'], [(schemaname, ) for schemaname, grantees
+                                in sorted(self.schemas.get(database, {}).items())
+                                if rolename not in grantees]
+
+    def __default_privileges(self, database, rolename):
+        '''
+        The owner of a database, and if its future tables are granted to a role.
+        '''
+        owner = self.state.databases[database]
+        return ['datname', 'owner', 'granted'], [
+            (database, owner, (database, owner, rolename) in self.default_acl)]
+
+    def __dependencies(self, _database, rolenames):
+        '''
+        Databases where roles own the database, have grants or default privileges.
+        Ownership of a database is a dependency on a shared object, reported in postgres.
+        '''
+        rolenames = set(re.findall(r"'((?:[^']|'')*)'", rolenames))
+        rows = set()
+        for dbname, owner in self.state.databases.items():
+            if owner in rolenames:
+                rows.add(('postgres', self.state.databases['postgres'], owner))
+            for grantees in self.schemas.get(dbname, {}).values():
+                for rolename in grantees & rolenames:
+                    rows.add((dbname, owner, rolename))
+        for dbname, owner, rolename in self.default_acl:
+            for dependent in {owner, rolename} & rolenames:
+                rows.add((dbname, self.state.databases[dbname], dependent))
+        return ['datname', 'owner', 'rolname'], sorted(rows)
+
+    def __slots(self, _database):
+        '''
+        The names of all replication slots.
+        '''
+        return ['slot_name'], [(slot_name, ) for slot_name in sorted(self.slots)]
+
+    def __slot_exists(self, _database, slot_name):
+        '''
+        Check if a replication slot exists.
+        '''
+        return ['exists'], [(slot_name in self.slots, )]
+
+    def __create_slot(self, _database, slot_name):
+        '''
+        Create a replication slot.
+        '''
+        self.slots.add(slot_name)
+        self.changes += 1
+        return ['pg_create_physical_replication_slot'], [('({},)'.format(slot_name), )]
+
+    def __drop_slot(self, _database, slot_name):
+        '''
+        Drop a replication slot.
+        '''
+        self.slots.discard(slot_name)
+        self.changes += 1
+        return ['pg_drop_replication_slot'], [('', )]
+
+    def __create_role(self, _database, rolename, options, memberof):
+        '''
+        CREATE ROLE with options and IN ROLE.
+        '''
+        if rolename in self.state.roles:
+            raise FakeSQLError('role "{}" already exists'.format(rolename))
+        for granted in identifiers(memberof or ''):
+            self.__role(granted)
+        self.state.add_role(rolename)
+        self.__alter_role(_database, rolename, options or '')
+        for granted in identifiers(memberof or ''):
+            self.state.add_member(rolename, granted)
+
+    def __alter_role(self, _database, rolename, options):
+        '''
+        ALTER ROLE WITH options.
+        '''
+        self.__role(rolename)
+        for option in options.split():
+            self.state.set_role_option(rolename, ROLE_OPTIONS[option])
+        self.changes += 1
+
+    def __set_password(self, _database, username, hashed_password):
+        '''
+        ALTER USER WITH (ENCRYPTED) PASSWORD.
+        '''
+        self.__role(username)
+        self.state.set_password(username, hashed_password or None)
+        self.changes += 1
+
+    def __grant_role(self, _database, rolename, username):
+        '''
+        GRANT role TO user.
+        '''
+        self.__role(rolename)
+        self.__role(username)
+        self.state.add_member(username, rolename)
+        self.changes += 1
+
+    def __revoke_role(self, _database, rolename, usernames):
+        '''
+        REVOKE role FROM users.
+        '''
+        for username in identifiers(usernames):
+            self.state.remove_member(username, rolename)
+        self.changes += 1
+
+    def __drop_roles(self, _database, rolenames):
+        '''
+        DROP ROLE, which fails for roles that still own a database.
+        '''
+        rolenames = identifiers(rolenames)
+        for rolename in rolenames:
+            self.__role(rolename)
+            if rolename in self.state.databases.values():
+                raise FakeSQLError('role "{}" cannot be dropped because some objects depend '
+                                   'on it'.format(rolename))
+        for rolename in rolenames:
+            self.state.drop_role(rolename)
+        self.changes += 1
+
+    def __reassign_owned(self, _database, rolenames, new_owner, _new_owner_ident):
+        '''
+        REASSIGN OWNED BY roles TO new owner (databases are shared objects).
+        '''
+        rolenames = identifiers(rolenames)
+        new_owner = identifiers(new_owner)[0] if new_owner != 'CURRENT_USER' else \
+            self.state.current_user
+        for dbname, owner in list(self.state.databases.items()):
+            if owner in rolenames:
+                self.state.set_database(dbname, new_owner)
+        self.changes += 1
+
+    def __drop_owned(self, database, rolenames):
+        '''
+        DROP OWNED BY roles (in one database).
+        '''
+        rolenames = set(identifiers(rolenames))
+        for grantees in self.schemas.get(database, {}).values():
+            grantees -= rolenames
+        self.default_acl = {acl for acl in self.default_acl
+                            if acl[0] != database or not rolenames & set(acl[1:])}
+        self.changes += 1
+
+    def __create_database(self, _database, dbname):
+        '''
+        CREATE DATABASE (with a few schemas with tables, and plpgsql).
+        '''
+        if dbname in self.state.databases:
+            raise FakeSQLError('database "{}" already exists'.format(dbname))
+        self.state.set_database(dbname, self.state.current_user)
+        self.state.extensions[dbname] = {'plpgsql': '1.0'}
+        self.schemas[dbname] = {schemaname: set() for schemaname in TABLE_SCHEMAS}
+        self.changes += 1
+
+    def __alter_database(self, _database, dbname, ownername):
+        '''
+        ALTER DATABASE OWNER TO.
+        '''
+        self.__role(ownername)
+        self.state.set_database(dbname, ownername)
+        self.changes += 1
+
+    def __drop_database(self, _database, dbname):
+        '''
+        DROP DATABASE.
+        '''
+        self.state.drop_database(dbname)
+        self.schemas.pop(dbname, None)
+        self.default_acl = {acl for acl in self.default_acl if acl[0] != dbname}
+        self.changes += 1
+
+    def __create_extension(self, database, extname, _schemaname, version):
+        '''
+        CREATE EXTENSION IF NOT EXISTS.
+        '''
+        self.state.extensions[database].setdefault(extname, version or '1.0')
+        self.changes += 1
+
+    def __drop_extension(self, database, extname):
+        '''
+        DROP EXTENSION IF EXISTS.
+        '''
+        self.state.drop_extension(extname, database)
+        self.changes += 1
+
+    def __grant_tables(self, database, schemaname, rolename):
+        '''
+        GRANT SELECT ON ALL TABLES IN SCHEMA.
+        '''
+        self.__role(rolename)
+        self.schemas.setdefault(database, {}).setdefault(schemaname, set()).add(rolename)
+        self.changes += 1
+
+    def __alter_default_privileges(self, database, owner, rolename):
+        '''
+        ALTER DEFAULT PRIVILEGES FOR ROLE owner GRANT SELECT ON TABLES TO role.
+        '''
+        self.__role(owner)
+        self.__role(rolename)
+        self.default_acl.add((database, owner, rolename))
+        self.changes += 1
+
+
+class FakeConnection():
+    '''
+    This class is a fake psycopg2 connection to a database of a FakeCluster.
+    '''
+    def __init__(self, cluster, database, async_=False):
+        '''
+        Sets some defaults on a new initted FakeConnection class.
+        An asynchronous connection waits for the latency of a round trip in poll (with a pipe
+        that becomes readable after the latency) instead of sleeping.
+        '''
+        self.cluster = cluster
+        self.database = database
+        self.closed = 0
+        self.autocommit = async_
+        self.prepared = {}
+        self.pid = next(cluster.backend_pids)
+        self.async_ = async_
+        self.__waiting = False
+        self.__read, self.__write = os.pipe() if async_ else (None, None)
+
+    def round_trip(self):
+        '''
+        Counts a round trip (of a statement without a result), and waits for the latency.
+        '''
+        self.cluster.round_trip(not self.async_)
+        if self.async_:
+            self.wait()
+
+    def wait(self):
+        '''
+        Start waiting for the latency of a round trip (of an asynchronous connection).
+        '''
+        self.__waiting = True
+        threading.Timer(self.cluster.latency, os.write, (self.__write, b'x')).start()
+
+    def poll(self):
+        '''
+        Returns POLL_READ while waiting for a round trip, and POLL_OK when it is done.
+        '''
+        if self.__waiting:
+            if not select.select([self.__read], [], [], 0)[0]:
+                return POLL_READ
+            os.read(self.__read, 1)
+            self.__waiting = False
+        return POLL_OK
+
+    def fileno(self):
+        '''
+        Returns the file descriptor that becomes readable when a round trip is done.
+        '''
+        return self.__read
+
+    def cursor(self, name=None, withhold=False, cursor_factory=None):
+        '''
+        Returns a new FakeCursor (a named one acts like a server side cursor).
+        '''
+        # pylint: disable=W0613
+        return FakeCursor(self, name, cursor_factory)
+
+    @staticmethod
+    def get_transaction_status():
+        '''
+        Statements run in autocommit, so a connection is always idle in between.
+        '''
+        return TRANSACTION_STATUS_IDLE
+
+    def get_backend_pid(self):
+        '''
+        Returns the (fake) pid of the backend of this connection.
+        '''
+        return self.pid
+
+    def close(self):
+        '''
+        Close the connection.
+        '''
+        self.closed = 1
+        if self.async_ and self.__read is not None:
+            os.close(self.__read)
+            os.close(self.__write)
+            self.__read = self.__write = None
+
+
+class FakeCursor():
+    '''
+    This class is a fake psycopg2 cursor that runs queries on a FakeCluster.
+    '''
+    def __init__(self, connection, name=None, cursor_factory=None):
+        '''
+        Sets some defaults on a new initted FakeCursor class.
+        '''
+        self.connection = connection
+        self.name = name
+        self.namedtuples = cursor_factory is not None
+        self.itersize = 2000
+        self.description = None
+        self.__rows = []
+
+    def execute(self, query, parameters=None):
+        '''
+        Run a query in one round trip. Prepared statements are kept per connection, and
+        executed by running the prepared query with the arguments filled in.
+        '''
+        statements = []
+        for statement in split_statements(render(query, parameters)):
+            prepare = PREPARE_PATTERN.match(statement)
+            execute = EXECUTE_PATTERN.match(statement)
+            if prepare:
+                if prepare.group(1) in self.connection.prepared:
+                    raise FakeSQLError('prepared statement "{}" already exists'.format(
+                        prepare.group(1)))
+                self.connection.prepared[prepare.group(1)] = prepare.group(2)
+            elif execute:
+                try:
+                    statement = self.connection.prepared[execute.group(1)]
+                except KeyError:
+                    raise FakeSQLError('prepared statement "{}" does not exist'.format(
+                        execute.group(1)))
+                arguments = ARGUMENT_PATTERN.findall(execute.group(2) or '')
+                statements.append(re.sub(r'\$(\d+)',
+                                         lambda match: arguments[int(match.group(1)) - 1],
+                                         statement))
+            else:
+                statements.append(statement)
+        if not statements:
+            self.connection.round_trip()
+            self.description, self.__rows = None, []
+            return
+        text = ';\n'.join(statements)
+        columns, rows = self.connection.cluster.execute(self.connection.database, text,
+                                                        not self.connection.async_)
+        if self.connection.async_:
+            self.connection.wait()
+        self.description = [(column, ) for column in columns] if columns else None
+        self.__rows = rows or []
+
+    @staticmethod
+    def mogrify(query, parameters=None):
+        '''
+        Returns the query (with parameters filled in) that execute would send.
+        '''
+        return render(query, parameters).encode()
+
+    def fetchall(self):
+        '''
+        Returns all rows of the last query.
+        '''
+        rows, self.__rows = self.__rows, []
+        return rows
+
+    def __iter__(self):
+        '''
+        Iterate over the rows of the last query. A named cursor fetches itersize rows per
+        round trip (DECLARE was the round trip of execute), like psycopg2 does.
+        '''
+        rows, self.__rows = self.__rows, []
+        if self.namedtuples:
+            row_type = collections.namedtuple('Row', [column for column, in self.description])
+            rows = [row_type(*row) for row in rows]
+        if not self.name:
+            yield from rows
+            return
+        for start in range(0, len(rows) + 1, self.itersize):
+            self.connection.cluster.round_trip()
+            yield from rows[start:start + self.itersize]
+
+    def close(self):
+        '''
+        Close the cursor (a named cursor is closed with a CLOSE statement).
+        '''
+        if self.name:
+            self.connection.cluster.round_trip()
+            self.name = None
+
+
+class PhaseRecorder():
+    '''
+    This class measures wall time, round trips, ldap searches and peak memory per phase of
+    proces_fga, by wrapping the functions that implement the phases (see PHASES).
+    Peak memory is traced with tracemalloc, which should be started by the caller.
+    '''
+    def __init__(self, cluster):
+        '''
+        Sets some defaults on a new initted PhaseRecorder class.
+        '''
+        self.cluster = cluster
+        self.results = {}
+        self.ldap_searches = 0
+        # Highest traced memory seen, as tracemalloc.reset_peak forgets it
+        self.peak_memory = 0
+        self.__lock = threading.Lock()
+
+    @contextmanager
+    def recording(self):
+        '''
+        Context manager that records the phases (and ldap searches) of everything run in it.
+        '''
+        search = ldap3.Connection.search
+
+        def counting_search(*args, **kwargs):
+            '''
+            Count a ldap search (a page of a paged search is a search too).
+            '''
+            with self.__lock:
+                self.ldap_searches += 1
+            return search(*args, **kwargs)
+        patches = [patch.object(ldap3.Connection, 'search', counting_search)]
+        for phase, owner, name in PHASES:
+            patches.append(patch.object(owner, name, self.__wrap(phase, getattr(owner, name))))
+        for patcher in patches:
+            patcher.start()
+        try:
+            yield self
+        finally:
+            for patcher in reversed(patches):
+                patcher.stop()
+
+    def __wrap(self, phase, function):
+        '''
+        Returns a wrapper that measures every call of function as (part of) a phase.
+        '''
+        @wraps(function)
+        def measured(*args, **kwargs):
+            '''
+            Call function and add its metrics to the phase.
+            '''
+            round_trips = self.cluster.stats['round_trips']
+            ldap_searches = self.ldap_searches
+            self.peak_memory = max(self.peak_memory, tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+            memory = tracemalloc.get_traced_memory()[0]
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                metrics = self.results.setdefault(phase, dict.fromkeys(METRICS, 0))
+                metrics['wall_time'] += time.perf_counter() - start
+                metrics['round_trips'] += self.cluster.stats['round_trips'] - round_trips
+                metrics['ldap_searches'] += self.ldap_searches - ldap_searches
+                peak_memory = tracemalloc.get_traced_memory()[1]
+                self.peak_memory = max(self.peak_memory, peak_memory)
+                metrics['peak_memory'] = max(metrics['peak_memory'], peak_memory - memory)
+        return measured
+
+
+async def proces_fga_async(configdata, pgconn, ldapconn, detector=None):
+    '''
+    Runs proces_fga_async (of the asyncio engine) with a pool of worker threads, and returns
+    the number of errors.
+    '''
+    parallelism = pgcdfga.general_option(configdata, 'parallelism')
+    apgconn = AsyncPGConnection(partial(pgconn.new_connection, async_=True), parallelism)
+    with ThreadPoolExecutor(max_workers=parallelism + 1) as executor:
+        try:
+            return await pgcdfga.proces_fga_async(
+                configdata, pgconn, apgconn, ldapconn,
+                partial(asyncio.get_running_loop().run_in_executor, executor), detector)
+        finally:
+            apgconn.close()
+
+
+def run_scenario(configdata, cluster, detector=None, engine='threads'):
+    '''
+    Runs proces_fga (or proces_fga_async with the asyncio engine) once against a fake cluster
+    and returns {phase: {metric: value}}. The total phase also holds the number of errors.
+    '''
+    recorder = PhaseRecorder(cluster)
+    # Don't let garbage of a previous scenario end up in the memory of this one
+    gc.collect()
+    round_trips = cluster.stats['round_trips']
+    tracemalloc.reset_peak()
+    memory = tracemalloc.get_traced_memory()[0]
+    start = time.perf_counter()
+    with recorder.recording():
+        pgconn = PGConnection(dsn_params=dict(configdata['postgresql']['dsn']),
+                              strict_params=dict(configdata['strict']))
+        ldapconn = LDAPConnection(pgcdfga.config_ldap(configdata))
+        if engine == 'asyncio':
+            errorcount = asyncio.run(proces_fga_async(configdata, pgconn, ldapconn, detector))
+        else:
+            errorcount = pgcdfga.proces_fga(configdata, pgconn, ldapconn, detector)
+        pgconn.close()
+    results = recorder.results
+    peak_memory = max(recorder.peak_memory, tracemalloc.get_traced_memory()[1])
+    results['total'] = {'wall_time': time.perf_counter() - start,
+                        'round_trips': cluster.stats['round_trips'] - round_trips,
+                        'ldap_searches': recorder.ldap_searches,
+                        'peak_memory': peak_memory - memory,
+                        'errors': errorcount}
+    return results
+
+
+def run_benchmark(scale='small', latency=0.0, seed=0, engine='threads'):
+    '''
+    Runs all scenarios at a scale (see SCALES) and returns {scenario: {phase: {metric: value}}}.
+    The scenarios are: initial (on an empty cluster), unchanged (the same again, which should be
+    skipped by the ChangeDetector), steady (a full run on the converged cluster) and drift
+    (a full run after 10% of the memberships, passwords and extensions drifted).
+    '''
+    configdata = generate_config(seed=seed, **SCALES[scale])
+    cluster = FakeCluster(latency)
+    detector = ChangeDetector(full_run_every=configdata['general']['full_run_every'])
+    results = {}
+    tracing = tracemalloc.is_tracing()
+    if not tracing:
+        tracemalloc.start()
+    try:
+        with cluster.patched():
+            results['initial'] = run_scenario(configdata, cluster, detector, engine)
+            results['unchanged'] = run_scenario(configdata, cluster, detector, engine)
+            results['steady'] = run_scenario(configdata, cluster, engine=engine)
+            cluster.drift(0.1, seed)
+            results['drift'] = run_scenario(configdata, cluster, engine=engine)
+    finally:
+        if not tracing:
+            tracemalloc.stop()
+    return results
+
+
+def load_baselines(filename=BASELINES_FILE):
+    '''
+    Returns the saved baselines as {scale: {'latency': latency, 'results': results}}.
+    '''
+    try:
+        with open(filename) as baselinefile:
+            return json.load(baselinefile)
+    except FileNotFoundError:
+        return {}
+
+
+def save_baselines(scale, latency, results, filename=BASELINES_FILE):
+    '''
+    Saves the results of run_benchmark as the baselines of a scale.
+    '''
+    baselines = load_baselines(filename)
+    baselines[scale] = {'latency': latency, 'results': {
+        scenario: {phase: {metric: round(value, 4) for metric, value in metrics.items()}
+                   for phase, metrics in phases.items()}
+        for scenario, phases in results.items()}}
+    with open(filename, 'w') as baselinefile:
+        json.dump(baselines, baselinefile, indent=2, sort_keys=True)
+        baselinefile.write('\n')
+
+
+def regressions(results, baseline, checked=None):
+    '''
+    Returns a description of every metric (of checked, which defaults to COUNTED_METRICS) in
+    results that regressed against the baseline results (see TOLERANCES). Phases that are not
+    in the baseline count as regressions too.
+    '''
+    checked = checked or COUNTED_METRICS
+    regressed = []
+    for scenario, phases in sorted(results.items()):
+        for phase, metrics in sorted(phases.items()):
+            for metric in sorted(checked):
+                factor, slack = TOLERANCES[metric]
+                value = metrics.get(metric, 0)
+                expected = baseline.get(scenario, {}).get(phase, {}).get(metric, 0)
+                if value > expected * factor + slack:
+                    regressed.append('{}/{}/{}: {:g} (baseline {:g})'.format(
+                        scenario, phase, metric, value, expected))
+    return regressed
+
+
+def report(results):
+    '''
+    Returns the results of run_benchmark as a table.
+    '''
+    lines = ['{:10} {:12} {:>10} {:>12} {:>14} {:>12}'.format(
+        'scenario', 'phase', 'wall (s)', 'round trips', 'ldap searches', 'peak (KiB)')]
+    for scenario, phases in results.items():
+        for phase, metrics in phases.items():
+            lines.append('{:10} {:12} {:10.3f} {:12d} {:14d} {:12d}'.format(
+                scenario, phase, metrics['wall_time'], metrics['round_trips'],
+                metrics['ldap_searches'], metrics['peak_memory'] // 1024))
+    return '\n'.join(lines)
+
+
+def main():
+    '''
+    This function runs the benchmark from the command line.
+    '''
+    parser = ArgumentParser(description='Benchmark pgcdfga against a fake postgres cluster and '
+                            'mocked ldap at synthetic scale')
+    parser.add_argument('-s', '--scale', choices=sorted(SCALES), default='small',
+                        help='The scale of the generated config')
+    parser.add_argument('-l', '--latency', type=float, default=0.0,
+                        help='Latency (in seconds) of every round trip to postgres')
+    parser.add_argument('--save', action='store_true',
+                        help='Save the results as the new baselines for this scale')
+    parser.add_argument('--engine', choices=['threads', 'asyncio'], default='threads',
+                        help='The engine to benchmark (baselines are saved and checked for '
+                        'the threads engine only)')
+    parser.add_argument('--check-measured', action='store_true',
+                        help='Also check wall time and peak memory against the baselines '
+                        '(these depend on the machine)')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.CRITICAL)
+    results = run_benchmark(args.scale, args.latency, engine=args.engine)
+    print(report(results))
+    baseline = load_baselines().get(args.scale)
+    if args.engine != 'threads':
+        return
+    if args.save:
+        save_baselines(args.scale, args.latency, results)
+    elif baseline:
+        checked = COUNTED_METRICS + (MEASURED_METRICS if args.check_measured else [])
+        for regression in regressions(results, baseline['results'], checked):
+            print('Regression: {}'.format(regression))
+
+
+if __name__ == '__main__':
+    main()
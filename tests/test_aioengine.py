@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+
+# Copyright 2019 Bol.com
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''
+This module holds all unit tests for the aioengine module
+'''
+import os
+import asyncio
+import logging
+import unittest
+import unittest.mock
+import psycopg2
+from psycopg2.extensions import POLL_OK, POLL_READ, POLL_WRITE
+from pgcdfga.aioengine import AsyncPGConnection, wait_ready, load_extensions, \
+    catalog_fingerprint, apply
+from pgcdfga.pgcatalog import PGCatalog
+from pgcdfga.planner import Operation
+
+
+logging.disable(logging.CRITICAL)
+
+
+class FakeAsyncConnection():
+    '''
+    This class is a fake asynchronous psycopg2 connection, that is busy (POLL_READ) for one
+    poll after every query, and keeps count of the queries that are running (in stats).
+    '''
+    def __init__(self, database, stats):
+        '''
+        Sets some defaults on a new initted FakeAsyncConnection class.
+        '''
+        self.database = database
+        self.stats = stats
+        self.statements = []
+        self.fail = False
+        self.closed = 0
+        self.busy = False
+        self.polled = False
+        self.__read, self.__write = os.pipe()
+
+    def cursor(self):
+        '''
+        Returns a cursor that runs queries on this connection.
+        '''
+        cursor = unittest.mock.Mock()
+        cursor.description = [('extname', ), ('extversion', )]
+        cursor.fetchall.return_value = [(self.database, '1.0')]
+        cursor.execute.side_effect = self.execute
+        return cursor
+
+    def execute(self, statement, parameters=None):
+        '''
+        Start running a query.
+        '''
+        self.statements.append((statement, parameters))
+        self.busy = True
+        self.polled = False
+        self.stats['running'] += 1
+        self.stats['max_running'] = max(self.stats['max_running'], self.stats['running'])
+        os.write(self.__write, b'x')
+
+    def poll(self):
+        '''
+        Returns POLL_READ on the first poll of a query, and POLL_OK after that.
+        '''
+        if not self.busy:
+            return POLL_OK
+        if not self.polled:
+            # The socket is readable already, but the other queries get to start first
+            self.polled = True
+            return POLL_READ
+        os.read(self.__read, 1)
+        self.busy = False
+        self.stats['running'] -= 1
+        if self.fail:
+            raise psycopg2.OperationalError('server closed the connection unexpectedly')
+        return POLL_OK
+
+    def fileno(self):
+        '''
+        Returns the file descriptor to wait on.
+        '''
+        return self.__read
+
+    def close(self):
+        '''
+        Close the connection.
+        '''
+        self.closed = 1
+        os.close(self.__read)
+        os.close(self.__write)
+
+
+class AioEngineTest(unittest.TestCase):
+    """
+    Test the AsyncPGConnection Class and the functions of the asyncio engine.
+    """
+    def setUp(self):
+        '''
+        Create an AsyncPGConnection that opens FakeAsyncConnections.
+        '''
+        self.stats = {'running': 0, 'max_running': 0}
+        self.connections = {}
+
+        def connect(database):
+            self.connections[database] = FakeAsyncConnection(database, self.stats)
+            return self.connections[database]
+        self.apgconn = AsyncPGConnection(connect, max_queries=2)
+
+    def tearDown(self):
+        '''
+        Close all connections.
+        '''
+        self.apgconn.close()
+
+    def test_wait_ready(self):
+        '''
+        Test wait_ready to wait for the socket until poll returns POLL_OK
+        '''
+        read, write = os.pipe()
+        conn = unittest.mock.Mock()
+        conn.fileno.return_value = write
+        conn.poll.side_effect = [POLL_WRITE, POLL_OK]
+        asyncio.run(wait_ready(conn))
+        self.assertEqual(conn.poll.call_count, 2)
+        conn.fileno.return_value = read
+        os.write(write, b'x')
+        conn.poll.side_effect = [POLL_READ, POLL_OK]
+        asyncio.run(wait_ready(conn))
+        conn.poll.side_effect = [4]
+        with self.assertRaises(psycopg2.OperationalError):
+            asyncio.run(wait_ready(conn))
+        os.close(read)
+        os.close(write)
+
+    def test_run_prepared(self):
+        '''
+        Test AsyncPGConnection.run_prepared to prepare once per connection, and to run at most
+        max_queries queries, and one query per database at a time
+        '''
+        query = 'SELECT extname, extversion FROM pg_extension WHERE extname = $1'
+
+        async def run():
+            return await asyncio.gather(*[self.apgconn.run_prepared(query, [str(index)],
+                                                                    'db{}'.format(index % 3))
+                                          for index in range(6)])
+        results = asyncio.run(run())
+        self.assertEqual(results[0], [{'extname': 'db0', 'extversion': '1.0'}])
+        self.assertEqual(self.stats['max_running'], 2)
+        self.assertEqual(len(self.apgconn), 3)
+        statements = [statement for statement, _ in self.connections['db0'].statements]
+        self.assertEqual(len(statements), 2)
+        self.assertTrue(statements[0].startswith('PREPARE'))
+        self.assertTrue(statements[1].startswith('EXECUTE'))
+        # Connections are kept over runs (and event loops)
+        asyncio.run(run())
+        self.assertEqual(len(self.apgconn), 3)
+
+        # A connection that fails is closed, and opened again on next use
+        failing = self.connections['db1']
+        failing.fail = True
+        with self.assertRaises(psycopg2.OperationalError):
+            asyncio.run(self.apgconn.run_prepared(query, ['x'], 'db1'))
+        self.assertEqual(failing.closed, 1)
+        self.assertEqual(len(self.apgconn), 2)
+        asyncio.run(self.apgconn.run_prepared(query, ['x'], 'db1'))
+        self.assertIsNot(self.connections['db1'], failing)
+        self.assertTrue(self.connections['db1'].statements[0][0].startswith('PREPARE'))
+
+    def test_max_connections(self):
+        '''
+        Test AsyncPGConnection to close the least recently used connection at max_connections
+        '''
+        query = 'SELECT extname, extversion FROM pg_extension WHERE extname = $1'
+        self.apgconn.max_connections = 2
+        for database in ['db0', 'db1', 'db0', 'db2']:
+            asyncio.run(self.apgconn.run_prepared(query, ['x'], database))
+        self.assertEqual(len(self.apgconn), 2)
+        self.assertEqual(self.connections['db1'].closed, 1)
+        self.assertEqual(self.connections['db0'].closed, 0)
+
+        # Connections that are running a query are not closed
+        async def run():
+            return await asyncio.gather(*[self.apgconn.run_prepared(query, ['x'], database)
+                                          for database in ['db0', 'db2', 'db3']])
+        self.apgconn.max_queries = 3
+        asyncio.run(run())
+        self.assertEqual(len(self.apgconn), 3)
+
+    def test_catalog(self):
+        '''
+        Test load_extensions and catalog_fingerprint to read the databases that exist
+        '''
+        catalog = PGCatalog()
+        catalog.databases = {'db1': 'owner', 'db2': 'owner'}
+        catalog.extensions = {'db2': {'plpgsql': '1.0'}}
+        asyncio.run(load_extensions(catalog, self.apgconn, ['db1', 'db2', 'new']))
+        self.assertEqual(catalog.extensions, {'db1': {'db1': '1.0'}, 'db2': {'plpgsql': '1.0'},
+                                              'new': {}})
+        self.assertEqual(set(self.connections), {'db1'})
+
+        apgconn = unittest.mock.Mock()
+
+        async def run_prepared(query, _parameters=None, database='postgres'):
+            if query == 'SELECT datname FROM pg_database':
+                return [{'datname': 'postgres'}, {'datname': 'db1'}]
+            return [{'query': query[:6]}]
+        apgconn.run_prepared.side_effect = run_prepared
+        rows = asyncio.run(catalog_fingerprint(apgconn, ['db1', 'new']))
+        self.assertEqual(len(rows), 2)
+        self.assertEqual(rows[1]['database'], 'db1')
+
+    def test_apply(self):
+        '''
+        Test apply to apply the phases in order, and to count errors
+        '''
+        pgconn = unittest.mock.Mock()
+        pgconn.strict_option.return_value = True
+        pgconn.createextension.side_effect = [None, Exception('could not open extension')]
+        pgconn.strict_params = {}
+        calls = []
+
+        async def call(function, *args):
+            calls.append(function.__name__)
+            return function(*args)
+        operations = [Operation('roles', 'users', 'createrole', ('role1', ), None),
+                      Operation('extensions', 'extensions', 'createextension',
+                                ('ext1', 'db1', None, None), 'db1'),
+                      Operation('extensions', 'extensions', 'createextension',
+                                ('ext1', 'db2', None, None), 'db2'),
+                      Operation('databases', 'databases', 'createdb', ('db1', 'owner'), None)]
+        self.assertEqual(asyncio.run(apply(pgconn, operations, call, parallelism=2)), 1)
+        self.assertEqual([method for method, _, _ in pgconn.method_calls
+                          if method != 'strict_option'],
+                         ['createrole', 'createdb', 'createextension', 'createextension'])
+        self.assertEqual(len(calls), 4)
+        self.assertEqual(pgconn.strict_params, {'extensions': False})
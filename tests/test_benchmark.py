@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+
+# Copyright 2019 Bol.com
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''
+This module holds the benchmark tests (see the benchmark module)
+'''
+import logging
+import unittest
+from pgcdfga import pgcdfga
+from pgcdfga.fingerprint import ChangeDetector
+from pgcdfga.ldapconnection import LDAPConnection
+from pgcdfga.pgconnection import PGConnection
+from tests.benchmark import FakeCluster, generate_config, load_baselines, regressions, \
+    run_benchmark, run_scenario, COUNTED_METRICS, MEASURED_METRICS
+
+
+logging.disable(logging.CRITICAL)
+
+
+class BenchmarkTest(unittest.TestCase):
+    """
+    Test proces_fga at synthetic scale against the baselines.
+    """
+    def test_no_regressions(self):
+        '''
+        Test that no scenario uses more round trips or ldap searches than its baseline
+        (wall time and memory depend on the machine, see --check-measured)
+        '''
+        baseline = load_baselines()['small']
+        results = run_benchmark('small', baseline['latency'])
+        for scenario, phases in results.items():
+            self.assertEqual(phases['total']['errors'], 0, scenario)
+        self.assertNotIn('plan', results['unchanged'])
+        self.assertEqual(regressions(results, baseline['results']), [])
+
+    def test_regressions(self):
+        '''
+        Test regressions to report metrics over their tolerance, and phases without a baseline
+        '''
+        baseline = {'steady': {'apply': {'round_trips': 10, 'wall_time': 1.0}}}
+        results = {'steady': {'apply': {'round_trips': 11, 'wall_time': 2.0}},
+                   'unchanged': {'plan': {'round_trips': 0, 'wall_time': 0.01}}}
+        self.assertEqual(regressions(results, baseline),
+                         ['steady/apply/round_trips: 11 (baseline 10)'])
+        results['unchanged']['plan']['round_trips'] = 5
+        self.assertEqual(len(regressions(results, baseline)), 2)
+        results['steady']['apply']['wall_time'] = 5.0
+        self.assertEqual(len(regressions(results, baseline)), 2)
+        self.assertIn('steady/apply/wall_time: 5 (baseline 1)',
+                      regressions(results, baseline, COUNTED_METRICS + MEASURED_METRICS))
+
+    def test_fake_cluster_converges(self):
+        '''
+        Test that the fake cluster runs the DDL of proces_fga, so that it converges
+        '''
+        configdata = generate_config(users=20, groups=4, databases=3, extensions=2)
+        cluster = FakeCluster()
+        with cluster.patched():
+            run_scenario(configdata, cluster)
+            run_scenario(configdata, cluster)
+            pgconn = PGConnection(dsn_params=configdata['postgresql']['dsn'],
+                                  strict_params=dict(configdata['strict']))
+            ldapconn = LDAPConnection(pgcdfga.config_ldap(configdata))
+            operations, errorcount = pgcdfga.plan_fga(configdata, pgconn, ldapconn)
+        self.assertEqual(errorcount, 0)
+        self.assertEqual({operation.method for operation in operations}, {'grantreadonly'})
+        self.assertIn('user00019', cluster.state.roles)
+        self.assertEqual(cluster.schemas['db0000'], {'public': {'db0000_readonly'},
+                                                     'app': {'db0000_readonly'}})
+
+    def test_asyncio_engine(self):
+        '''
+        Test that the asyncio engine converges the fake cluster (and skips unchanged runs) with
+        the same round trips and ldap searches as the threads engine
+        '''
+        configdata = generate_config(users=20, groups=4, databases=3, extensions=2)
+        totals = {}
+        for engine in ['threads', 'asyncio']:
+            cluster = FakeCluster(latency=0.001)
+            detector = ChangeDetector()
+            with cluster.patched():
+                totals[engine] = [run_scenario(configdata, cluster, detector, engine)['total']
+                                  for _ in range(2)]
+            self.assertIn('user00019', cluster.state.roles)
+        for threads, asyncio in zip(totals['threads'], totals['asyncio']):
+            self.assertEqual(asyncio['errors'], 0)
+            self.assertEqual(asyncio['round_trips'], threads['round_trips'])
+            self.assertEqual(asyncio['ldap_searches'], threads['ldap_searches'])
+        self.assertEqual(detector.stats['skipped'], 1)
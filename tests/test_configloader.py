@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+
+# Copyright 2019 Bol.com
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''
+This module holds all unit tests for the configloader module
+'''
+import os
+import tempfile
+import unittest
+from unittest.mock import Mock, patch
+from pgcdfga import configloader
+from pgcdfga.configloader import ConfigLoader
+
+
+class ConfigLoaderTest(unittest.TestCase):
+    """
+    Test the ConfigLoader Class.
+    """
+    def setUp(self):
+        '''
+        Create a directory with a config file that is a symlink (like a ConfigMap volume).
+        '''
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.configfile = os.path.join(self.tmpdir.name, 'config.yaml')
+        self.write_config('v1', 'general: {loglevel: debug}\n')
+
+    def tearDown(self):
+        '''
+        Clean up the config directory.
+        '''
+        self.tmpdir.cleanup()
+
+    def write_config(self, version, content):
+        '''
+        Write a new version of the config, and swap the symlink to it.
+        '''
+        target = os.path.join(self.tmpdir.name, version)
+        with open(target, 'w') as configfile:
+            configfile.write(content)
+        tmplink = self.configfile + '.tmp'
+        os.symlink(target, tmplink)
+        os.replace(tmplink, self.configfile)
+
+    def test_reload_on_change(self):
+        '''
+        Test ConfigLoader to parse the file only when it changed
+        '''
+        loader = ConfigLoader(self.configfile)
+        configdata = loader.load()
+        self.assertEqual(configdata, {'general': {'loglevel': 'debug'}})
+        configdata['ldap'] = {}
+        self.assertEqual(loader.load(), {'general': {'loglevel': 'debug'}})
+        self.assertFalse(loader.changed())
+        self.write_config('v2', 'general: {loglevel: info}\n')
+        self.assertTrue(loader.changed())
+        self.assertEqual(loader.load(), {'general': {'loglevel': 'info'}})
+        self.assertEqual(loader.stats, {'loads': 3, 'parses': 2, 'compiles': 0})
+
+    def test_model(self):
+        '''
+        Test ConfigLoader.model to compile the config only once per parse
+        '''
+        self.write_config('v2', 'users: {scot: {auth: password, password: tiger}}\n')
+        loader = ConfigLoader(self.configfile)
+        loader.load()
+        model = loader.model()
+        self.assertEqual([user.name for user in model.users], ['scot'])
+        loader.load()
+        self.assertIs(loader.model(), model)
+        self.write_config('v3', 'users: {scot: {auth: password, password: lion}}\n')
+        loader.load()
+        self.assertEqual(loader.model().users[0].password, 'lion')
+        self.assertEqual(loader.stats, {'loads': 3, 'parses': 2, 'compiles': 2})
+
+    def test_wait_without_inotify(self):
+        '''
+        Test ConfigLoader.wait to sleep and report changes without inotify
+        '''
+        loader = ConfigLoader(self.configfile)
+        loader.load()
+        with patch.object(configloader, 'inotify_simple', None), \
+                patch.object(configloader.time, 'sleep') as mock_sleep:
+            self.assertFalse(loader.wait(10))
+            mock_sleep.assert_called_with(10)
+
+    def test_wait_with_inotify(self):
+        '''
+        Test ConfigLoader.wait to return early when the config file changes
+        '''
+        loader = ConfigLoader(self.configfile)
+        loader.load()
+        mock_inotify = Mock()
+        for flag in ['CLOSE_WRITE', 'MOVED_TO', 'CREATE', 'DELETE', 'ATTRIB']:
+            setattr(mock_inotify.flags, flag, 1)
+        mock_inotify.INotify.return_value.read.side_effect = (
+            lambda timeout: self.write_config('v2', 'general: {}\n') or ['event']
+            if timeout > 1000 else [])
+        with patch.object(configloader, 'inotify_simple', mock_inotify):
+            self.assertTrue(loader.wait(60))
+        mock_inotify.INotify.return_value.add_watch.assert_called_once()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+
+# Copyright 2019 Bol.com
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''
+This module holds all unit tests for the configmodel module
+'''
+import datetime
+import unittest
+from pgcdfga.configmodel import NON_WORD_CHAR_RE, UserConfig, compile_config
+
+
+class NonWordCharReTest(unittest.TestCase):
+    """
+    Test the Non Word Characters regular expression.
+    """
+    def test_valid_non_word_char_re(self):
+        '''
+        Test NON_WORD_CHAR_RE for matches
+        '''
+        self.assertEqual(NON_WORD_CHAR_RE.search('123_!?').group(0), '_')
+        self.assertEqual(NON_WORD_CHAR_RE.search('abc!?_').group(0), '!')
+        self.assertEqual(NON_WORD_CHAR_RE.search('ABC?_!').group(0), '?')
+
+    def test_invalid_non_word_char_re(self):
+        '''
+        Test NON_WORD_CHAR_RE for non-matches
+        '''
+        self.assertEqual(NON_WORD_CHAR_RE.search('1234abcdABCD'), None)
+
+
+class CompileConfigTest(unittest.TestCase):
+    """
+    Test compiling the config into records.
+    """
+    def test_user_config(self):
+        '''
+        Test UserConfig to normalize auth, expiry and options
+        '''
+        user = UserConfig('dbateam', {'auth': 'LDAP-Group', 'expiry': '2018-07',
+                                      'options': ['superuser'], 'memberof': 'dba'})
+        self.assertEqual(user.auth, 'ldapgroup')
+        self.assertEqual(user.expiry, datetime.datetime(2018, 7, 31, 23, 59, 59))
+        self.assertTrue(user.expired())
+        self.assertEqual(user.options, ('SUPERUSER', ))
+        self.assertEqual(user.memberof, ('dba', ))
+        self.assertEqual(user.ldap_query(), (None, 'dbateam'))
+        with self.assertRaises(AttributeError):
+            user.unknown = True
+
+    def test_schema_errors(self):
+        '''
+        Test compile_config to report schema errors up front and leave those entries out
+        '''
+        configdata = {'users': {'scot': {'password': 'tiger'},
+                                'john': {'expiry': '2018-13'},
+                                'jane': {'memberof': {'dba': True}}},
+                      'roles': {'dba': {'ensure': 'maybe'}},
+                      'databases': {'app': {'extensions': {'hstore': 'yes'}},
+                                    'old': {'ensure': 'absent'}},
+                      'replication_slots': ['slot1']}
+        model = compile_config(configdata)
+        self.assertEqual([user.name for user in model.users], ['scot'])
+        self.assertEqual(model.roles, [])
+        self.assertEqual([database.name for database in model.databases], ['app', 'old'])
+        self.assertEqual(model.databases[0].extensions, [])
+        self.assertFalse(model.databases[0].default_privileges)
+        self.assertEqual(model.replication_slots, ['slot1'])
+        self.assertEqual([chapter for chapter, _error in model.errors],
+                         ['users', 'users', 'users', 'extensions'])
+        self.assertIn('users.john.expiry', model.errors[0][1])
+
+    def test_empty_config(self):
+        '''
+        Test compile_config with chapters that are missing or invalid
+        '''
+        model = compile_config({'users': None, 'databases': ['app']})
+        self.assertEqual(model.users, [])
+        self.assertEqual(model.errors, [('databases', 'databases: expected a dictionary')])
+        self.assertIsNone(model.replication_slots)
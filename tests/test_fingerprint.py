@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+
+# Copyright 2019 Bol.com
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''
+This module holds all unit tests for the fingerprint module
+'''
+import unittest
+from pgcdfga.fingerprint import ChangeDetector, digest
+
+
+class ChangeDetectorTest(unittest.TestCase):
+    """
+    Test the ChangeDetector Class.
+    """
+    def test_digest(self):
+        '''
+        Test digest to be independent of the order of dict keys
+        '''
+        self.assertEqual(digest({'a': 1, 'b': [1, 2]}), digest({'b': [1, 2], 'a': 1}))
+        self.assertNotEqual(digest({'a': 1}), digest({'a': 2}))
+
+    def test_skip_unchanged(self):
+        '''
+        Test ChangeDetector to skip unchanged runs, but force a full run every n runs
+        '''
+        detector = ChangeDetector(full_run_every=3)
+        self.assertFalse(detector.unchanged('fp1'))
+        detector.succeeded('fp1')
+        self.assertTrue(detector.unchanged('fp1'))
+        self.assertTrue(detector.unchanged('fp1'))
+        self.assertFalse(detector.unchanged('fp1'))
+        detector.succeeded('fp1')
+        self.assertFalse(detector.unchanged('fp2'))
+        detector.failed()
+        self.assertFalse(detector.unchanged('fp1'))
+        self.assertEqual(detector.stats, {'runs': 6, 'skipped': 2})
+        self.assertAlmostEqual(detector.skip_rate(), 1 / 3)
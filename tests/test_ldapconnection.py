@@ -20,7 +20,8 @@ This module holds all unit tests for the pgcdfga module
 import unittest
 from copy import copy
 import ldap3
-from pgcdfga.ldapconnection import LDAPConnectionException, LDAPConnection
+from unittest.mock import Mock, patch
+from pgcdfga.ldapconnection import LDAPConnectionException, LDAPConnection, MembershipCache
 
 
 class LDAPConnectionTest(unittest.TestCase):
@@ -58,6 +59,85 @@ class LDAPConnectionTest(unittest.TestCase):
         result = ldap_con.ldap_grp_mmbrs(ldapfilter='team1')
         self.assertEqual(set(groupmembers), set(result))
 
+    def test_resolve_groups_mocked(self):
+        '''
+        Test resolve_groups to resolve simple filters with one search,
+        and leave complex filters to ldap_grp_mmbrs
+        '''
+        mockdata = {}
+        for team in range(3):
+            mockdata['cn=team{0},OU=test,DC=example,DC=com'.format(team)] = {
+                'cn': ['team{0}'.format(team)],
+                'memberUid': ['user{0}'.format(team), 'user9', 'dummy']}
+        ldap_config = {'mockdata': mockdata, 'basedn': 'OU=test,DC=example,DC=com',
+                       'servers': ['ldap.example.com'], 'user': 'Nobody',
+                       'password': 'Secret', 'filter_template': '(cn=%s)', 'bulk_size': 2}
+        ldap_con = LDAPConnection(ldap_config)
+        search = LDAPConnection._LDAPConnection__paged_search
+        with patch.object(LDAPConnection, '_LDAPConnection__paged_search', autospec=True,
+                          side_effect=search) as mock_search:
+            ldap_con.resolve_groups([(None, 'team0'), (None, '(cn=TEAM1)'),
+                                     (None, '(cn=team2)'), (None, '(|(cn=team0)(cn=x))'),
+                                     (None, '(cn=team1)')])
+            self.assertEqual(mock_search.call_count, 3)
+            self.assertEqual(ldap_con.ldap_grp_mmbrs(ldapfilter='team0'), ['user0', 'user9'])
+            self.assertEqual(ldap_con.ldap_grp_mmbrs(ldapfilter='(cn=TEAM1)'),
+                             ['user1', 'user9'])
+            # Filters that only differ in case are resolved by the same search
+            self.assertEqual(ldap_con.ldap_grp_mmbrs(ldapfilter='(cn=team1)'),
+                             ['user1', 'user9'])
+            self.assertEqual(ldap_con.ldap_grp_mmbrs(ldapfilter='(cn=team2)'),
+                             ['user2', 'user9'])
+            self.assertEqual(ldap_con.ldap_grp_mmbrs(ldapfilter='(|(cn=team0)(cn=x))'),
+                             ['user0', 'user9'])
+            self.assertEqual(mock_search.call_count, 3)
+
+    def test_paged_search_closed(self):
+        '''
+        Test that a search that is stopped early returns its connection to the pool
+        '''
+        mockdata = {'cn=team{0},OU=test,DC=example,DC=com'.format(team): {
+            'cn': ['team{0}'.format(team)], 'memberUid': ['user{0}'.format(team)]}
+                    for team in range(3)}
+        ldap_config = {'mockdata': mockdata, 'basedn': 'OU=test,DC=example,DC=com',
+                       'servers': ['ldap.example.com'], 'user': 'Nobody',
+                       'password': 'Secret', 'filter_template': '(cn=%s)', 'connections': 1}
+        ldap_con = LDAPConnection(ldap_config)
+        search = ldap_con._LDAPConnection__paged_search('OU=test,DC=example,DC=com',
+                                                        '(cn=team*)', ['memberUid'])
+        next(search)
+        search.close()
+        # With one connection, this would block if the connection was not released
+        self.assertEqual(ldap_con.ldap_grp_mmbrs(ldapfilter='team1'), ['user1'])
+
+    def test_resolve_groups_concurrent(self):
+        '''
+        Test resolve_groups to search with a pool of connections,
+        and leave groups that failed to ldap_grp_mmbrs
+        '''
+        mockdata = {}
+        for team in range(4):
+            mockdata['cn=team{0},OU=test,DC=example,DC=com'.format(team)] = {
+                'cn': ['team{0}'.format(team)], 'memberUid': ['user{0}'.format(team)]}
+        ldap_config = {'mockdata': mockdata, 'basedn': 'OU=test,DC=example,DC=com',
+                       'servers': ['ldap.example.com'], 'user': 'Nobody',
+                       'password': 'Secret', 'connections': 2}
+        ldap_con = LDAPConnection(ldap_config)
+        search = LDAPConnection._LDAPConnection__search_members
+        with patch.object(LDAPConnection, '_LDAPConnection__search_members',
+                          autospec=True) as mock_search:
+            mock_search.side_effect = lambda self, basedn, ldapfilter: (
+                1 / 0 if 'team3' in ldapfilter else search(self, basedn, ldapfilter))
+            queries = [(None, '(&(cn=team{0})(cn=*))'.format(team)) for team in range(4)]
+            ldap_con.resolve_groups(queries)
+            self.assertEqual(mock_search.call_count, 4)
+            for team in range(3):
+                self.assertEqual(ldap_con.ldap_grp_mmbrs(*queries[team]),
+                                 ['user{0}'.format(team)])
+            self.assertEqual(mock_search.call_count, 4)
+            with self.assertRaises(ZeroDivisionError):
+                ldap_con.ldap_grp_mmbrs(*queries[3])
+
     def test_mocked_invalid_filter(self):
         '''
         Test test_mocked_invalid_filter without ldap filter and ldap filter template.
@@ -129,3 +209,115 @@ class LDAPConnectionTest(unittest.TestCase):
             mia_ldap_config = copy(ldap_config)
             del mia_ldap_config[key]
             self.assertIsNone(LDAPConnection(mia_ldap_config).connect())
+
+
+class MembershipCacheTest(unittest.TestCase):
+    """
+    Test the MembershipCache Class.
+    """
+    def test_ttl(self):
+        '''
+        Test MembershipCache to return cached members until they are older than ttl
+        '''
+        cache = MembershipCache()
+        lookup = Mock(return_value=['user1'])
+        with patch('pgcdfga.ldapconnection.time.monotonic', return_value=100):
+            self.assertEqual(cache.get('key', lookup, 60, 600), ['user1'])
+        with patch('pgcdfga.ldapconnection.time.monotonic', return_value=150):
+            self.assertEqual(cache.get('key', lookup, 60, 600), ['user1'])
+        self.assertEqual(lookup.call_count, 1)
+        self.assertEqual(cache.stats['hits'], 1)
+        self.assertEqual(cache.stats['misses'], 1)
+
+    def test_stale_while_revalidate(self):
+        '''
+        Test MembershipCache to return stale members while refreshing in the background
+        '''
+        cache = MembershipCache()
+        with patch('pgcdfga.ldapconnection.time.monotonic', return_value=100):
+            cache.get('key', Mock(return_value=['user1']), 60, 600)
+        with patch('pgcdfga.ldapconnection.time.monotonic', return_value=200):
+            self.assertEqual(cache.get('key', Mock(return_value=['user2']), 60, 600),
+                             ['user1'])
+            cache.join()
+            self.assertEqual(cache.get('key', Mock(), 60, 600), ['user2'])
+        self.assertEqual(cache.stats['stale_hits'], 1)
+        self.assertEqual(cache.stats['refreshes'], 1)
+
+    def test_concurrent_refreshes(self):
+        '''
+        Test MembershipCache to count refreshes that run at the same time
+        '''
+        cache = MembershipCache()
+        keys = ['key{}'.format(index) for index in range(20)]
+        with patch('pgcdfga.ldapconnection.time.monotonic', return_value=100):
+            for key in keys:
+                cache.get(key, Mock(return_value=['user1']), 60, 600)
+        with patch('pgcdfga.ldapconnection.time.monotonic', return_value=200):
+            for index, key in enumerate(keys):
+                lookup = Mock(return_value=['user2']) if index % 2 else \
+                    Mock(side_effect=ldap3.core.exceptions.LDAPSocketOpenError)
+                cache.get(key, lookup, 60, 600)
+            cache.join()
+        self.assertEqual(cache.stats['refreshes'], 10)
+        self.assertEqual(cache.stats['refresh_errors'], 10)
+        self.assertEqual(cache.stats['stale_hits'], 20)
+
+    def test_resolve_groups_stale(self):
+        '''
+        Test resolve_groups to leave stale groups to the cache, which refreshes them in the
+        background
+        '''
+        cache = MembershipCache()
+        ldap_config = {'servers': ['ldap.example.com'], 'user': 'Nobody', 'password': 'Secret',
+                       'basedn': 'OU=test,DC=example,DC=com', 'filter_template': '(cn=%s)',
+                       'cache_ttl': 60, 'cache_max_staleness': 600,
+                       'mockdata': {'cn=team1,OU=test,DC=example,DC=com': {
+                           'cn': ['team1'], 'memberUid': ['user1']}}}
+        with patch('pgcdfga.ldapconnection.time.monotonic', return_value=100):
+            ldap_con = LDAPConnection(ldap_config, cache=cache)
+            ldap_con.resolve_groups([(None, 'team1')])
+            self.assertEqual(ldap_con.ldap_grp_mmbrs(ldapfilter='team1'), ['user1'])
+        self.assertEqual(cache.stats['misses'], 1)
+        with patch('pgcdfga.ldapconnection.time.monotonic', return_value=200):
+            ldap_con = LDAPConnection(ldap_config, cache=cache)
+            with patch.object(LDAPConnection, '_LDAPConnection__search_bulk') as mock_search:
+                ldap_con.resolve_groups([(None, 'team1')])
+                mock_search.assert_not_called()
+            self.assertEqual(ldap_con.ldap_grp_mmbrs(ldapfilter='team1'), ['user1'])
+            cache.join()
+        self.assertEqual(cache.stats['stale_hits'], 1)
+        self.assertEqual(cache.stats['refreshes'], 1)
+
+    def test_outage(self):
+        '''
+        Test MembershipCache to fall back to stale members when ldap is down,
+        but not longer than max_staleness
+        '''
+        cache = MembershipCache()
+        failing = Mock(side_effect=ldap3.core.exceptions.LDAPSocketOpenError)
+        with patch('pgcdfga.ldapconnection.time.monotonic', return_value=100):
+            cache.get('key', Mock(return_value=['user1']), 60, 600)
+        with patch('pgcdfga.ldapconnection.time.monotonic', return_value=200):
+            self.assertEqual(cache.get('key', failing, 60, 600), ['user1'])
+            cache.join()
+        self.assertEqual(cache.stats['refresh_errors'], 1)
+        with patch('pgcdfga.ldapconnection.time.monotonic', return_value=800):
+            with self.assertRaises(ldap3.core.exceptions.LDAPSocketOpenError):
+                cache.get('key', failing, 60, 600)
+
+    def test_ldapconnection_cache(self):
+        '''
+        Test LDAPConnection to use the cache when cache_ttl is set
+        '''
+        cache = MembershipCache()
+        ldap_config = {'servers': ['ldap.example.com'], 'user': 'Nobody',
+                       'password': 'Secret', 'cache_ttl': 60}
+        with patch.object(LDAPConnection, 'connect') as mock_connect:
+            mock_connect.return_value.extend.standard.paged_search.return_value = [
+                {'raw_attributes': {'memberUid': [b'user1', b'dummy']}}]
+            for _ in range(2):
+                ldap_con = LDAPConnection(ldap_config, cache=cache)
+                self.assertEqual(ldap_con.ldap_grp_mmbrs(ldapfilter='(cn=team1)'), ['user1'])
+            self.assertEqual(mock_connect.call_count, 1)
+        self.assertEqual(cache.stats['hits'], 1)
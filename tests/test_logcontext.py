@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+
+# Copyright 2019 Bol.com
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''
+This module holds all unit tests for the logcontext module
+'''
+import asyncio
+import logging
+import unittest
+from pgcdfga.logcontext import CLUSTER, ClusterFilter, cluster_logging, run_as, worker_pool
+
+
+logging.disable(logging.CRITICAL)
+
+
+def record(msg, *args):
+    '''
+    Returns a log record with msg and args.
+    '''
+    return logging.LogRecord('root', logging.INFO, __file__, 1, msg, args, None)
+
+
+class LogContextTest(unittest.TestCase):
+    """
+    Test prefixing log lines with the name of a cluster.
+    """
+    def test_filter(self):
+        '''
+        Test ClusterFilter to prefix messages only when a cluster is set, and only once
+        '''
+        log_filter = ClusterFilter()
+        plain = record('Dropping %s', 'role1')
+        self.assertTrue(log_filter.filter(plain))
+        self.assertEqual(plain.getMessage(), 'Dropping role1')
+        with cluster_logging('pg%1'):
+            prefixed = record('Dropping %s', 'role1')
+            self.assertTrue(log_filter.filter(prefixed))
+            log_filter.filter(prefixed)
+        self.assertEqual(prefixed.getMessage(), 'pg%1: Dropping role1')
+        self.assertIsNone(CLUSTER.get())
+
+    def test_threads(self):
+        '''
+        Test that the workers of worker_pool use the cluster of the thread that created it
+        '''
+        with worker_pool(2) as pool:
+            self.assertEqual(list(pool.map(lambda _: CLUSTER.get(), range(2))), [None, None])
+
+        def workers():
+            with worker_pool(2) as pool:
+                return list(pool.map(lambda _: CLUSTER.get(), range(4)))
+        self.assertEqual(run_as('pg1', workers), ['pg1'] * 4)
+        self.assertIsNone(CLUSTER.get())
+
+    def test_tasks(self):
+        '''
+        Test that asyncio tasks each have their own cluster
+        '''
+        async def task(name):
+            with cluster_logging(name):
+                await asyncio.sleep(0.01)
+                return CLUSTER.get()
+
+        async def run():
+            return await asyncio.gather(task('pg1'), task('pg2'))
+        self.assertEqual(asyncio.run(run()), ['pg1', 'pg2'])
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+
+# Copyright 2019 Bol.com
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''
+This module holds all unit tests for the metrics module
+'''
+import os
+import logging
+import tempfile
+import unittest
+import urllib.request
+from unittest.mock import patch
+from pgcdfga.metrics import Registry, QUERIES, DDL_STATEMENTS, OBJECTS, CONNECTION_POOL
+from pgcdfga.pgconnection import PGConnection
+
+
+logging.disable(logging.CRITICAL)
+
+
+class RegistryTest(unittest.TestCase):
+    """
+    Test the Registry Class (and its metrics).
+    """
+    def test_exposition(self):
+        '''
+        Test Registry to expose counters and histograms in the Prometheus text format
+        '''
+        registry = Registry()
+        counter = registry.counter('test_queries_total', 'Queries', ['database'])
+        counter.inc(database='postgres')
+        counter.inc(2, database='my "db"')
+        histogram = registry.histogram('test_seconds', 'Latency', buckets=(0.1, 1))
+        histogram.observe(0.05)
+        histogram.observe(0.5)
+        self.assertIs(registry.counter('test_queries_total', 'Queries', ['database']), counter)
+        self.assertEqual(registry.exposition(), '\n'.join([
+            '# HELP test_queries_total Queries',
+            '# TYPE test_queries_total counter',
+            'test_queries_total{database="my \\"db\\""} 2',
+            'test_queries_total{database="postgres"} 1',
+            '# HELP test_seconds Latency',
+            '# TYPE test_seconds histogram',
+            'test_seconds_bucket{le="0.1"} 1',
+            'test_seconds_bucket{le="1"} 2',
+            'test_seconds_bucket{le="+Inf"} 2',
+            'test_seconds_sum 0.55',
+            'test_seconds_count 2', '']))
+        with self.assertRaises(ValueError):
+            counter.inc(schema='public')
+
+    def test_textfile(self):
+        '''
+        Test Registry to write metrics to a file for the textfile collector
+        '''
+        registry = Registry()
+        registry.gauge('test_skip_rate', 'Skip rate').set(0.5)
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'pgcdfga.prom')
+            registry.write_textfile(filename)
+            with open(filename) as textfile:
+                self.assertIn('test_skip_rate 0.5\n', textfile.read())
+            self.assertEqual(os.listdir(directory), ['pgcdfga.prom'])
+
+    def test_serve(self):
+        '''
+        Test Registry to serve metrics over http
+        '''
+        registry = Registry()
+        registry.counter('test_runs_total', 'Runs').inc()
+        server = registry.serve(0, '127.0.0.1')
+        try:
+            url = 'http://127.0.0.1:{}/metrics'.format(server.server_address[1])
+            with urllib.request.urlopen(url) as response:
+                self.assertIn(b'test_runs_total 1\n', response.read())
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_instrumented(self):
+        '''
+        Test PGConnection to count queries per database, DDL statements and changed objects
+        '''
+        queries = QUERIES.value(database='db1')
+        statements = DDL_STATEMENTS.value()
+        created = OBJECTS.value(object='extension', action='created')
+        with patch('psycopg2.connect') as mock_connect:
+            mock_connect.return_value.cursor.return_value.fetchall.return_value = []
+            pgconn = PGConnection(dsn_params={'server': 'server1'})
+            self.assertTrue(pgconn.createextension('hstore', 'db1'))
+        self.assertEqual(QUERIES.value(database='db1'), queries + 2)
+        self.assertEqual(DDL_STATEMENTS.value(), statements + 1)
+        self.assertEqual(OBJECTS.value(object='extension', action='created'), created + 1)
+
+    def test_pool_metrics(self):
+        '''
+        Test PGConnection.export_metrics to add the pool events since the last export
+        '''
+        misses = CONNECTION_POOL.value(event='misses')
+        hits = CONNECTION_POOL.value(event='hits')
+        with patch('psycopg2.connect') as mock_connect:
+            mock_connect.return_value.closed = 0
+            mock_connect.return_value.get_transaction_status.return_value = 0
+            pgconn = PGConnection(dsn_params={'server': 'server1'})
+            pgconn.connect('db1')
+            pgconn.export_metrics()
+            self.assertEqual(CONNECTION_POOL.value(event='misses'), misses + 1)
+            pgconn.connect('db1')
+            pgconn.export_metrics()
+            self.assertEqual(CONNECTION_POOL.value(event='misses'), misses + 1)
+            self.assertEqual(CONNECTION_POOL.value(event='hits'), hits + 1)
+            pgconn.close()
+        self.assertEqual(CONNECTION_POOL.value(event='hits'), hits + 1)
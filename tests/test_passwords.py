@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+
+# Copyright 2019 Bol.com
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''
+This module holds all unit tests for the passwords module
+'''
+import base64
+import logging
+import unittest
+from unittest.mock import patch
+from pgcdfga import passwords
+from pgcdfga.passwords import md5_password, saslprep, scram_verifier, parse_scram_verifier, \
+    verifier_encryption, password_is_current, password_verifier, password_verifiers, \
+    VERIFIER_MEMO
+from pgcdfga.metrics import SCRAM_VERIFIERS
+
+
+logging.disable(logging.CRITICAL)
+
+# The user 'user' with password 'pencil' from the example exchange of RFC 7677
+RFC7677_VERIFIER = 'SCRAM-SHA-256$4096:W22ZaJ0SNY7soEsUEjb6gQ==$' \
+                   'WG5d8oPm3OtcPnkdi4Uo7BkeZkBFzpcXkuLmtbsT4qY=:' \
+                   'wfPLwcE6nTWhTAmQ7tl2KeoiWGPlZqQxSrmfPwDl2dU='
+
+
+class PasswordsTest(unittest.TestCase):
+    """
+    Test deriving and checking md5 and SCRAM-SHA-256 verifiers.
+    """
+    def setUp(self):
+        '''
+        Start every test with an empty memo.
+        '''
+        VERIFIER_MEMO.clear()
+
+    def test_scram_verifier(self):
+        '''
+        Test scram_verifier against the example of RFC 7677, and with a random salt
+        '''
+        salt = base64.b64decode('W22ZaJ0SNY7soEsUEjb6gQ==')
+        self.assertEqual(scram_verifier('pencil', salt), RFC7677_VERIFIER)
+        iterations, salt, _, _ = parse_scram_verifier(scram_verifier('pencil'))
+        self.assertEqual(iterations, 4096)
+        self.assertEqual(len(salt), 16)
+        self.assertNotEqual(scram_verifier('pencil'), scram_verifier('pencil'))
+        self.assertIsNone(parse_scram_verifier('SCRAM-SHA-256$4096:!!$a:b'))
+        self.assertIsNone(parse_scram_verifier(None))
+
+    def test_saslprep(self):
+        '''
+        Test saslprep to normalize non ascii passwords, and to leave rejected passwords as is
+        '''
+        self.assertEqual(saslprep('pencil'), 'pencil')
+        # Non ascii space is mapped to space, soft hyphen is removed, and ligatures are split
+        self.assertEqual(saslprep('a\u00a0b\u00adc\ufb01'), 'a bcfi')
+        # Control characters are prohibited
+        self.assertEqual(saslprep('é\u0007'), 'é\u0007')
+
+    def test_verifier_encryption(self):
+        '''
+        Test verifier_encryption for md5, SCRAM-SHA-256 and cleartext passwords
+        '''
+        self.assertEqual(verifier_encryption(md5_password('user', 'pencil')), 'md5')
+        self.assertEqual(verifier_encryption(RFC7677_VERIFIER), 'scram-sha-256')
+        self.assertIsNone(verifier_encryption('pencil'))
+        self.assertIsNone(verifier_encryption(None))
+
+    def test_password_is_current(self):
+        '''
+        Test password_is_current for md5, SCRAM-SHA-256 and hashed passwords in the config
+        '''
+        md5_verifier = md5_password('user', 'pencil')
+        self.assertTrue(password_is_current('user', 'pencil', md5_verifier, 'md5'))
+        self.assertFalse(password_is_current('user', 'crayon', md5_verifier, 'md5'))
+        self.assertTrue(password_is_current('user', 'pencil', RFC7677_VERIFIER,
+                                            'scram-sha-256'))
+        self.assertFalse(password_is_current('user', 'crayon', RFC7677_VERIFIER,
+                                             'scram-sha-256'))
+        # Stored with another encryption than the configured one
+        self.assertFalse(password_is_current('user', 'pencil', md5_verifier, 'scram-sha-256'))
+        self.assertFalse(password_is_current('user', 'pencil', RFC7677_VERIFIER, 'md5'))
+        self.assertFalse(password_is_current('user', 'pencil', None, 'md5'))
+        # Hashed in the config
+        self.assertTrue(password_is_current('user', md5_verifier, md5_verifier,
+                                            'scram-sha-256'))
+        self.assertTrue(password_is_current('user', RFC7677_VERIFIER, RFC7677_VERIFIER,
+                                            'md5'))
+        self.assertFalse(password_is_current('user', md5_verifier, RFC7677_VERIFIER,
+                                             'scram-sha-256'))
+
+    def test_memo(self):
+        '''
+        Test that the keys of a password that did not change are only derived once
+        '''
+        hits = SCRAM_VERIFIERS.value(event='hit')
+        derived = SCRAM_VERIFIERS.value(event='derived')
+        with patch.object(passwords, 'scram_keys', wraps=passwords.scram_keys) as mock_keys:
+            for _ in range(3):
+                self.assertTrue(password_is_current('user', 'pencil', RFC7677_VERIFIER,
+                                                    'scram-sha-256'))
+            self.assertEqual(mock_keys.call_count, 1)
+            # A changed password is derived again, and replaces the memo of the user
+            self.assertFalse(password_is_current('user', 'crayon', RFC7677_VERIFIER,
+                                                 'scram-sha-256'))
+            self.assertTrue(password_is_current('user', 'pencil', RFC7677_VERIFIER,
+                                                'scram-sha-256'))
+            self.assertEqual(mock_keys.call_count, 3)
+        self.assertEqual(SCRAM_VERIFIERS.value(event='hit'), hits + 2)
+        self.assertEqual(SCRAM_VERIFIERS.value(event='derived'), derived + 3)
+
+    def test_password_verifiers(self):
+        '''
+        Test password_verifiers, with and without a pool of workers
+        '''
+        self.assertEqual(password_verifier('user', 'pencil'), md5_password('user', 'pencil'))
+        self.assertEqual(password_verifier('user', RFC7677_VERIFIER, 'md5'), RFC7677_VERIFIER)
+        users = {'user{}'.format(index): 'pencil{}'.format(index) for index in range(4)}
+        users['hashed'] = RFC7677_VERIFIER
+        expected = {username: md5_password(username, password)
+                    for username, password in users.items()}
+        expected['hashed'] = RFC7677_VERIFIER
+        self.assertEqual(password_verifiers(users), expected)
+        for threshold in [100, 2]:
+            verifiers = password_verifiers(users, 'scram-sha-256', threshold)
+            self.assertEqual(set(verifiers), set(users))
+            self.assertEqual(verifiers['hashed'], RFC7677_VERIFIER)
+            for username, password in users.items():
+                self.assertTrue(password_is_current(username, password, verifiers[username],
+                                                    'scram-sha-256'))
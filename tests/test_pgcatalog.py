@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+
+# Copyright 2019 Bol.com
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''
+This module holds all unit tests for the pgcatalog module
+'''
+import unittest
+import unittest.mock
+from pgcdfga.pgcatalog import PGCatalog, NEW_ROLE_ATTRIBUTES, catalog_fingerprint, \
+    DATABASE_FINGERPRINT_QUERY, ROLES_QUERY, MEMBERS_QUERY, PASSWORDS_QUERY, DATABASES_QUERY
+
+
+def fake_catalog_run_sql():
+    '''
+    Returns a mock that can be used as run_sql for PGCatalog.load.
+    '''
+    # Rows hold the columns in the order of the query, like PGConnection.run_sql returns them
+    dba = dict({'rolname': 'dba'}, **dict(NEW_ROLE_ATTRIBUTES, rolsuper=True))
+    scot = dict({'rolname': 'scot'}, **dict(NEW_ROLE_ATTRIBUTES, rolcanlogin=True))
+    postgres = dict({'rolname': 'postgres'}, **dict(NEW_ROLE_ATTRIBUTES, rolsuper=True,
+                                                    rolcanlogin=True))
+    results = [None,
+               [{'usename': 'postgres'}],
+               [dba, scot, postgres],
+               [{'granted_role': 'dba', 'grantee_role': 'scot'}],
+               [{'usename': 'scot', 'passwd': 'md5' + 'a' * 32},
+                {'usename': 'postgres', 'passwd': None}],
+               [{'datname': 'postgres', 'owner': 'postgres'}],
+               None]
+    return unittest.mock.Mock(side_effect=results)
+
+
+class PGCatalogTest(unittest.TestCase):
+    """
+    Test the PGCatalog Class.
+    """
+    def test_load(self):
+        '''
+        Test PGCatalog.load for normal functionality
+        '''
+        run_sql = fake_catalog_run_sql()
+        catalog = PGCatalog()
+        catalog.load(run_sql)
+        run_sql.assert_any_call('BEGIN ISOLATION LEVEL REPEATABLE READ READ ONLY')
+        run_sql.assert_called_with('COMMIT')
+        self.assertEqual(catalog.current_user, 'postgres')
+        self.assertTrue(catalog.role_exists('dba'))
+        self.assertFalse(catalog.role_exists('postgres', exclude_current_user=True))
+        self.assertFalse(catalog.role_exists('john'))
+        self.assertTrue(catalog.role_has_option('dba', 'rolsuper'))
+        self.assertFalse(catalog.role_has_option('dba', 'not rolsuper'))
+        self.assertTrue(catalog.role_has_option('scot', 'not rolsuper'))
+        self.assertFalse(catalog.role_has_option('john', 'rolsuper'))
+        self.assertTrue(catalog.is_member('scot', 'dba'))
+        self.assertFalse(catalog.is_member('dba', 'scot'))
+        self.assertEqual(catalog.grantees('dba'), {'scot'})
+        self.assertEqual(catalog.password('scot'), (True, 'md5' + 'a' * 32))
+        self.assertEqual(catalog.password('dba'), (False, None))
+        self.assertEqual(catalog.databases, {'postgres': 'postgres'})
+
+    def test_load_iter_sql(self):
+        '''
+        Test PGCatalog.load to stream the bulk queries through iter_sql
+        '''
+        run_sql = unittest.mock.Mock(side_effect=[None, [{'usename': 'postgres'}], None])
+        rows = {ROLES_QUERY: [('postgres', True, True, True, True, True, True)],
+                MEMBERS_QUERY: [],
+                PASSWORDS_QUERY: [('postgres', None)],
+                DATABASES_QUERY: [('postgres', 'postgres'), ('app', 'postgres')]}
+        iter_sql = unittest.mock.Mock(side_effect=lambda query: iter(rows[query]))
+        catalog = PGCatalog()
+        catalog.load(run_sql, iter_sql)
+        self.assertEqual(iter_sql.call_count, 4)
+        self.assertEqual(run_sql.call_count, 3)
+        self.assertTrue(catalog.role_has_option('postgres', 'rolreplication'))
+        self.assertEqual(catalog.members, {})
+        self.assertEqual(catalog.password('postgres'), (True, None))
+        self.assertEqual(catalog.databases, {'postgres': 'postgres', 'app': 'postgres'})
+
+    def test_load_commits_on_error(self):
+        '''
+        Test PGCatalog.load to end the transaction when a query fails
+        '''
+        run_sql = unittest.mock.Mock(side_effect=[None, KeyError('usename'), None])
+        with self.assertRaises(KeyError):
+            PGCatalog().load(run_sql)
+        run_sql.assert_called_with('COMMIT')
+
+    def test_updates(self):
+        '''
+        Test PGCatalog methods that keep the snapshot in line with issued DDL
+        '''
+        catalog = PGCatalog()
+        catalog.load(fake_catalog_run_sql())
+        catalog.add_role('john')
+        self.assertTrue(catalog.role_has_option('john', 'not rolcanlogin'))
+        self.assertEqual(catalog.password('john'), (False, None))
+        catalog.set_role_option('john', 'rolcanlogin')
+        self.assertEqual(catalog.password('john'), (True, None))
+        catalog.set_password('john', 'md5' + 'b' * 32)
+        self.assertEqual(catalog.password('john'), (True, 'md5' + 'b' * 32))
+        catalog.add_member('john', 'dba')
+        self.assertEqual(catalog.grantees('dba'), {'scot', 'john'})
+        catalog.remove_member('scot', 'dba')
+        self.assertEqual(catalog.grantees('dba'), {'john'})
+        catalog.drop_role('john')
+        self.assertFalse(catalog.role_exists('john'))
+        self.assertEqual(catalog.grantees('dba'), set())
+        catalog.set_role_option('scot', 'not rolcanlogin')
+        self.assertEqual(catalog.password('scot'), (False, None))
+        catalog.set_database('foo', 'scot')
+        self.assertEqual(catalog.databases['foo'], 'scot')
+        catalog.drop_database('foo')
+        self.assertNotIn('foo', catalog.databases)
+
+    def test_catalog_fingerprint(self):
+        '''
+        Test catalog_fingerprint to fingerprint the cluster and the databases that exist
+        '''
+        def run_sql(query, database='postgres'):
+            '''
+            Fake run_sql that returns a row per query.
+            '''
+            if query.startswith('SELECT datname'):
+                return [{'datname': 'postgres'}, {'datname': 'app1'}, {'datname': 'app2'}]
+            if query == DATABASE_FINGERPRINT_QUERY:
+                return [{'source': 'pg_extension', 'num_rows': 1, 'xmin_sum': len(database)}]
+            return [{'source': 'pg_authid', 'num_rows': 3, 'xmin_sum': 1234}]
+        for parallelism in [1, 2]:
+            rows = catalog_fingerprint(run_sql, ['app2', 'app1', 'missing'], parallelism)
+            self.assertEqual([row.get('database') for row in rows], [None, 'app1', 'app2'])
@@ -17,8 +17,19 @@
 '''
 This module holds all unit tests for the pgcdfga module
 '''
+import time
+import signal
+import asyncio
+import threading
 import unittest
+import unittest.mock
+import psycopg2
 from pgcdfga import pgcdfga
+from pgcdfga.planner import DesiredState, Operation, plan
+from pgcdfga.pgcatalog import PGCatalog
+from pgcdfga.pgconnection import PGConnection
+from pgcdfga.fingerprint import ChangeDetector
+from pgcdfga.configmodel import UserConfig, compile_config
 
 
 class DictWithDefaultsTest(unittest.TestCase):
@@ -51,20 +62,231 @@ class DictWithDefaultsTest(unittest.TestCase):
             pgcdfga.dict_with_defaults(correct, listvalues)
 
 
-class NonWordCharReTest(unittest.TestCase):
+class CompileTest(unittest.TestCase):
     """
-    Test the Non Word Characters regular expression.
+    Test compiling config into a desired state.
     """
-    def test_valid_non_word_char_re(self):
+    def test_compile_user(self):
         '''
-        Test NON_WORD_CHAR_RE for matches
+        Test compile_user for ldap groups, passwords and expired users
         '''
-        self.assertEqual(pgcdfga.NON_WORD_CHAR_RE.search('123_!?').group(0), '_')
-        self.assertEqual(pgcdfga.NON_WORD_CHAR_RE.search('abc!?_').group(0), '!')
-        self.assertEqual(pgcdfga.NON_WORD_CHAR_RE.search('ABC?_!').group(0), '?')
+        ldapconn = unittest.mock.Mock()
+        ldapconn.ldap_grp_mmbrs.return_value = ['john', 'jane']
+        desired = DesiredState()
+        pgcdfga.compile_user(desired, UserConfig('dbateam', {'auth': 'ldap-group',
+                                                             'memberof': ['dba'],
+                                                             'options': ['superuser']}),
+                             ldapconn)
+        pgcdfga.compile_user(desired, UserConfig('scot', {'auth': 'password',
+                                                          'password': 'tiger'}), ldapconn)
+        pgcdfga.compile_user(desired, UserConfig('smannem', {'auth': 'ldap-user',
+                                                             'expiry': 2018}), ldapconn)
+        ldapconn.ldap_grp_mmbrs.assert_called_with(ldapbasedn=None, ldapfilter='dbateam')
+        self.assertEqual(desired.roles, {'dbateam': set(), 'john': {'LOGIN', 'SUPERUSER'},
+                                         'jane': {'LOGIN', 'SUPERUSER'}, 'dba': set(),
+                                         'scot': {'LOGIN'}})
+        self.assertEqual(desired.grants, {('john', 'dbateam'), ('jane', 'dbateam'),
+                                          ('dbateam', 'dba')})
+        self.assertEqual(desired.password_resets, {'john', 'jane', 'dbateam'})
+        self.assertEqual(desired.passwords, {'scot': 'tiger'})
+        self.assertEqual(desired.absent_roles, {'smannem'})
 
-    def test_invalid_non_word_char_re(self):
+    def test_compile_databases(self):
         '''
-        Test NON_WORD_CHAR_RE for non-matches
+        Test compile_databases for databases and extensions
         '''
-        self.assertEqual(pgcdfga.NON_WORD_CHAR_RE.search('1234abcdABCD'), None)
+        desired = DesiredState()
+        databases = {'app': {'extensions': {'pg_stat_statements': {'version': 1.5},
+                                            'hstore': {'ensure': 'absent'}}},
+                     'old': {'ensure': 'absent'}}
+        model = compile_config({'databases': databases})
+        pgcdfga.compile_databases(desired, model.databases)
+        self.assertEqual(desired.databases, {'app': 'app'})
+        self.assertEqual(desired.absent_databases, {'old'})
+        self.assertEqual(desired.extensions, {'app': {'pg_stat_statements': ('public', 1.5)}})
+        self.assertEqual(desired.absent_extensions, {'app': {'hstore'}})
+        self.assertEqual(desired.grants, {('opex', 'app'), ('readonly', 'app_readonly')})
+
+    def test_event_triggers_strict_extensions(self):
+        '''
+        Test that strict extensions do not drop the language of the event trigger function
+        '''
+        model = compile_config({'databases': {'app': {'extensions': {'hstore': {}}}}})
+        pgconn = PGConnection(dsn_params={'server': 'server1'},
+                              strict_params={'users': False, 'databases': False,
+                                             'extensions': True})
+        pgconn.catalog = catalog = PGCatalog()
+        catalog.current_user = 'postgres'
+        for rolename in ['postgres', 'opex', 'readonly', 'app_readonly']:
+            catalog.add_role(rolename)
+        catalog.set_database('app', 'app')
+        catalog.extensions['app'] = {'hstore': '1.0', 'plpgsql': '1.0'}
+        ldapconn = unittest.mock.Mock()
+        for event_triggers, dropped in [(False, ['plpgsql']), (True, [])]:
+            desired, errors = pgcdfga.compile_desired(pgconn, ldapconn, model, event_triggers)
+            self.assertEqual(errors, 0)
+            self.assertEqual([operation.args[0] for operation in plan(desired, pgconn)
+                              if operation.method == 'dropextension'], dropped)
+        # Unless the language is configured to be absent
+        model = compile_config({'databases': {'app': {'extensions': {
+            'plpgsql': {'ensure': 'absent'}}}}})
+        desired, _ = pgcdfga.compile_desired(pgconn, ldapconn, model, True)
+        self.assertNotIn('plpgsql', desired.extensions['app'])
+
+
+class ProcesFgaTest(unittest.TestCase):
+    """
+    Test skipping runs where nothing changed.
+    """
+    def test_skip_unchanged(self):
+        '''
+        Test proces_fga to skip a run when the fingerprint did not change
+        '''
+        configdata = {'users': {'dbateam': {'auth': 'ldap-group'}}}
+        ldapconn = unittest.mock.Mock()
+        ldapconn.ldap_grp_mmbrs.return_value = ['john']
+        pgconn = unittest.mock.Mock()
+        detector = ChangeDetector()
+        with unittest.mock.patch.object(pgcdfga, 'catalog_fingerprint') as mock_fingerprint, \
+                unittest.mock.patch.object(pgcdfga, 'plan_fga') as mock_plan, \
+                unittest.mock.patch.object(pgcdfga, 'apply') as mock_apply:
+            mock_fingerprint.side_effect = [['before'], ['after'], ['after'], ['after']]
+            mock_plan.return_value = ([Operation('roles', 'users', 'createrole', ('john',),
+                                                 None)], 0)
+            mock_apply.return_value = 0
+            self.assertEqual(pgcdfga.proces_fga(configdata, pgconn, ldapconn, detector), 0)
+            self.assertEqual(pgcdfga.proces_fga(configdata, pgconn, ldapconn, detector), 0)
+            self.assertEqual(mock_plan.call_count, 1)
+            ldapconn.ldap_grp_mmbrs.return_value = ['john', 'jane']
+            self.assertEqual(pgcdfga.proces_fga(configdata, pgconn, ldapconn, detector), 0)
+            self.assertEqual(mock_plan.call_count, 2)
+        self.assertEqual(detector.stats, {'runs': 3, 'skipped': 1})
+
+
+class ClustersTest(unittest.TestCase):
+    """
+    Test managing more than one cluster from one process.
+    """
+    def test_cluster_configs(self):
+        '''
+        Test cluster_configs for one cluster, and a list of clusters with overrides
+        '''
+        configdata = {'postgresql': {'dsn': {'host': 'pg1'}}, 'strict': {'users': True}}
+        self.assertEqual(pgcdfga.cluster_configs(configdata), [('pg1', configdata)])
+        configdata['postgresql'] = [{'name': 'main', 'dsn': {'host': 'pg1'},
+                                     'strict': {'databases': True}},
+                                    {'dsn': {'host': 'pg2', 'port': 5433},
+                                     'general': {'parallelism': 1}},
+                                    {'dsn': {}}]
+        configs = pgcdfga.cluster_configs(configdata)
+        self.assertEqual([name for name, _ in configs], ['main', 'pg2:5433', 'cluster2'])
+        self.assertEqual(configs[0][1]['postgresql'], {'dsn': {'host': 'pg1'}})
+        self.assertEqual(configs[0][1]['strict'], {'users': True, 'databases': True})
+        self.assertEqual(configs[1][1]['strict'], {'users': True})
+        self.assertEqual(configs[1][1]['general'], {'parallelism': 1})
+        configdata['postgresql'].append({'dsn': {'host': 'pg2', 'port': 5433}})
+        with self.assertRaises(ValueError):
+            pgcdfga.cluster_configs(configdata)
+        configdata['postgresql'] = {'main': {'dsn': {'host': 'pg1'}},
+                                    'backup': {'dsn': {'host': 'pg2'},
+                                               'general': {'parallelism': 1}}}
+        configs = pgcdfga.cluster_configs(configdata)
+        self.assertEqual([name for name, _ in configs], ['main', 'backup'])
+        self.assertEqual(configs[1][1]['postgresql'], {'dsn': {'host': 'pg2'}})
+        self.assertEqual(configs[1][1]['general'], {'parallelism': 1})
+
+    def test_run_clusters(self):
+        '''
+        Test run_clusters to run clusters concurrently, without waiting for slow clusters
+        '''
+        release = threading.Event()
+
+        def proces_fga(configdata, _pgconn, _ldapconn, _detector, _model):
+            host = configdata['postgresql']['dsn']['host']
+            if host == 'down':
+                raise psycopg2.OperationalError('could not connect to server')
+            if host == 'slow':
+                release.wait(10)
+            return 0
+        configdata = {'postgresql': [{'dsn': {'host': host}} for host in ['up', 'down', 'slow']],
+                      'general': {'cluster_timeout': 1}, 'users': {}}
+        # The general chapter of a cluster does not override process wide options
+        configdata['postgresql'][0]['general'] = {'cluster_timeout': 60}
+        ldapconn = unittest.mock.Mock()
+        clusters = {}
+        with unittest.mock.patch.object(pgcdfga, 'PGConnection') as mock_pgconnection, \
+                unittest.mock.patch.object(pgcdfga, 'proces_fga') as mock_proces_fga:
+            mock_pgconnection.return_value.is_standby.return_value = False
+            mock_proces_fga.side_effect = proces_fga
+            targets = pgcdfga.cluster_configs(configdata)
+            # The down cluster and the slow cluster count as an error
+            self.assertEqual(pgcdfga.run_clusters(clusters, configdata, targets, ldapconn), 2)
+            self.assertIsNone(clusters['down'].pgconn)
+            self.assertTrue(clusters['slow'].busy())
+            self.assertFalse(clusters['up'].busy())
+            # The slow cluster is skipped while it is still running
+            self.assertEqual(pgcdfga.run_clusters(clusters, configdata, targets, ldapconn), 2)
+            release.set()
+            clusters['slow'].future.result()
+            self.assertEqual(pgcdfga.run_clusters(clusters, configdata, targets, ldapconn), 1)
+            self.assertEqual(mock_proces_fga.call_count, 8)
+        # Ldap groups are resolved once for all clusters
+        self.assertEqual(ldapconn.resolve_groups.call_count, 3)
+
+    def test_run_clusters_async(self):
+        '''
+        Test run_clusters_async to run clusters on one event loop, without waiting for slow
+        clusters
+        '''
+        release = threading.Event()
+
+        async def proces_fga_async(configdata, _pgconn, _apgconn, _ldapconn, call, _detector,
+                                   ldap_resolved, _model):
+            await asyncio.shield(ldap_resolved)
+            host = configdata['postgresql']['dsn']['host']
+            if host == 'down':
+                raise psycopg2.OperationalError('could not connect to server')
+            if host == 'slow':
+                await call(release.wait, 10)
+            return 0
+        configdata = {'postgresql': [{'dsn': {'host': host}} for host in ['up', 'down', 'slow']],
+                      'general': {'cluster_timeout': 1}, 'users': {}}
+        # The general chapter of a cluster does not override process wide options
+        configdata['postgresql'][0]['general'] = {'cluster_timeout': 60}
+        ldapconn = unittest.mock.Mock()
+        clusters = {}
+        with unittest.mock.patch.object(pgcdfga, 'PGConnection') as mock_pgconnection, \
+                unittest.mock.patch.object(pgcdfga, 'proces_fga_async',
+                                           side_effect=proces_fga_async) as mock_proces_fga:
+            mock_pgconnection.return_value.is_standby.return_value = False
+            targets = pgcdfga.cluster_configs(configdata)
+            # The down cluster and the slow cluster count as an error
+            self.assertEqual(pgcdfga.run_clusters_async(clusters, configdata, targets, ldapconn), 2)
+            self.assertIsNone(clusters['down'].pgconn)
+            self.assertIsNotNone(clusters['up'].apgconn)
+            self.assertTrue(clusters['slow'].busy())
+            self.assertFalse(clusters['up'].busy())
+            # The slow cluster is skipped while its call is still running
+            self.assertEqual(pgcdfga.run_clusters_async(clusters, configdata, targets, ldapconn), 2)
+            release.set()
+            for _ in range(100):
+                if not clusters['slow'].busy():
+                    break
+                time.sleep(0.01)
+            self.assertEqual(pgcdfga.run_clusters_async(clusters, configdata, targets, ldapconn), 1)
+            self.assertEqual(mock_proces_fga.call_count, 8)
+        # Ldap groups are resolved once per run, for all clusters
+        self.assertEqual(ldapconn.resolve_groups.call_count, 3)
+
+
+class TerminateTest(unittest.TestCase):
+    """
+    Test the terminate function.
+    """
+    def test_terminate(self):
+        '''
+        Test that SIGTERM exits through SystemExit, so that cleanup handlers run
+        '''
+        with self.assertRaises(SystemExit) as context:
+            pgcdfga.terminate(signal.SIGTERM, None)
+        self.assertEqual(context.exception.code, 128 + signal.SIGTERM)
@@ -22,9 +22,14 @@ import tempfile
 import logging
 import unittest
 import unittest.mock
+import psycopg2
 from unittest.mock import patch
 from psycopg2.sql import Composed, SQL, Identifier
-from pgcdfga.pgconnection import PGConnection, PGConnectionException, STRICT_DEFAULTS
+from psycopg2.extras import NamedTupleCursor
+from pgcdfga.pgcatalog import NEW_ROLE_ATTRIBUTES
+from pgcdfga.pgconnection import PGConnection, PGConnectionException, STRICT_DEFAULTS, \
+    KeyFileCache, prepared_name, redact
+from pgcdfga.passwords import md5_password
 
 
 logging.disable(logging.CRITICAL)
@@ -119,6 +124,63 @@ class PGConnectionTest(unittest.TestCase):
             with self.assertRaises(PGConnectionException):
                 result = PGConnection(dsn_params={'server': 'server1'}).run_sql(test_qry)
 
+    def test_mocked_iter_sql(self):
+        '''
+        Test PGConnection.iter_sql to stream rows from a named server side cursor
+        '''
+        test_qry = 'SELECT rolname FROM pg_roles'
+        with unittest.mock.patch('psycopg2.connect') as mock_connect:
+            mock_con = mock_connect.return_value
+            mock_cur = mock_con.cursor.return_value
+            mock_cur.__iter__.return_value = iter([('postgres', ), ('scot', )])
+            pgcon = PGConnection(dsn_params={'server': 'server1'}, itersize=100)
+            rows = pgcon.iter_sql(test_qry)
+            mock_cur.execute.assert_not_called()
+            self.assertEqual(list(rows), [('postgres', ), ('scot', )])
+            mock_con.cursor.assert_called_with(name='pgcdfga_1', withhold=True,
+                                               cursor_factory=None)
+            mock_cur.execute.assert_called_with(test_qry, None)
+            mock_cur.fetchall.assert_not_called()
+            mock_cur.close.assert_called_with()
+            self.assertEqual(mock_cur.itersize, 100)
+
+            mock_cur.__iter__.return_value = iter([])
+            self.assertEqual(list(pgcon.iter_sql(test_qry, itersize=5, namedtuples=True)), [])
+            mock_con.cursor.assert_called_with(name='pgcdfga_2', withhold=True,
+                                               cursor_factory=NamedTupleCursor)
+            self.assertEqual(mock_cur.itersize, 5)
+
+    def test_mocked_run_prepared(self):
+        '''
+        Test PGConnection.run_prepared to prepare a query once per connection
+        '''
+        class StatementMissing(psycopg2.Error):
+            '''
+            The error postgres raises on EXECUTE of a statement that was not prepared.
+            '''
+            pgcode = '26000'
+
+        test_qry = 'SELECT rolname FROM pg_roles WHERE rolname LIKE $1'
+        name = prepared_name(test_qry)
+        with patch.object(PGConnection, 'run_sql') as mock_runsql:
+            mock_runsql.return_value = [{'rolname': 'scot'}]
+            pgcon = PGConnection(dsn_params={'server': 'server1'})
+            self.assertEqual(pgcon.run_prepared(test_qry, ['s%']), [{'rolname': 'scot'}])
+            mock_runsql.assert_called_with(
+                'PREPARE {0} AS SELECT rolname FROM pg_roles WHERE rolname LIKE $1;\n'
+                'EXECUTE {0} (%s)'.format(name), ['s%'], database='postgres')
+            pgcon.run_prepared(test_qry, ['j%'])
+            mock_runsql.assert_called_with('EXECUTE {} (%s)'.format(name), ['j%'],
+                                           database='postgres')
+            pgcon.run_prepared(test_qry, ['j%'], database='app')
+            self.assertTrue(mock_runsql.call_args[0][0].startswith('PREPARE'))
+
+            # After a reconnect, the statement is prepared again
+            mock_runsql.side_effect = [StatementMissing(), [{'rolname': 'jane'}]]
+            self.assertEqual(pgcon.run_prepared(test_qry, ['j%']), [{'rolname': 'jane'}])
+            self.assertTrue(mock_runsql.call_args[0][0].startswith('PREPARE'))
+            self.assertEqual(pgcon.prepared_stats(), {name: {'prepares': 3, 'hits': 1}})
+
     def test_mocked_is_standby(self):
         '''
         Test PGConnection.is_standby for normal functionality
@@ -194,21 +256,76 @@ class PGConnectionTest(unittest.TestCase):
         '''
         rolename = 'foobar'
         with patch.object(PGConnection, 'run_sql') as mock_runsql:
+            mock_runsql.return_value = [{'rolname': rolename, 'datname': 'postgres',
+                                         'owner': 'postgres'}]
             # Test with strict should return True if dropped and not else
             for strict in [True, False]:
                 pgcon = PGConnection(dsn_params={'server': 'server1'},
                                      strict_params={'users': strict})
                 self.assertEqual(pgcon.droprole(rolename), strict)
 
-            mock_runsql.return_value = [{'datname': 'postgres', 'owner': 'postgres'}]
             # Test with result on role query should return True
             pgcon = PGConnection(dsn_params={'server': 'server1'})
             self.assertTrue(pgcon.droprole(rolename))
-            expected_qry = Composed([SQL('DROP ROLE '), Identifier(rolename)])
-            mock_runsql.assert_called_with(expected_qry)
+            expected_qry = Composed([SQL('DROP ROLE '), Composed([Identifier(rolename)])])
+            mock_runsql.assert_called_with(expected_qry, database='postgres')
             mock_runsql.return_value = []
             self.assertFalse(pgcon.droprole(rolename))
 
+    def test_mocked_droproles(self):
+        '''
+        Test PGConnection.droproles to only reassign in databases with dependencies
+        '''
+        dependencies = [{'rolname': 'john', 'datname': 'app1', 'owner': 'app1'},
+                        {'rolname': 'jane', 'datname': 'app1', 'owner': 'app1'},
+                        {'rolname': 'jane', 'datname': 'app2', 'owner': 'jane'}]
+        with patch.object(PGConnection, 'run_sql') as mock_runsql:
+            mock_runsql.side_effect = [[{'rolname': 'john'}, {'rolname': 'jane'}],
+                                       dependencies, None, None, None]
+            pgcon = PGConnection(dsn_params={'server': 'server1'})
+            self.assertTrue(pgcon.droproles(['john', 'jane', 'missing'], parallelism=2))
+            self.assertEqual(mock_runsql.call_count, 5)
+            mock_runsql.assert_any_call(
+                Composed([SQL('REASSIGN OWNED BY '),
+                          Composed([Identifier('jane'), SQL(', '), Identifier('john')]),
+                          SQL(' TO '), Identifier('app1'), SQL('; DROP OWNED BY '),
+                          Composed([Identifier('jane'), SQL(', '), Identifier('john')])]),
+                database='app1')
+            mock_runsql.assert_any_call(
+                Composed([SQL('REASSIGN OWNED BY '), Composed([Identifier('jane')]),
+                          SQL(' TO '), SQL('CURRENT_USER'), SQL('; DROP OWNED BY '),
+                          Composed([Identifier('jane')])]), database='app2')
+            mock_runsql.assert_called_with(
+                Composed([SQL('DROP ROLE '),
+                          Composed([Identifier('john'), SQL(', '), Identifier('jane')])]),
+                database='postgres')
+
+    def test_mocked_droproles_fallback(self):
+        '''
+        Test PGConnection.droproles to skip system roles and retry failing statements per role
+        '''
+        def run_sql(query, parameters=None, database='postgres'):
+            statement = query.as_string(None) if isinstance(query, Composed) else query
+            if 'pg_shdepend' in statement:
+                return []
+            if 'pg_roles' in statement:
+                return [{'rolname': 'john'}, {'rolname': 'jane'}]
+            if 'jane' in statement:
+                raise psycopg2.Error(database)
+            return None
+        with patch.object(PGConnection, 'run_sql') as mock_runsql, \
+                patch.object(Composed, 'as_string', lambda self, context: repr(self)):
+            mock_runsql.side_effect = run_sql
+            pgcon = PGConnection(dsn_params={'server': 'server1'})
+            with self.assertRaises(PGConnectionException):
+                pgcon.droproles(['john', 'jane', 'pg_database_owner'])
+            mock_runsql.assert_any_call(Composed([SQL('DROP ROLE '),
+                                                  Composed([Identifier('john')])]),
+                                        database='postgres')
+            for call in mock_runsql.call_args_list:
+                self.assertNotIn('pg_database_owner', repr(call))
+            self.assertFalse(pgcon.droproles(['pg_read_all_data']))
+
     def test_mocked_createrole(self):
         '''
         Test PGConnection.createrole for normal functionality
@@ -223,11 +340,21 @@ class PGConnectionTest(unittest.TestCase):
             self.assertFalse(pgcon.createrole(rolename))
             mock_runsql.return_value = []
             self.assertTrue(pgcon.createrole(rolename, options))
-            expected_qrys.append(Composed([SQL('CREATE ROLE '), Identifier(rolename)]))
-            expected_qrys.append(Composed([SQL('ALTER ROLE '), Identifier(rolename),
+            expected_qrys.append(Composed([SQL('CREATE ROLE '), Identifier(rolename),
                                            SQL(' WITH SUPERUSER')]))
+            self.assertTrue(pgcon.createrole(rolename, ['login', 'superuser'], ['dba', 'ops']))
+            expected_qrys.append(Composed([SQL('CREATE ROLE '), Identifier(rolename),
+                                           SQL(' WITH LOGIN SUPERUSER'), SQL(' IN ROLE '),
+                                           Identifier('dba'), SQL(', '), Identifier('ops')]))
+            mock_runsql.return_value = [dict(NEW_ROLE_ATTRIBUTES, rolname=rolename,
+                                             rolsuper=True)]
+            self.assertTrue(pgcon.createrole(rolename, ['superuser', 'login', 'replication']))
+            expected_qrys.append(Composed([SQL('ALTER ROLE '), Identifier(rolename),
+                                           SQL(' WITH LOGIN REPLICATION')]))
+            self.assertFalse(pgcon.createrole(rolename, ['superuser']))
             for expected_qry in expected_qrys:
                 mock_runsql.assert_any_call(expected_qry)
+            self.assertEqual(mock_runsql.call_count, 8)
             with self.assertRaises(PGConnectionException):
                 pgcon.createrole(rolename, invalid_options)
 
@@ -239,7 +366,7 @@ class PGConnectionTest(unittest.TestCase):
         md5password = 'md5'+'a'*32
         normal_password = '12345'
         with patch.object(PGConnection, 'run_sql') as mock_runsql:
-            mock_runsql.return_value = [{'usename': rolename}]
+            mock_runsql.return_value = [{'passwd': None}]
             pgcon = PGConnection(dsn_params={'server': 'server1'})
             self.assertTrue(pgcon.setpassword(rolename, normal_password))
             self.assertTrue(pgcon.setpassword(rolename, md5password))
@@ -247,9 +374,32 @@ class PGConnectionTest(unittest.TestCase):
                                      SQL(' with encrypted password %s')])
             mock_runsql.assert_any_call(expected_qry, [md5password])
 
+            mock_runsql.return_value = [{'passwd': md5password}]
+            self.assertFalse(pgcon.setpassword(rolename, md5password))
+
             mock_runsql.return_value = []
             self.assertFalse(pgcon.setpassword(rolename, md5password))
 
+    def test_mocked_setpassword_scram(self):
+        '''
+        Test PGConnection.setpassword with password_encryption scram-sha-256
+        '''
+        rolename = 'foo'
+        with self.assertRaises(PGConnectionException):
+            PGConnection(dsn_params={'server': 'server1'}, password_encryption='sha1')
+        with patch.object(PGConnection, 'run_sql') as mock_runsql:
+            pgcon = PGConnection(dsn_params={'server': 'server1'},
+                                 password_encryption='scram-sha-256')
+            # A md5 verifier of the same password is replaced by a SCRAM-SHA-256 verifier
+            mock_runsql.return_value = [{'passwd': md5_password(rolename, '12345')}]
+            self.assertTrue(pgcon.setpassword(rolename, '12345'))
+            verifier = mock_runsql.call_args[0][1][0]
+            self.assertTrue(verifier.startswith('SCRAM-SHA-256$4096:'))
+
+            mock_runsql.return_value = [{'passwd': verifier}]
+            self.assertFalse(pgcon.setpassword(rolename, '12345'))
+            self.assertTrue(pgcon.setpassword(rolename, '54321'))
+
     def test_mocked_resetpassword(self):
         '''
         Test PGConnection.createrole for normal functionality
@@ -302,85 +452,37 @@ class PGConnectionTest(unittest.TestCase):
                                      SQL(' FROM '), Identifier(username)])
             mock_runsql.assert_any_call(expected_qry)
 
-    def test_mocked_strify_roles(self):
-        '''
-        Test PGConnection.strictifyroles for normal operation
-        '''
-        empty_testset = []
-        normal_testset = []
-        qry1 = []
-        qry2 = []
-        normal_testset.append(qry1)
-        normal_testset.append(qry2)
-        qry1.append({'grantee': 'john'})
-        qry2.append({'rolname': 'dba'})
-        qry2.append({'rolname': 'operator'})
-
-        with patch.object(PGConnection, 'run_sql') as mock_runsql, \
-                patch.object(PGConnection, 'droprole') as mock_droprole, \
-                patch.object(PGConnection, 'createrole') as mock_createrole, \
-                patch.object(PGConnection, 'revokerole') as mock_revokerole:
-            pgcon = PGConnection(dsn_params={'server': 'server1'})
-            mock_droprole.return_value = True
-            mock_revokerole.return_value = True
-            mock_createrole.return_value = True
-            pgcon.grantrole('scot', 'dba')
-            mock_runsql.side_effect = empty_testset
-            self.assertFalse(pgcon.strictifyroles())
-            mock_runsql.side_effect = normal_testset
-            self.assertTrue(pgcon.strictifyroles())
-            mock_droprole.assert_any_call('operator')
-            mock_revokerole.assert_any_call('john', 'dba')
-
-    def test_mocked_strify_databases(self):
+    def test_mocked_grantreadonly(self):
         '''
-        Test PGConnection.strictifydatabases for normal operation
+        Test PGConnection.grantreadonly to grant ungranted schemas and default privileges
         '''
-        with patch.object(PGConnection, 'run_sql') as mock_runsql, \
-                patch.object(PGConnection, 'createrole') as mock_createrole, \
-                patch.object(PGConnection, 'grantrole') as mock_grantrole, \
-                patch.object(PGConnection, 'dropdb') as mock_dropdb:
+        with patch.object(PGConnection, 'run_sql') as mock_runsql:
+            mock_runsql.side_effect = [[{'datname': 'app', 'owner': 'scot', 'granted': False}],
+                                       None, [{'schemaname': 'public'}], None]
             pgcon = PGConnection(dsn_params={'server': 'server1'})
-            mock_dropdb.return_value = True
-            mock_createrole.return_value = True
-            mock_grantrole.return_value = True
-            sql_return = []
-            mock_runsql.return_value = sql_return
-            pgcon.createdb('test1')
-            sql_return.append({'datname': 'postgres'})
-            sql_return.append({'datname': 'test1'})
-            self.assertFalse(pgcon.strictifydatabases())
-            sql_return.append({'datname': 'test2'})
-            # This line will throw a keyerror on parsing return of run_sql
-            sql_return.append({'keyError': 'This throws a'})
-            self.assertTrue(pgcon.strictifydatabases())
-            mock_dropdb.assert_any_call('test2')
-
-    def test_mocked_strify_extensions(self):
-        '''
-        Test PGConnection.strictifyextensions for normal operation
+            self.assertTrue(pgcon.grantreadonly('app', default_privileges=True))
+            mock_runsql.assert_any_call(
+                Composed([SQL('ALTER DEFAULT PRIVILEGES FOR ROLE '), Identifier('scot'),
+                          SQL(' GRANT SELECT ON TABLES TO '), Identifier('app_readonly')]),
+                database='app')
+            mock_runsql.assert_called_with(
+                Composed([SQL('GRANT SELECT ON ALL TABLES IN SCHEMA '), Identifier('public'),
+                          SQL(' TO '), Identifier('app_readonly')]), database='app')
+            mock_runsql.side_effect = [[{'datname': 'app', 'owner': 'scot', 'granted': True}],
+                                       []]
+            self.assertFalse(pgcon.grantreadonly('app', default_privileges=True))
+
+    def test_mocked_revokeroles(self):
+        '''
+        Test PGConnection.revokeroles to revoke from many users with one statement
         '''
-        with patch.object(PGConnection, 'run_sql') as mock_runsql, \
-                patch.object(PGConnection, 'createrole') as mock_createrole, \
-                patch.object(PGConnection, 'grantrole') as mock_grantrole, \
-                patch.object(PGConnection, 'dropextension') as mock_dropextension:
+        with patch.object(PGConnection, 'run_sql') as mock_runsql:
             pgcon = PGConnection(dsn_params={'server': 'server1'})
-            mock_dropextension.return_value = True
-            mock_createrole.return_value = True
-            mock_grantrole.return_value = True
-            sql_return = []
-            mock_runsql.return_value = sql_return
-            pgcon.createdb('test1')
-            # at this state, self.__extensions[dbname] will throw a keyerror
-            self.assertFalse(pgcon.strictifyextensions())
-            pgcon.createextension('extension1', 'test1')
-            sql_return.append({'extname': 'extension1'})
-            self.assertFalse(pgcon.strictifyextensions())
-            sql_return.append({'extname': 'extension2'})
-            # This line will throw a keyerror on parsing return of run_sql
-            sql_return.append({'keyError': 'This throws a'})
-            self.assertTrue(pgcon.strictifyextensions())
-            mock_dropextension.assert_any_call('extension2', 'test1')
+            self.assertTrue(pgcon.revokeroles('dba', ['john', 'jane']))
+            mock_runsql.assert_called_once_with(
+                Composed([SQL('REVOKE '), Identifier('dba'), SQL(' FROM '),
+                          Composed([Identifier('john'), SQL(', '), Identifier('jane')])]))
+            self.assertFalse(pgcon.revokeroles('dba', []))
 
     def test_mocked_dropextension(self):
         '''
@@ -432,3 +534,129 @@ class PGConnectionTest(unittest.TestCase):
             self.assertTrue(pgcon.createextension(extension_name, dbname=created_in_db))
             mock_runsql.assert_called_with(SQL(' ').join([expected_qry_create]),
                                            database=created_in_db)
+
+    def test_mocked_catalog_checks(self):
+        '''
+        Test PGConnection methods to answer existence checks from a loaded catalog
+        '''
+        with patch.object(PGConnection, 'run_sql') as mock_runsql, \
+                patch('pgcdfga.pgconnection.PGCatalog.load') as mock_load:
+            pgcon = PGConnection(dsn_params={'server': 'server1'})
+            catalog = pgcon.load_catalog()
+            mock_load.assert_called_with(pgcon.run_sql, pgcon.iter_sql)
+            catalog.current_user = 'postgres'
+            catalog.add_role('foo')
+            catalog.set_role_option('foo', 'rolcanlogin')
+            self.assertFalse(pgcon.createrole('foo', ['login']))
+            self.assertFalse(pgcon.resetpassword('foo'))
+            mock_runsql.assert_not_called()
+
+            self.assertTrue(pgcon.createrole('bar', ['superuser']))
+            self.assertTrue(catalog.role_has_option('bar', 'rolsuper'))
+            self.assertTrue(pgcon.grantrole('foo', 'bar'))
+            self.assertFalse(pgcon.grantrole('foo', 'bar'))
+            self.assertTrue(catalog.is_member('foo', 'bar'))
+            self.assertTrue(pgcon.setpassword('foo', 'md5' + 'a' * 32))
+            self.assertFalse(pgcon.setpassword('foo', 'md5' + 'a' * 32))
+            self.assertTrue(pgcon.revokerole('foo', 'bar'))
+            self.assertFalse(catalog.is_member('foo', 'bar'))
+            self.assertTrue(pgcon.droprole('bar'))
+            self.assertFalse(catalog.role_exists('bar'))
+            self.assertEqual(mock_runsql.call_count, 6)
+
+    def test_mocked_batch(self):
+        '''
+        Test PGConnection.run_ddl in batches, with savepoints to isolate failing statements
+        '''
+        statements = ['CREATE ROLE a', 'CREATE ROLE b', 'GRANT a TO b']
+        with unittest.mock.patch('psycopg2.connect') as mock_connect, \
+                patch.object(PGConnection, 'run_sql') as mock_runsql:
+            mock_cur = mock_connect.return_value.cursor.return_value
+            mock_cur.mogrify.side_effect = lambda query, parameters: query.encode()
+            pgcon = PGConnection(dsn_params={'server': 'server1'})
+            pgcon.start_batch(10)
+            for statement in statements:
+                pgcon.run_ddl(statement)
+            pgcon.run_ddl('GRANT SELECT ON ALL TABLES IN SCHEMA a TO b', database='db1')
+            mock_runsql.assert_not_called()
+            self.assertEqual(pgcon.flush_ddl(), 0)
+            mock_runsql.assert_any_call('BEGIN;\n' + ';\n'.join(statements) + ';\nCOMMIT',
+                                        database='postgres')
+            mock_runsql.assert_called_with('BEGIN;\nGRANT SELECT ON ALL TABLES IN SCHEMA a TO b'
+                                           ';\nCOMMIT', database='db1')
+
+            def fail_on_grant(query, database):
+                if 'GRANT' in query:
+                    raise psycopg2.Error(database)
+            mock_runsql.reset_mock()
+            mock_runsql.side_effect = fail_on_grant
+            for statement in statements:
+                pgcon.run_ddl(statement)
+            self.assertEqual(pgcon.stop_batch(), 1)
+            mock_runsql.assert_any_call('ROLLBACK', database='postgres')
+            mock_runsql.assert_any_call('RELEASE SAVEPOINT pgcdfga_batch', database='postgres')
+            mock_runsql.assert_any_call('ROLLBACK TO SAVEPOINT pgcdfga_batch',
+                                        database='postgres')
+            mock_runsql.assert_called_with('COMMIT', database='postgres')
+
+            # Outside of a batch, statements run immediately
+            mock_runsql.reset_mock()
+            mock_runsql.side_effect = None
+            pgcon.run_ddl('CREATE ROLE c')
+            mock_runsql.assert_called_with('CREATE ROLE c')
+
+    def test_mocked_batch_redacted(self):
+        '''
+        Test that queued DDL is logged without the password hash
+        '''
+        password = 'md5' + '0' * 32
+        with unittest.mock.patch('psycopg2.connect') as mock_connect, \
+                patch.object(PGConnection, 'run_sql'), \
+                patch('pgcdfga.pgconnection.logging.debug') as mock_debug:
+            mock_cur = mock_connect.return_value.cursor.return_value
+            mock_cur.mogrify.return_value = "ALTER ROLE a WITH ENCRYPTED PASSWORD '{}'".format(
+                password).encode()
+            pgcon = PGConnection(dsn_params={'server': 'server1'})
+            pgcon.start_batch(10)
+            pgcon.run_ddl(SQL('ALTER ROLE a WITH ENCRYPTED PASSWORD %s'), [password])
+            logged = ' '.join(str(arg) for call in mock_debug.call_args_list for arg in call[0])
+            self.assertIn("PASSWORD '********'", logged)
+            self.assertNotIn(password, logged)
+            pgcon.stop_batch()
+        self.assertEqual(redact("alter role a password 'it''s'"),
+                         "alter role a password '********'")
+
+
+class KeyFileCacheTest(unittest.TestCase):
+    """
+    Test the KeyFileCache Class.
+    """
+    def test_key_file_cache(self):
+        '''
+        Test KeyFileCache to reuse a copy until the key file changes
+        '''
+        keyfile_hnd, keyfile = tempfile.mkstemp()
+        os.close(keyfile_hnd)
+        with open(keyfile, 'w', encoding='utf8') as keyfile_hnd:
+            keyfile_hnd.write('key1')
+        os.chmod(keyfile, 0o640)
+        cache = KeyFileCache()
+        newkeyfile = cache.get(keyfile)
+        with open(newkeyfile, encoding='utf8') as keyfile_hnd:
+            self.assertEqual(keyfile_hnd.read(), 'key1')
+        self.assertEqual(os.stat(newkeyfile).st_mode & 0o777, 0o600)
+        self.assertEqual(cache.get(keyfile), newkeyfile)
+
+        with open(keyfile, 'w', encoding='utf8') as keyfile_hnd:
+            keyfile_hnd.write('key2 (rotated)')
+        rotatedkeyfile = cache.get(keyfile)
+        self.assertNotEqual(rotatedkeyfile, newkeyfile)
+        self.assertFalse(os.path.exists(newkeyfile))
+        with open(rotatedkeyfile, encoding='utf8') as keyfile_hnd:
+            self.assertEqual(keyfile_hnd.read(), 'key2 (rotated)')
+
+        cache.clean()
+        self.assertFalse(os.path.exists(rotatedkeyfile))
+        os.chmod(keyfile, 0o600)
+        self.assertIsNone(cache.get(keyfile))
+        os.remove(keyfile)
@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+
+# Copyright 2019 Bol.com
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''
+This module holds all unit tests for the pgevents module
+'''
+import os
+import time
+import logging
+import unittest
+import unittest.mock
+import psycopg2
+from psycopg2.extensions import Notify
+from pgcdfga.pgevents import DDLListener, install_event_trigger, wait_for_ddl, NOTIFY_CHANNEL
+
+
+logging.disable(logging.CRITICAL)
+
+
+class FakeListenConnection():
+    '''
+    This class is a fake connection with a pipe as socket, which is readable after notify.
+    '''
+    def __init__(self, database):
+        '''
+        Sets some defaults on a new initted FakeListenConnection class.
+        '''
+        self.database = database
+        self.notifies = []
+        self.pending = []
+        self.broken = False
+        self.closed = 0
+        self.cursor = unittest.mock.Mock()
+        self.__read, self.__write = os.pipe()
+
+    def fileno(self):
+        '''
+        Returns the file descriptor to wait on.
+        '''
+        return self.__read
+
+    def notify(self, pid, payload):
+        '''
+        Send a notification to this connection (as if it was sent by backend pid).
+        '''
+        self.pending.append(Notify(pid, NOTIFY_CHANNEL, payload))
+        os.write(self.__write, b'x')
+
+    def poll(self):
+        '''
+        Read the pending notifications.
+        '''
+        os.read(self.__read, 1024)
+        if self.broken:
+            raise psycopg2.OperationalError('server closed the connection unexpectedly')
+        self.notifies.extend(self.pending)
+        self.pending = []
+
+    def close(self):
+        '''
+        Close the connection.
+        '''
+        self.closed = 1
+        os.close(self.__read)
+        os.close(self.__write)
+
+
+class PGEventsTest(unittest.TestCase):
+    """
+    Test install_event_trigger and the DDLListener Class.
+    """
+    def test_install_event_trigger(self):
+        '''
+        Test install_event_trigger to only create the trigger when it does not exist
+        '''
+        pgconn = unittest.mock.Mock()
+        pgconn.run_prepared.return_value = []
+        self.assertTrue(install_event_trigger(pgconn, 'app'))
+        self.assertEqual(pgconn.run_ddl.call_count, 2)
+        pgconn.run_ddl.assert_called_with(unittest.mock.ANY, database='app')
+        pgconn.reset_mock()
+        pgconn.run_prepared.return_value = [{'evtname': 'pgcdfga_ddl'}]
+        self.assertFalse(install_event_trigger(pgconn, 'app'))
+        pgconn.run_ddl.assert_not_called()
+
+    def test_wait(self):
+        '''
+        Test DDLListener.wait to coalesce notifications, and ignore notifications of own pids
+        '''
+        connections = {}
+
+        def connect(database):
+            connections[database] = FakeListenConnection(database)
+            return connections[database]
+        pgconn = unittest.mock.Mock()
+        pgconn.run_prepared.return_value = [{'evtname': 'pgcdfga_ddl'}]
+        listener = DDLListener(connect)
+        listener.debounce = 0.05
+        listener.watch(pgconn, ['app1', 'app2', 'app3'])
+        self.assertEqual(listener.databases(), {'app1', 'app2', 'app3'})
+        connections['app1'].cursor.return_value.execute.assert_called_once()
+
+        start = time.monotonic()
+        self.assertEqual(listener.wait(0.05), set())
+        self.assertGreaterEqual(time.monotonic() - start, 0.05)
+
+        connections['app1'].notify(100, 'CREATE TABLE')
+        connections['app1'].notify(100, 'GRANT')
+        connections['app2'].notify(200, 'CREATE EXTENSION')
+        connections['app3'].notify(42, 'GRANT')
+        start = time.monotonic()
+        self.assertEqual(listener.wait(10, ignore_pids={42}), {'app1', 'app2'})
+        self.assertLess(time.monotonic() - start, 5)
+        self.assertEqual(connections['app1'].notifies, [])
+
+        connections['app3'].notify(42, 'GRANT')
+        self.assertEqual(listener.wait(0.05, ignore_pids={42}), set())
+
+        # A broken connection is closed, and opened again by watch
+        connections['app2'].broken = True
+        connections['app2'].notify(200, 'DROP TABLE')
+        self.assertEqual(listener.wait(0.05), set())
+        self.assertEqual(listener.databases(), {'app1', 'app3'})
+        listener.watch(pgconn, ['app1', 'app2'])
+        self.assertEqual(listener.databases(), {'app1', 'app2'})
+        self.assertEqual(connections['app3'].closed, 1)
+        listener.close()
+        self.assertEqual(listener.databases(), set())
+
+    def test_watch_failure(self):
+        '''
+        Test DDLListener.watch to skip databases where the event trigger can not be installed
+        '''
+        pgconn = unittest.mock.Mock()
+        pgconn.run_prepared.side_effect = psycopg2.ProgrammingError('permission denied')
+        connect = unittest.mock.Mock()
+        listener = DDLListener(connect)
+        listener.watch(pgconn, ['app'])
+        self.assertEqual(listener.databases(), set())
+        connect.assert_not_called()
+
+    def test_wait_for_ddl(self):
+        '''
+        Test wait_for_ddl to wait for the listeners of more than one cluster
+        '''
+        pgconn = unittest.mock.Mock()
+        pgconn.run_prepared.return_value = [{'evtname': 'pgcdfga_ddl'}]
+        connections = {}
+        listeners = {}
+        for cluster in ['pg1', 'pg2']:
+            connections[cluster] = FakeListenConnection('app')
+            listeners[cluster] = DDLListener(lambda database, conn=connections[cluster]: conn)
+            listeners[cluster].debounce = 0.05
+            listeners[cluster].watch(pgconn, ['app'])
+        # Backend pids are per cluster
+        connections['pg1'].notify(42, 'GRANT')
+        connections['pg2'].notify(42, 'GRANT')
+        self.assertEqual(wait_for_ddl(listeners, 10, {'pg1': {42}}), {'pg2': {'app'}})
+        self.assertEqual(wait_for_ddl(listeners, 0.05), {})
+        for listener in listeners.values():
+            listener.close()
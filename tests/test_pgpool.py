@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+
+# Copyright 2019 Bol.com
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''
+This module holds all unit tests for the pgpool module
+'''
+import logging
+import unittest
+import unittest.mock
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE, TRANSACTION_STATUS_INTRANS, \
+    TRANSACTION_STATUS_UNKNOWN
+from pgcdfga.pgpool import PGConnectionPool
+
+
+logging.disable(logging.CRITICAL)
+
+
+def fake_connect(database):
+    '''
+    Returns a mocked connection that is open and idle.
+    '''
+    conn = unittest.mock.Mock(closed=0, database=database)
+    conn.get_transaction_status.return_value = TRANSACTION_STATUS_IDLE
+    return conn
+
+
+class PGConnectionPoolTest(unittest.TestCase):
+    """
+    Test the PGConnectionPool Class.
+    """
+    def test_lru_eviction(self):
+        '''
+        Test PGConnectionPool to close the least recently used connection
+        '''
+        pool = PGConnectionPool(fake_connect, max_connections=2)
+        db1 = pool.acquire('db1')
+        pool.release('db1')
+        db2 = pool.acquire('db2')
+        pool.release('db2')
+        self.assertIs(pool.acquire('db1'), db1)
+        pool.release('db1')
+        pool.acquire('db3')
+        pool.release('db3')
+        db2.close.assert_called_with()
+        db1.close.assert_not_called()
+        self.assertEqual(len(pool), 2)
+        self.assertEqual(pool.stats, {'hits': 1, 'misses': 3, 'evictions': 1,
+                                      'invalidated': 0})
+        pool.close()
+        db1.close.assert_called_with()
+        self.assertEqual(len(pool), 0)
+
+    def test_no_eviction_in_use(self):
+        '''
+        Test PGConnectionPool not to close connections that are in use, or in a transaction
+        '''
+        pool = PGConnectionPool(fake_connect, max_connections=2)
+        db1 = pool.acquire('db1')
+        db2 = pool.acquire('db2')
+        pool.release('db2')
+        db2.get_transaction_status.return_value = TRANSACTION_STATUS_INTRANS
+        pool.acquire('db3')
+        db1.close.assert_not_called()
+        db2.close.assert_not_called()
+        self.assertEqual(len(pool), 3)
+        pool.release('db1')
+        pool.release('db3')
+        pool.acquire('db4')
+        db1.close.assert_called_with()
+        db2.close.assert_not_called()
+        self.assertEqual(len(pool), 2)
+
+    def test_validation(self):
+        '''
+        Test PGConnectionPool to replace closed and broken connections
+        '''
+        pool = PGConnectionPool(fake_connect)
+        db1 = pool.acquire('db1')
+        pool.release('db1')
+        db1.closed = 1
+        self.assertIsNot(pool.acquire('db1'), db1)
+        pool.release('db1')
+        db1 = pool.acquire('db1')
+        pool.release('db1')
+        db1.get_transaction_status.return_value = TRANSACTION_STATUS_UNKNOWN
+        self.assertIsNot(pool.acquire('db1'), db1)
+        self.assertEqual(pool.stats['invalidated'], 2)
+
+    def test_backend_pids(self):
+        '''
+        Test PGConnectionPool to return the backend pids of the open connections
+        '''
+        pool = PGConnectionPool(fake_connect)
+        for pid, database in enumerate(['db1', 'db2']):
+            conn = pool.acquire(database)
+            conn.get_backend_pid.return_value = pid
+            pool.release(database)
+        conn.closed = 1
+        self.assertEqual(pool.backend_pids(), {0})
+
+    def test_connect_error(self):
+        '''
+        Test PGConnectionPool to release a connection that could not be made
+        '''
+        pool = PGConnectionPool(unittest.mock.Mock(side_effect=OSError), max_connections=1)
+        with self.assertRaises(OSError):
+            pool.acquire('db1')
+        self.assertEqual(len(pool), 0)
@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+
+# Copyright 2019 Bol.com
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''
+This module holds all unit tests for the planner module
+'''
+import logging
+import unittest
+from unittest.mock import patch
+from pgcdfga.pgcatalog import PGCatalog
+from pgcdfga.pgconnection import PGConnection
+from pgcdfga.passwords import md5_password, scram_verifier, verifier_encryption
+from pgcdfga.planner import DesiredState, Operation, plan, apply, describe
+
+
+logging.disable(logging.CRITICAL)
+
+
+def catalog_for(desired):
+    '''
+    Returns a PGCatalog that is in line with a desired state.
+    '''
+    catalog = PGCatalog()
+    catalog.current_user = 'postgres'
+    catalog.add_role('postgres')
+    for rolename, options in desired.roles.items():
+        catalog.add_role(rolename)
+        for option in options:
+            catalog.set_role_option(rolename, {'LOGIN': 'rolcanlogin',
+                                               'SUPERUSER': 'rolsuper'}[option])
+    for username, password in desired.passwords.items():
+        catalog.set_password(username, md5_password(username, password))
+    for username, rolename in desired.grants:
+        catalog.add_member(username, rolename)
+    catalog.set_database('postgres', 'postgres')
+    for dbname, ownername in desired.databases.items():
+        catalog.set_database(dbname, ownername)
+        catalog.extensions[dbname] = {extname: version and str(version) for extname,
+                                      (_schema, version) in desired.extensions[dbname].items()}
+    return catalog
+
+
+def example_state():
+    '''
+    Returns a DesiredState with a bit of everything.
+    '''
+    desired = DesiredState()
+    desired.add_role('scot', ['login'])
+    desired.passwords['scot'] = 'tiger'
+    desired.add_role('dba', ['superuser'])
+    desired.add_grant('scot', 'dba')
+    desired.add_database('app', 'scot')
+    desired.extensions['app']['pg_stat_statements'] = ('public', '1.5')
+    return desired
+
+
+class PlannerTest(unittest.TestCase):
+    """
+    Test the plan and apply functions.
+    """
+    def test_plan_unchanged(self):
+        '''
+        Test plan on a cluster that is in line with the desired state
+        '''
+        desired = example_state()
+        pgconn = PGConnection(dsn_params={'server': 'server1'})
+        pgconn.catalog = catalog_for(desired)
+        with patch.object(PGConnection, 'run_sql') as mock_runsql:
+            operations = plan(desired, pgconn)
+            mock_runsql.assert_not_called()
+        self.assertEqual(operations, [Operation('databases', 'databases', 'grantreadonly',
+                                                ('app',), 'app')])
+
+    def test_plan_changes(self):
+        '''
+        Test plan on a cluster that has drifted from the desired state
+        '''
+        desired = example_state()
+        desired.absent_roles.add('john')
+        pgconn = PGConnection(dsn_params={'server': 'server1'},
+                              strict_params={'users': True, 'databases': True,
+                                             'extensions': True})
+        pgconn.catalog = catalog = catalog_for(desired)
+        catalog.roles['dba']['rolsuper'] = False
+        catalog.set_password('scot', None)
+        catalog.remove_member('scot', 'dba')
+        catalog.add_role('john')
+        catalog.add_role('olduser')
+        catalog.add_member('olduser', 'readonly')
+        # Predefined roles of newer postgres versions are never dropped
+        catalog.add_role('pg_database_owner')
+        catalog.add_role('pg_read_all_data')
+        catalog.set_database('olddb', 'postgres')
+        catalog.databases['app'] = 'postgres'
+        catalog.extensions['app'] = {'pg_stat_statements': '1.4', 'plpgsql': '1.0'}
+        operations = plan(desired, pgconn)
+        expected = [Operation('roles', 'users', 'createrole', ('dba', ['SUPERUSER']), None),
+                    Operation('passwords', 'users', 'setpassword',
+                              ('scot', md5_password('scot', 'tiger')), None),
+                    Operation('grants', 'users', 'grantrole', ('scot', 'dba'), None),
+                    Operation('databases', 'databases', 'createdb', ('app', 'scot'), None),
+                    Operation('extensions', 'extensions', 'createextension',
+                              ('pg_stat_statements', 'app', 'public', '1.5'), 'app'),
+                    Operation('drops', 'users', 'droproles', (('john', ), 1), None),
+                    Operation('strictify', 'users', 'revokeroles', ('readonly', ('olduser', )),
+                              None),
+                    Operation('strictify', 'users', 'droproles', (('olduser', ), 1), None),
+                    Operation('strictify', 'databases', 'dropdb', ('olddb',), None),
+                    Operation('strictify', 'extensions', 'dropextension',
+                              ('plpgsql', 'app'), 'app')]
+        self.assertEqual(operations, expected)
+        self.assertEqual(describe(expected[1]), "passwords: setpassword('scot', '********')")
+
+    def test_plan_scram(self):
+        '''
+        Test plan to set SCRAM-SHA-256 verifiers for changed passwords and md5 verifiers
+        '''
+        desired = example_state()
+        desired.add_role('tiger', ['login'])
+        desired.passwords['tiger'] = 'scot'
+        pgconn = PGConnection(dsn_params={'server': 'server1'},
+                              password_encryption='scram-sha-256')
+        pgconn.catalog = catalog = catalog_for(desired)
+        catalog.set_password('tiger', scram_verifier('scot'))
+        operations = [operation for operation in plan(desired, pgconn)
+                      if operation.method == 'setpassword']
+        self.assertEqual([operation.args[0] for operation in operations], ['scot'])
+        self.assertEqual(verifier_encryption(operations[0].args[1]), 'scram-sha-256')
+        catalog.set_password('scot', operations[0].args[1])
+        self.assertEqual([operation for operation in plan(desired, pgconn)
+                          if operation.method == 'setpassword'], [])
+
+    def test_plan_new_role(self):
+        '''
+        Test plan to grant existing roles to a new role when it is created
+        '''
+        desired = example_state()
+        pgconn = PGConnection(dsn_params={'server': 'server1'})
+        pgconn.catalog = catalog_for(desired)
+        desired.add_role('jane', ['login'])
+        desired.add_grant('jane', 'dba')
+        desired.add_grant('jane', 'newrole')
+        operations = plan(desired, pgconn)
+        self.assertEqual(operations[:3], [
+            Operation('roles', 'users', 'createrole', ('jane', ['LOGIN'], ['dba']), None),
+            Operation('roles', 'users', 'createrole', ('newrole', []), None),
+            Operation('grants', 'users', 'grantrole', ('jane', 'newrole'), None)])
+
+    def test_apply(self):
+        '''
+        Test apply to count errors and skip strictify for chapters with errors
+        '''
+        operations = [Operation('roles', 'users', 'createrole', ('dba', ['SUPERUSER']), None),
+                      Operation('databases', 'databases', 'createdb', ('app', 'scot'), None),
+                      Operation('strictify', 'users', 'droprole', ('olduser',), None),
+                      Operation('strictify', 'databases', 'dropdb', ('olddb',), None)]
+        with patch.object(PGConnection, 'createrole') as mock_createrole, \
+                patch.object(PGConnection, 'createdb') as mock_createdb, \
+                patch.object(PGConnection, 'droprole') as mock_droprole, \
+                patch.object(PGConnection, 'dropdb') as mock_dropdb:
+            mock_createrole.side_effect = Exception('Failed')
+            pgconn = PGConnection(dsn_params={'server': 'server1'},
+                                  strict_params={'users': True, 'databases': True})
+            self.assertEqual(apply(pgconn, operations), 1)
+            mock_createrole.assert_called_with('dba', ['SUPERUSER'])
+            mock_createdb.assert_called_with('app', 'scot')
+            mock_droprole.assert_not_called()
+            mock_dropdb.assert_called_with('olddb')
+            self.assertFalse(pgconn.strict_params['users'])
+
+    def test_resolve_conflicts(self):
+        '''
+        Test that absent roles win from roles that are created elsewhere
+        '''
+        desired = example_state()
+        desired.absent_roles.add('scot')
+        desired.resolve_conflicts()
+        self.assertNotIn('scot', desired.roles)
+        self.assertNotIn('scot', desired.passwords)
+        self.assertNotIn(('scot', 'dba'), desired.grants)
+
+    def test_apply_batched(self):
+        '''
+        Test apply to count failed statements of a batch as errors of that phase
+        '''
+        operations = [Operation('grants', 'users', 'grantrole', ('scot', 'dba'), None),
+                      Operation('strictify', 'users', 'droprole', ('olduser',), None)]
+        with patch.object(PGConnection, 'grantrole'), \
+                patch.object(PGConnection, 'droprole') as mock_droprole, \
+                patch.object(PGConnection, 'start_batch') as mock_start_batch, \
+                patch.object(PGConnection, 'stop_batch') as mock_stop_batch:
+            mock_stop_batch.return_value = 2
+            pgconn = PGConnection(dsn_params={'server': 'server1'},
+                                  strict_params={'users': True})
+            self.assertEqual(apply(pgconn, operations, batch_size=50), 4)
+            mock_start_batch.assert_called_with(50)
+            mock_droprole.assert_not_called()
+
+    def test_apply_parallel(self):
+        '''
+        Test apply to run operations per database in a pool of workers
+        '''
+        operations = [Operation('databases', 'databases', 'createdb', ('db1', 'db1'), None)]
+        for dbname in ['db2', 'db3', 'db4']:
+            operations.append(Operation('databases', 'databases', 'grantreadonly', (dbname,),
+                                        dbname))
+            operations.append(Operation('extensions', 'extensions', 'createextension',
+                                        ('hstore', dbname, 'public', None), dbname))
+        operations.append(Operation('strictify', 'extensions', 'dropextension',
+                                    ('plpgsql', 'db2'), 'db2'))
+        with patch.object(PGConnection, 'createdb') as mock_createdb, \
+                patch.object(PGConnection, 'grantreadonly') as mock_grantreadonly, \
+                patch.object(PGConnection, 'createextension') as mock_createextension, \
+                patch.object(PGConnection, 'dropextension') as mock_dropextension:
+            mock_createextension.side_effect = lambda *args: args[1] == 'db3' and 1 / 0
+            pgconn = PGConnection(dsn_params={'server': 'server1'},
+                                  strict_params={'databases': True, 'extensions': True})
+            self.assertEqual(apply(pgconn, operations, parallelism=3), 1)
+            mock_createdb.assert_called_with('db1', 'db1')
+            self.assertEqual(mock_grantreadonly.call_count, 3)
+            self.assertEqual(mock_createextension.call_count, 3)
+            self.assertFalse(pgconn.strict_params['extensions'])
+            self.assertTrue(pgconn.strict_params['databases'])
+            mock_dropextension.assert_not_called()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+
+# Copyright 2019 Bol.com
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''
+This module holds all unit tests for the profiler module
+'''
+import os
+import pstats
+import logging
+import tempfile
+import unittest
+from pgcdfga.profiler import Profiler, collapsed_stacks
+
+
+logging.disable(logging.CRITICAL)
+
+
+def busy(count):
+    '''
+    Returns a sum of squares, to have something to profile.
+    '''
+    return sum(number * number for number in range(count))
+
+
+class ProfilerTest(unittest.TestCase):
+    """
+    Test the Profiler Class.
+    """
+    def test_every(self):
+        '''
+        Test Profiler to only profile every Nth run, and only when enabled
+        '''
+        profiler = Profiler('/tmp', every=3)
+        self.assertEqual([profiler.start_run() for _ in range(5)],
+                         [True, False, False, True, False])
+        self.assertFalse(Profiler().start_run())
+
+    def test_profile_run(self):
+        '''
+        Test Profiler to write pstats per phase, and collapsed stacks of all phases
+        '''
+        with tempfile.TemporaryDirectory() as directory:
+            profiler = Profiler(directory)
+            profiler.start_run()
+            with profiler.profile('roles'):
+                busy(10000)
+                with profiler.profile('nested'):
+                    busy(10000)
+            with profiler.profile('strictify'):
+                busy(20000)
+            filenames = profiler.finish_run()
+            self.assertEqual([os.path.basename(filename) for filename in filenames],
+                             ['pgcdfga-00001-roles.pstats', 'pgcdfga-00001-strictify.pstats',
+                              'pgcdfga-00001.folded'])
+            lineno = busy.__code__.co_firstlineno
+            stats = pstats.Stats(filenames[0])
+            self.assertEqual(stats.stats[(busy.__code__.co_filename, lineno, 'busy')][1], 2)
+            with open(filenames[-1]) as foldedfile:
+                lines = foldedfile.read().splitlines()
+            label = 'roles;test_profiler.py:{}:busy'.format(lineno)
+            self.assertTrue(any(line.startswith(label) for line in lines))
+            self.assertTrue(any(line.startswith('strictify;') for line in lines))
+            for line in lines:
+                self.assertRegex(line, r'^\S.* \d+$')
+            self.assertEqual(profiler.finish_run(), [])
+
+    def test_collapsed_stacks(self):
+        '''
+        Test collapsed_stacks to divide the time of functions over the places they where called
+        '''
+        main, query, execute = ('main.py', 1, 'main'), ('db.py', 2, 'query'), ('~', 0, 'execute')
+        stats = {main: (1, 1, 0.1, 1.0, {}),
+                 query: (3, 3, 0.2, 0.9, {main: (3, 3, 0.2, 0.9)}),
+                 execute: (4, 4, 0.8, 0.8, {query: (3, 3, 0.6, 0.6), main: (1, 1, 0.2, 0.2)})}
+        self.assertEqual(collapsed_stacks(stats, 'plan'), {
+            'plan;main.py:1:main': 100000,
+            'plan;main.py:1:main;db.py:2:query': 200000,
+            'plan;main.py:1:main;db.py:2:query;execute': 600000,
+            'plan;main.py:1:main;execute': 200000})